@@ -1,10 +1,10 @@
 from datetime import datetime
 import logging
-import os
 import sqlite3
 from textwrap import dedent
 import time
 
+from . import storage
 from .errors import NotificationError
 
 logger = logging.getLogger(__name__)
@@ -41,8 +41,7 @@ class NotificationMgmt():
 
     @classmethod
     def bootstrap(self, config):
-        db_path = os.path.join(config.temboard.home, 'core.db')
-        with sqlite3.connect(db_path) as conn:
+        with storage.connect(config.temboard.home, 'core.db') as conn:
             c = conn.cursor()
             c.execute(
                 dedent("""
@@ -64,8 +63,7 @@ class NotificationMgmt():
     def push(self, config, notification):
         try:
 
-            db_path = os.path.join(config.temboard.home, 'core.db')
-            with sqlite3.connect(db_path) as conn:
+            with storage.connect(config.temboard.home, 'core.db') as conn:
                 c = conn.cursor()
                 c.execute(
                     "INSERT INTO action_logs VALUES (?, ?, ?)",
@@ -96,8 +94,7 @@ class NotificationMgmt():
 
         try:
 
-            db_path = os.path.join(config.temboard.home, 'core.db')
-            with sqlite3.connect(db_path) as conn:
+            with storage.connect(config.temboard.home, 'core.db') as conn:
                 c = conn.cursor()
                 c.execute("SELECT time, username, message FROM action_logs "
                           "ORDER BY time DESC " + limit)
@@ -46,9 +46,11 @@ def get_database(pgpool, dbname):
 
 @bottle.get('/<dbname>/schema/<schema>')
 def get_schema(pgpool, dbname, schema):
+    app = default_app().temboard
     for getconn in pgpool.auto_reconnect():
         with getconn(dbname) as conn:
-            tables = functions.get_tables(conn, schema)
+            tables = functions.get_tables(
+                conn, schema, app.config.temboard.home)
             indexes = functions.get_schema_indexes(conn, schema)
             schema = functions.get_schema(conn, schema)
     return dict(dict(tables, **indexes), **schema)
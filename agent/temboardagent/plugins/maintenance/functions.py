@@ -1,10 +1,12 @@
 from datetime import datetime, timedelta
 import hashlib
+import json
 import logging
 import os
 
 from bottle import HTTPError
 
+from temboardagent import storage
 from temboardagent.errors import UserError
 from temboardagent.toolkit import taskmanager
 
@@ -12,7 +14,7 @@ logger = logging.getLogger(__package__)
 
 # Taken from https://github.com/ioguix/pgsql-bloat-estimation/blob/master/table/table_bloat.sql  # noqa
 TABLE_BLOAT_SQL = """
-SELECT current_database(), schemaname, tblname, bs*tblpages AS real_size,
+SELECT current_database(), schemaname, tblname, tblid, bs*tblpages AS real_size,
   (tblpages-est_tblpages)*bs AS extra_size,
   CASE WHEN tblpages - est_tblpages > 0
     THEN 100 * (tblpages - est_tblpages)/tblpages::float
@@ -77,7 +79,7 @@ INDEX_BTREE_BLOAT_SQL = """
 -- This query run much faster than btree_bloat.sql, about 1000x faster.
 --
 -- This query is compatible with PostgreSQL 8.2 and after.
-SELECT current_database(), nspname AS schemaname, tblname, idxname, bs*(relpages)::bigint AS real_size,
+SELECT current_database(), nspname AS schemaname, tblname, idxname, idxoid, bs*(relpages)::bigint AS real_size,
   bs*(relpages-est_pages)::bigint AS extra_size,
   100 * (relpages-est_pages)::float / relpages AS extra_ratio,
   fillfactor,
@@ -95,7 +97,7 @@ FROM (
       coalesce(1 +
          ceil(reltuples/floor((bs-pageopqdata-pagehdr)*fillfactor/(100*(4+nulldatahdrwidth)::float))), 0
       ) AS est_pages_ff,
-      bs, nspname, tblname, idxname, relpages, fillfactor, is_na
+      bs, nspname, tblname, idxname, idxoid, relpages, fillfactor, is_na
       -- , pgstatindex(idxoid) AS pst, index_tuple_hdr_bm, maxalign, pagehdr, nulldatawidth, nulldatahdrwidth, reltuples -- (DEBUG INFO)
   FROM (
       SELECT maxalign, bs, nspname, tblname, idxname, reltuples, relpages, idxoid, fillfactor,
@@ -274,6 +276,106 @@ ORDER BY 1,2
 """  # noqa
 
 
+# Bloat estimation depends on pg_class, pg_stats and reloptions of a relation.
+# These change on VACUUM, ANALYZE, DDL and rename. Signature is the state of
+# all these inputs, per table and btree index.
+BLOAT_SIGNATURES_SQL = """
+SELECT c.oid, c.relkind,
+       concat_ws(
+         ':', n.nspname, t.relname, c.relname, c.reloptions::TEXT,
+         c.relpages, c.reltuples,
+         s.vacuum_count + s.autovacuum_count,
+         s.analyze_count + s.autoanalyze_count
+       ) AS signature
+FROM pg_catalog.pg_class AS c
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+LEFT JOIN pg_catalog.pg_index AS i ON i.indexrelid = c.oid
+JOIN pg_catalog.pg_class AS t ON t.oid = COALESCE(i.indrelid, c.oid)
+JOIN pg_catalog.pg_stat_all_tables AS s ON s.relid = t.oid
+WHERE c.relkind = 'r'
+   OR (c.relkind = 'i' AND
+       c.relam = (SELECT oid FROM pg_catalog.pg_am WHERE amname = 'btree'))
+"""
+
+# Estimation queries are filtered on relation oids. Escape % for parameters.
+TABLE_BLOAT_BY_OID_SQL = """
+SELECT * FROM (%s) AS bloat WHERE tblid = ANY(%%s::OID[])
+""" % TABLE_BLOAT_SQL.replace('%', '%%')
+
+INDEX_BTREE_BLOAT_BY_OID_SQL = """
+SELECT * FROM (%s) AS bloat WHERE idxoid = ANY(%%s::OID[])
+""" % INDEX_BTREE_BLOAT_SQL.replace('%', '%%')
+
+
+def estimate_bloat(conn, path):
+    """Returns tables and btree indexes bloat estimation of a database.
+
+    Estimations are cached in catalog.db. Only relations whose signature
+    changed since previous call are estimated again.
+    """
+    dbname = conn.queryscalar("SELECT current_database()")
+    signatures = dict(
+        (r['oid'], (r['relkind'], r['signature']))
+        for r in conn.query(BLOAT_SIGNATURES_SQL))
+
+    sqlite = storage.connect(path, 'catalog.db')
+    with sqlite:
+        sqlite.execute("""
+        CREATE TABLE IF NOT EXISTS bloat (
+            dbname TEXT,
+            oid INTEGER,
+            signature TEXT,
+            data TEXT,
+            PRIMARY KEY (dbname, oid)
+        )
+        """)
+    cache = dict(
+        (oid, (signature, data)) for oid, signature, data in sqlite.execute(
+            "SELECT oid, signature, data FROM bloat WHERE dbname = ?",
+            (dbname,)))
+
+    stale = dict(r=[], i=[])
+    for oid, (relkind, signature) in signatures.items():
+        if cache.get(oid, (None,))[0] != signature:
+            stale[relkind].append(oid)
+    logger.debug(
+        "Estimating bloat of %s tables and %s indexes of %s.",
+        len(stale['r']), len(stale['i']), dbname)
+
+    estimates = dict((oid, None) for oid in stale['r'] + stale['i'])
+    if stale['r']:
+        for row in conn.query(TABLE_BLOAT_BY_OID_SQL, (stale['r'],)):
+            estimates[row['tblid']] = row
+    if stale['i']:
+        for row in conn.query(INDEX_BTREE_BLOAT_BY_OID_SQL, (stale['i'],)):
+            estimates[row['idxoid']] = row
+
+    # Serialize Decimal as float, like cached estimations. Estimation query
+    # may ignore a relation, e.g. an empty index. Cache it as null to not
+    # estimate it again.
+    data = dict(
+        (oid, json.dumps(row, default=float))
+        for oid, row in estimates.items())
+    with sqlite:
+        # Forget dropped relations.
+        sqlite.executemany(
+            "DELETE FROM bloat WHERE dbname = ? AND oid = ?",
+            [(dbname, oid) for oid in cache if oid not in signatures])
+        sqlite.executemany(
+            "INSERT OR REPLACE INTO bloat VALUES (?, ?, ?, ?)",
+            [(dbname, oid, signatures[oid][1], d) for oid, d in data.items()])
+
+    tables, indexes = [], []
+    for oid, (relkind, _) in signatures.items():
+        row = json.loads(data[oid] if oid in data else cache[oid][1])
+        if row:
+            (tables if 'r' == relkind else indexes).append(row)
+
+    tables.sort(key=lambda r: (r['schemaname'], r['tblname']))
+    indexes.sort(key=lambda r: (r['schemaname'], r['tblname'], r['idxname']))
+    return dict(tables=tables, indexes=indexes)
+
+
 def get_instance(conn):
     return conn.query("""\
     SELECT SUM(pg_database_size(datname)) AS total_bytes,
@@ -338,7 +440,16 @@ def get_schema(conn, schema):
         return {}
 
 
-def get_tables(conn, schema):
+def get_tables(conn, schema, path):
+    # Bloat comes from cached estimations, see estimate_bloat().
+    bloat = estimate_bloat(conn, path)
+    tables = [t for t in bloat['tables'] if t['schemaname'] == schema]
+    indexes = {}
+    for i in bloat['indexes']:
+        if i['schemaname'] == schema:
+            indexes[i['tblname']] = \
+                indexes.get(i['tblname'], 0) + i['bloat_size']
+
     # taken from https://wiki.postgresql.org/wiki/Disk_Usage
     query = """
 SELECT table_name AS name,
@@ -376,24 +487,22 @@ LEFT JOIN (
   GROUP BY tablename
 ) AS indexes
 ON indexes.tablename = table_name
-JOIN (
-  """ + TABLE_BLOAT_SQL + """
-) AS tbloat
-ON tbloat.schemaname = table_schema AND tbloat.tblname = table_name
-LEFT JOIN (
-  SELECT SUM(bloat_size) AS bloat_size,
-         schemaname,
-         tblname
-  FROM (
-    """ + INDEX_BTREE_BLOAT_SQL + """
-  ) AS a
-  GROUP BY schemaname, tblname
-) AS ibloat
-ON ibloat.schemaname = table_schema AND ibloat.tblname = table_name
-WHERE table_schema = '{schema}';
+JOIN unnest(%(tables)s::TEXT[], %(tables_bloat)s::FLOAT8[])
+  AS tbloat(tblname, bloat_size)
+ON tbloat.tblname = table_name
+LEFT JOIN unnest(%(indexes)s::TEXT[], %(indexes_bloat)s::FLOAT8[])
+  AS ibloat(tblname, bloat_size)
+ON ibloat.tblname = table_name
+WHERE table_schema = %(schema)s;
     """ # noqa
     return {
-        'tables': list(conn.query(query.format(schema=schema)))
+        'tables': list(conn.query(query, dict(
+            schema=schema,
+            tables=[t['tblname'] for t in tables],
+            tables_bloat=[t['bloat_size'] for t in tables],
+            indexes=list(indexes),
+            indexes_bloat=list(indexes.values()),
+        )))
     }
 
 
@@ -7,7 +7,7 @@ from bottle import Bottle, default_app, request, HTTPError, response
 
 from ...toolkit import taskmanager
 from ...toolkit.configuration import OptionSpec
-from ...toolkit.validators import commalist
+from ...toolkit.validators import commalist, intervals
 from ...tools import now, validate_parameters
 from ... import __version__ as __VERSION__
 
@@ -29,6 +29,7 @@ workers = taskmanager.WorkerSet()
 
 T_TIMESTAMP_UTC = b'(^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z$)'
 T_LIMIT = b'(^[0-9]+$)'
+PURGE_INTERVAL = 10 * 60  # 10 minutes
 
 
 @bottle.get('/metrics')
@@ -36,11 +37,23 @@ def get_metrics():
     app = default_app().temboard
     response.headers['Content-Type'] = 'text/plain; version=0.0.4'
 
-    rows = db.get_metrics(app.config.temboard.home, 'monitoring.db')
+    h, n = app.config.temboard.home, 'monitoring.db'
+    rows = db.get_metrics(h, n)
     if not rows:
         return '# EOF\n'
-    (_, data), = rows
+    (last_time, data), = rows
     data = json.loads(data)
+    if 'probes' in data:
+        # Complete last record with samples of probes not due at last
+        # collect, from records in the largest probe interval.
+        probes = load_probes(app.config.monitoring, h)
+        window = max([p.interval or 0 for p in probes] + [0])
+        rows = db.iter_metrics(h, n, None, last_time - window)
+        for _, older in rows:
+            older = json.loads(older)
+            for probe, samples in older['data'].items():
+                if probe not in data['probes']:
+                    data['data'][probe] = samples
     db.use_current_for_delta_metrics(data)
     lines = format_open_metrics_lines(generate_samples(data))
     return '\n'.join(lines)
@@ -56,11 +69,18 @@ def get_monitoring():
     returned records to N, the query parameter 'limit' can be used and set to
     N. 'limit' default value is 50, meaning that the maximum number of record
     set this API returns by default is 50.
+
+    With Accept: application/x-ndjson, records are streamed as newline
+    delimited JSON, without limit. 'limit' query parameter is ignored. Each
+    record has an opaque 'cursor' property. Pass it back as 'cursor' query
+    parameter to resume after this record.
     """
 
     # Default values
     start_timestamp = None
-    limit = 50
+    after = None
+    ndjson = 'application/x-ndjson' in request.headers.get('Accept', '')
+    limit = None if ndjson else 50
 
     app = default_app().temboard
 
@@ -79,24 +99,55 @@ def get_monitoring():
         except ValueError:
             raise HTTPError(406, "Invalid timestamp")
 
-    if 'limit' in request.query:
+    if 'limit' in request.query and not ndjson:
         # Validate limit parameter
         validate_parameters(request.query, [
             ('limit', T_LIMIT, False),
         ])
         limit = int(request.query['limit'])
 
-    out = []
+    if 'cursor' in request.query:
+        try:
+            after = parse_cursor(request.query['cursor'])
+        except ValueError:
+            raise HTTPError(406, "Invalid cursor")
+
     h, n = app.config.temboard.home, 'monitoring.db',
-    for _, metrics in db.get_metrics(h, n, limit, start_timestamp):
+    rows = db.iter_metrics(h, n, limit, start_timestamp, after)
+    response.set_header('X-TemBoard-Discover-ETag', app.discover.etag)
+    if ndjson:
+        response.content_type = 'application/x-ndjson'
+        return generate_ndjson_history(rows)
+
+    out = []
+    for _, metrics in rows:
         metrics = json.loads(metrics)
         # Dropping current value, use /metrics to get them.
         db.drop_current_for_delta_metrics(metrics)
         out.append(metrics)
-    response.set_header('X-TemBoard-Discover-ETag', app.discover.etag)
     return out
 
 
+def generate_ndjson_history(rows):
+    for time_, metrics in rows:
+        metrics = json.loads(metrics)
+        # Dropping current value, use /metrics to get them.
+        db.drop_current_for_delta_metrics(metrics)
+        metrics['cursor'] = format_cursor(time_)
+        yield json.dumps(metrics) + '\n'
+
+
+def format_cursor(time_):
+    # repr() of float round-trips, cursor matches exactly the stored time.
+    return 't' + repr(time_)
+
+
+def parse_cursor(cursor):
+    if not cursor.startswith('t'):
+        raise ValueError("Unsupported cursor %r." % cursor)
+    return float(cursor[1:])
+
+
 @bottle.get('/config')
 def get_config():
     """Returns monitoring plugin configuration.
@@ -123,10 +174,28 @@ def monitoring_collector_worker(app):
         config.monitoring,
         config.temboard.home
     )
+    # Skip probes run recently. Tolerate half a collect interval of jitter.
+    start = time.time()
+    runs = db.get_probe_runs(config.temboard.home, 'monitoring.db')
+    tolerance = config.monitoring.scheduler_interval / 2.
+    probes = [
+        p for p in probes
+        if p.is_due(runs.get(p.get_name()), start, tolerance)
+    ]
 
     with app.postgres.dbpool() as pool:
         instance = instance_info(pool, app.config.monitoring.dbnames, discover)
-        data = run_probes(probes, pool, [instance])
+        data = run_probes(
+            probes, pool, [instance], workers=config.monitoring.probe_workers)
+
+    # Only probes with output are sampled. Probes skipped because instance
+    # is unavailable, failed or timed out are due again at next collect.
+    sampled = [p for p in probes if p.get_name() in data]
+
+    # Persist delta state and probe runs for next run.
+    db.get_last_measures(config.temboard.home, 'monitoring.db').checkpoint()
+    db.set_probe_runs(config.temboard.home, 'monitoring.db', [
+        (p.get_name(), start, p.duration or 0) for p in sampled])
 
     # Prepare and send output
     output = dict(
@@ -134,6 +203,8 @@ def monitoring_collector_worker(app):
         hostinfo=system_info,
         instances=remove_passwords([instance]),
         data=data,
+        # Probes sampled in this record. Other probes are not due yet.
+        probes=sorted(p.get_name() for p in sampled),
         version=__VERSION__,
     )
     logger.info("Add data to metrics table.")
@@ -159,6 +230,12 @@ def monitoring_collector_worker(app):
         logger.exception("Failed to log metrics.")
 
 
+@workers.register(pool_size=1)
+def monitoring_purge_worker(app):
+    count = db.purge_metrics(app.config.temboard.home, 'monitoring.db')
+    logger.debug("Purged %s metrics records.", count)
+
+
 def iter_metrics_for_logfmt(data):
     # Generates a flat sequence of record dict containing key value for logfmt
     # printing. See dev/perfui/ in temboard project to analyze such data.
@@ -189,6 +266,8 @@ class MonitoringPlugin:
         OptionSpec(s, 'dbnames', default='*', validator=commalist),
         OptionSpec(s, 'scheduler_interval', default=60, validator=int),
         OptionSpec(s, 'probes', default='*', validator=commalist),
+        OptionSpec(s, 'probe_workers', default=4, validator=int),
+        OptionSpec(s, 'probe_intervals', default='', validator=intervals),
     ]
     del s
 
@@ -207,6 +286,10 @@ class MonitoringPlugin:
             id='monitoring_collector',
             redo_interval=self.app.config.monitoring.scheduler_interval,
         )(monitoring_collector_worker)
+        workers.schedule(
+            id='monitoring_purge',
+            redo_interval=PURGE_INTERVAL,
+        )(monitoring_purge_worker)
         self.app.scheduler.add(workers)
 
     def unload(self):
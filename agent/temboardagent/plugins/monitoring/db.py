@@ -1,12 +1,18 @@
 import json
 import os
-import sqlite3
+import threading
 from textwrap import dedent
 from time import time as current_time
 
+from ... import storage
 from ...toolkit.utils import JSONEncoder
 
 
+# Delta stores by pid and SQLite file. A forked collector never uses a store
+# inherited from its parent.
+_last_measures = {}
+
+
 def bootstrap(path, dbname):
     """Create SQLite database model we use to store collected data.
 
@@ -17,9 +23,13 @@ def bootstrap(path, dbname):
 
     metrics table is used to queued collected data before they are pushed to
     temboard server.
+
+    probe_runs table keeps the time and run time of the last run of each
+    probe, to schedule probes at their own interval. It is purged too, all
+    probes run at first collect.
     """
 
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.connect(path, dbname) as conn:
         c = conn.cursor()
         c.execute("DROP TABLE IF EXISTS last_measures")
         c.execute(
@@ -31,6 +41,16 @@ def bootstrap(path, dbname):
                 )
             """)
         )
+        c.execute("DROP TABLE IF EXISTS probe_runs")
+        c.execute(
+            dedent("""
+                CREATE TABLE probe_runs (
+                    name TEXT PRIMARY KEY,
+                    time REAL,
+                    duration REAL
+                )
+            """)
+        )
         c.execute(
             dedent("""
                 CREATE TABLE IF NOT EXISTS metrics (
@@ -39,26 +59,30 @@ def bootstrap(path, dbname):
                 )
             """)
         )
+    # Forget measures loaded by this process. Forked collectors must load
+    # measures from SQLite, not inherit a store from the main process.
+    _last_measures.pop((os.getpid(), os.path.join(path, dbname)), None)
 
 
 def add_metric(path, dbname, time, data):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(
+    with storage.connect(path, dbname) as conn:
+        conn.execute(
             "INSERT INTO metrics VALUES(?, ?)",
             (time, json.dumps(data, cls=JSONEncoder))
         )
-        # When data are pulled from temboard server, we need to keep 6 hours of
-        # data history for recovery.
-        time_limit = current_time() - (60 * 60 * 6)
-        c.execute(
-            "DELETE FROM metrics WHERE time < ?",
-            (time_limit,)
-        )
+
+
+def purge_metrics(path, dbname):
+    # When data are pulled from temboard server, we need to keep 6 hours of
+    # data history for recovery. Scheduled periodically, not on each insert.
+    time_limit = current_time() - (60 * 60 * 6)
+    with storage.connect(path, dbname) as conn:
+        c = conn.execute("DELETE FROM metrics WHERE time < ?", (time_limit,))
+        return c.rowcount
 
 
 def delete_metric(path, dbname, time):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.connect(path, dbname) as conn:
         c = conn.cursor()
         c.execute(
             "DELETE FROM metrics WHERE time = ?",
@@ -67,9 +91,19 @@ def delete_metric(path, dbname, time):
 
 
 def get_metrics(path, dbname, limit=50, start_timestamp=None):
+    return list(iter_metrics(path, dbname, limit, start_timestamp))
+
+
+def iter_metrics(path, dbname, limit=50, start_timestamp=None, after=None):
+    # Yields metrics rows without loading all of them in memory. after is the
+    # time of the last row received by the caller and takes precedence over
+    # start_timestamp.
     query = "SELECT time, data FROM metrics"
     args = ()
-    if start_timestamp:
+    if after is not None:
+        query += " WHERE time > ?"
+        args += (after,)
+    elif start_timestamp:
         query += " WHERE time >= ?"
         args += (start_timestamp,)
     else:
@@ -84,36 +118,86 @@ def get_metrics(path, dbname, limit=50, start_timestamp=None):
         query += " LIMIT ?"
         args += (limit,)
 
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(query, args)
-        return c.fetchall()
+    conn = storage.connect(path, dbname)
+    for row in conn.execute(query, args):
+        yield row
 
 
-def get_last_measure(path, dbname, key):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT time, data FROM last_measures WHERE key = ?",
-            (key,)
-        )
-        return c.fetchone()
+def get_probe_runs(path, dbname):
+    # Returns a dict of probe name to time and duration of its last run.
+    conn = storage.connect(path, dbname)
+    rows = conn.execute("SELECT name, time, duration FROM probe_runs")
+    return dict((name, (time, duration)) for name, time, duration in rows)
 
 
-def upsert_last_measure(path, dbname, time, key, data):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        try:
-            c.execute(
-                "INSERT INTO last_measures VALUES(?, ?, ?)",
-                (time, key, json.dumps(data, cls=JSONEncoder))
-            )
-        except sqlite3.IntegrityError:
-            c.execute(
-                "UPDATE last_measures SET time = ?, data = ? "
-                "WHERE key = ?",
-                (time, json.dumps(data, cls=JSONEncoder), key)
-            )
+def set_probe_runs(path, dbname, runs):
+    # runs is a list of tuples of name, time and duration.
+    with storage.connect(path, dbname) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO probe_runs VALUES(?, ?, ?)", runs)
+
+
+def get_last_measures(path, dbname):
+    # Returns the delta store of this process for this database.
+    key = os.getpid(), os.path.join(path, dbname)
+    store = _last_measures.get(key)
+    if store is None:
+        store = _last_measures[key] = LastMeasures(path, dbname)
+    return store
+
+
+class LastMeasures(object):
+    """In-memory store of last measures used by probes to compute delta.
+
+    Measures are loaded from last_measures table on first access and kept in
+    memory. checkpoint() writes updated measures back in a single
+    transaction, collector calls it once per run instead of writing each
+    measure.
+    """
+
+    def __init__(self, path, dbname):
+        self.path = path
+        self.dbname = dbname
+        self.measures = None
+        self.dirty = set()
+        # Probes run concurrently, ensure measures are loaded once.
+        self.lock = threading.Lock()
+
+    def load(self):
+        conn = storage.connect(self.path, self.dbname)
+        rows = conn.execute("SELECT time, key, data FROM last_measures")
+        self.measures = dict(
+            (key, dict(time=time, data=json.loads(data)))
+            for time, key, data in rows
+        )
+        self.dirty.clear()
+
+    def get(self, key):
+        with self.lock:
+            if self.measures is None:
+                self.load()
+            return self.measures.get(key)
+
+    def set(self, time, key, data):
+        with self.lock:
+            if self.measures is None:
+                self.load()
+            self.measures[key] = dict(time=time, data=data)
+            self.dirty.add(key)
+
+    def checkpoint(self):
+        if not self.dirty:
+            return
+        rows = [
+            (self.measures[key]['time'], key,
+             json.dumps(self.measures[key]['data'], cls=JSONEncoder))
+            for key in self.dirty
+        ]
+        with storage.connect(self.path, self.dbname) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO last_measures VALUES(?, ?, ?)",
+                rows)
+        self.dirty.clear()
 
 
 def drop_current_for_delta_metrics(metrics):
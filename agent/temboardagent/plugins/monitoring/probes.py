@@ -2,7 +2,8 @@ import logging
 import re
 import os
 import time
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from contextlib import closing
 
 import psycopg2
@@ -10,13 +11,15 @@ from psycopg2.extensions import parse_dsn
 from psycopg2.extras import PhysicalReplicationConnection
 
 from ...inventory import SysInfo
-from ...plugins.maintenance.functions import INDEX_BTREE_BLOAT_SQL
+from ...plugins.maintenance.functions import estimate_bloat
 from ...toolkit.utils import utcnow
 
 from . import db
 
 
 logger = logging.getLogger(__package__)
+# Slow probes run at least this many times their last run time apart.
+BACKOFF_RATIO = 2
 
 
 def load_probes(options, home):
@@ -33,23 +36,34 @@ def load_probes(options, home):
            and (m.group(1) in options['probes'] or '*' in options['probes']):
             o = eval(c + "(options)")
             o.set_home(home)
+            o.interval = options['probe_intervals'].get(
+                o.get_name(), o.interval)
             probes.append(o)
             logger.debug("Loaded probe: %s.", o.get_name())
 
     return probes
 
 
-def run_probes(probes, pool, instances, delta=True):
-    """Execute the probes."""
+def run_probes(probes, pool, instances, delta=True, workers=4):
+    """Execute the probes.
+
+    Host probes run each in its own thread, concurrently with SQL probes. SQL
+    probes are grouped by database and run sequentially on the pooled
+    connection of the database, at most `workers` databases at a time. Each
+    probe run is bounded by its timeout.
+    """
 
     now = utcnow()
     logger.info("Running probes at %s.", now.isoformat())
     # Output is a mapping of probe names with lists. Each probe returns
     # a list of dicts(metric -> value).
     output = {}
+    host_probes = []
+    # Mapping of dbname with probes to run on this database.
+    jobs = OrderedDict()
 
     for p in probes:
-        out = []
+        p.duration = None
         if delta is False:
             p.delta_key = None
             p.delta_columns = None
@@ -57,12 +71,7 @@ def run_probes(probes, pool, instances, delta=True):
         if p.level == 'host':
             if not p.check():
                 continue
-            logger.info("Running host probe %s.", p.get_name())
-            try:
-                out = p.run()
-            except Exception as e:
-                logger.error("Probe failure: %s", e)
-                continue
+            host_probes.append(p)
 
         else:
             if p.level not in ('instance', 'database'):
@@ -78,29 +87,94 @@ def run_probes(probes, pool, instances, delta=True):
                     p.get_name())
                 continue
 
-            logger.info("Running %s probe %s.", p.level, p.get_name())
             if p.level == 'instance':
                 dbnames = [i['database']]
             else:
                 dbnames = [db['dbname'] for db in i['dbnames']]
 
             for dbname in dbnames:
-                conninfo = dict(i, dbname=dbname)
-                try:
-                    out += p.run(pool.getconn(dbname=dbname), conninfo)
-                except Exception as e:
-                    logger.error("Probe failure: %s", e)
-                    raise
-                    continue
+                jobs.setdefault(dbname, []).append(p)
+
+        # Reserve output position of probe.
+        output[p.get_name()] = []
+
+    host_executor = ThreadPoolExecutor(max_workers=len(host_probes) or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        submitted = time.time()
+        host_futures = [
+            (p, host_executor.submit(run_host_probe, p)) for p in host_probes]
+        sql_futures = [
+            executor.submit(run_sql_probes, dbprobes, pool, dict(i, dbname=d))
+            for d, dbprobes in jobs.items()]
+
+        for p, future in host_futures:
+            # Host probes run concurrently, budget starts at submit time.
+            remaining = max(0, submitted + p.timeout - time.time())
+            try:
+                output[p.get_name()], p.duration = future.result(
+                    timeout=remaining)
+            except TimeoutError:
+                logger.error(
+                    "Probe %s timed out after %ss.", p, p.timeout)
+                p.duration = p.timeout
+                del output[p.get_name()]
+            except Exception as e:
+                logger.error("Probe failure: %s", e)
+                del output[p.get_name()]
+        # Don't wait for timed out host probes.
+        host_executor.shutdown(wait=False)
 
+        # Concatenate database outputs in order of databases.
+        for future in sql_futures:
+            for p, out, duration in future.result():
+                output[p.get_name()].extend(out)
+                p.duration = (p.duration or 0) + duration
+
+    for out in output.values():
         for record in out:
             record['datetime'] = now
-        output[p.get_name()] = out
 
     logger.info("Finished probes run.")
     return output
 
 
+def run_host_probe(probe):
+    logger.info("Running host probe %s.", probe.get_name())
+    start = time.time()
+    out = probe.run()
+    return out, time.time() - start
+
+
+def run_sql_probes(probes, pool, conninfo):
+    # Run probes sequentially on a single database. The pooled connection of
+    # the database is used by this thread only.
+    results = []
+    conn = pool.getconn(dbname=conninfo['dbname'])
+    timeout = None
+    for p in probes:
+        logger.info(
+            "Running %s probe %s on %s.", p.level, p.get_name(),
+            conninfo['dbname'])
+        start = time.time()
+        try:
+            if timeout != p.timeout:
+                # Force SET on next probe if this one fails.
+                timeout = None
+                conn.execute("SET statement_timeout = '%ss';", (p.timeout,))
+                timeout = p.timeout
+            out = p.run(conn, conninfo)
+        except Exception as e:
+            # Fail this probe only, like SqlProbe.run_sql().
+            logger.error(
+                "Unable to run probe \"%s\" on \"%s\" on database \"%s\": %s",
+                p.get_name(), conninfo['instance'], conninfo['dbname'], e,
+                exc_info=True,
+            )
+            out = []
+        results.append((p, out, time.time() - start))
+    return results
+
+
 def parse_primary_conninfo(pci):
     # Parse primary_conninfo string picked up from recovery.conf file
     m = re.match(r'.*primary_conninfo\s*=\s*\'(.*)\'[^\']*$', pci)
@@ -190,10 +264,15 @@ class Probe:
     level = None
     # Optionnal name of the probe
     name = None
-    # Previous measures used for compute delta
-    last_measure = {}
-    last_measure_time = {}
+    # Store of previous measures used for compute delta
+    last_measures = None
     home = None
+    # Time budget of a run, in seconds.
+    timeout = 10
+    # Minimum time between two runs, in seconds. None means every collect.
+    interval = None
+    # Run time of last run, in seconds.
+    duration = None
 
     def __init__(self, options):
         pass
@@ -208,6 +287,7 @@ class Probe:
 
     def set_home(self, home):
         self.home = home
+        self.last_measures = db.get_last_measures(home, 'monitoring.db')
 
     def get_name(self):
         """Computes the name of the probe."""
@@ -223,23 +303,29 @@ class Probe:
         logger.error("Could not get the name of the probe")
         return None
 
+    def is_due(self, last_run, now, tolerance=0):
+        """Tells whether the probe should run now.
+
+        last_run is a tuple of time and run time of previous run, or None.
+        tolerance avoids to delay a probe to next collect because of
+        scheduling jitter.
+        """
+        if last_run is None:
+            return True
+        last_time, last_duration = last_run
+        interval = self.interval or 0
+        if BACKOFF_RATIO * last_duration > interval:
+            interval = BACKOFF_RATIO * last_duration
+            logger.debug(
+                "Backing off probe %s to %.1fs.", self.get_name(), interval)
+        return now - last_time + tolerance >= interval
+
     def get_last_measure(self, key):
-        row = db.get_last_measure(
-            self.home,
-            'monitoring.db',
-            key
-        )
-        if row:
-            return dict(time=row[0], data=json.loads(row[1]))
+        return self.last_measures.get(key)
 
     def upsert_last_measure(self, time, key, data):
-        db.upsert_last_measure(
-            self.home,
-            'monitoring.db',
-            time,
-            key,
-            data
-        )
+        # Kept in memory until collector checkpoints the store.
+        self.last_measures.set(time, key, data)
 
     def delta(self, key, current_values):
         """
@@ -329,7 +415,6 @@ class SqlProbe(Probe):
     # compute delta on multiline output.
     delta_columns = None
     delta_key = None
-    timeout = False
 
     def check(self, version=None):
         """Check if the plugin can run on the target version of PostgreSQL."""
@@ -355,10 +440,6 @@ class SqlProbe(Probe):
 
         output = []
         try:
-            if self.timeout:
-                conn.execute(
-                    "SET statement_timeout = '%ss';", (self.timeout,))
-
             cluster_name = conninfo['instance'].replace('/', '')
             sql = "-- probe %s\n%s" % (self, sql)
             for r in conn.query(sql):
@@ -521,6 +602,7 @@ class probe_bgwriter(SqlProbe):
 
 class probe_db_size(SqlProbe):
     level = 'instance'
+    interval = 5 * 60
     sql = """select
   datname as dbname,
   pg_database_size(oid) as size
@@ -530,6 +612,7 @@ where datallowconn"""
 
 class probe_tblspc_size(SqlProbe):
     level = 'instance'
+    interval = 5 * 60
     sql = """select
   spcname,
   pg_tablespace_size(oid) as size
@@ -538,6 +621,7 @@ from pg_tablespace"""
 
 class probe_filesystems_size(HostProbe):
     system = 'Linux'
+    interval = 5 * 60
 
     def run(self):
         return SysInfo().file_systems()
@@ -821,82 +905,54 @@ class probe_replication_connection(SqlProbe):
             return []
 
 
-class probe_heap_bloat(SqlProbe):
+class BloatProbe(SqlProbe):
+    # Base class for bloat probes, reading cached estimations. See
+    # estimate_bloat().
+    timeout = 30
+    interval = 30 * 60
+    level = 'database'
+
+    def run(self, conn, conninfo):
+        try:
+            return self.run_bloat(conn, conninfo, estimate_bloat(
+                conn, self.home))
+        except Exception as e:
+            logger.error(
+                "Unable to run probe \"%s\" on \"%s\" on database \"%s\": %s",
+                self.get_name(), conninfo['instance'], conninfo['dbname'], e,
+                exc_info=True,
+            )
+            return []
+
+
+class probe_heap_bloat(BloatProbe):
     # Heap bloat estimation probe
     # Query coming from https://github.com/ioguix/pgsql-bloat-estimation/
-    level = 'database'
-    sql = """
-SELECT current_database() AS dbname,
-  SUM(bloat_size)::FLOAT/SUM(bs*tblpages)::FLOAT*100 AS ratio
-FROM (
-  SELECT
-  CASE WHEN tblpages - est_tblpages_ff > 0 THEN (tblpages-est_tblpages_ff)*bs ELSE 0 END AS bloat_size,
-  bs, tblpages
-  FROM (
-    SELECT
-      ceil( reltuples / ( (bs-page_hdr)*fillfactor/(tpl_size*100) ) ) + ceil( toasttuples / 4 ) AS est_tblpages_ff,
-      tblpages, bs
-    FROM (
-      SELECT
-        ( 4 + tpl_hdr_size + tpl_data_size + (2*ma)
-          - CASE WHEN tpl_hdr_size%ma = 0 THEN ma ELSE tpl_hdr_size%ma END
-          - CASE WHEN ceil(tpl_data_size)::int%ma = 0 THEN ma ELSE ceil(tpl_data_size)::int%ma END
-        ) AS tpl_size, bs - page_hdr AS size_per_block, (heappages + toastpages) AS tblpages, heappages,
-        toastpages, reltuples, toasttuples, bs, page_hdr, tblid, schemaname, tblname, fillfactor
-      FROM (
-        SELECT
-          tbl.oid AS tblid, ns.nspname AS schemaname, tbl.relname AS tblname,
-          tbl.reltuples, tbl.relpages AS heappages, coalesce(toast.relpages, 0) AS toastpages,
-          coalesce(toast.reltuples, 0) AS toasttuples,
-          coalesce(substring(
-            array_to_string(tbl.reloptions, ' ')
-            FROM 'fillfactor=([0-9]+)')::smallint, 100) AS fillfactor,
-          current_setting('block_size')::numeric AS bs,
-          CASE WHEN version()~'mingw32' OR version()~'64-bit|x86_64|ppc64|ia64|amd64' THEN 8 ELSE 4 END AS ma,
-          24 AS page_hdr,
-          23 + CASE WHEN MAX(coalesce(s.null_frac,0)) > 0 THEN ( 7 + count(s.attname) ) / 8 ELSE 0::int END
-           + CASE WHEN bool_or(att.attname = 'oid' and att.attnum < 0) THEN 4 ELSE 0 END AS tpl_hdr_size,
-          sum( (1-coalesce(s.null_frac, 0)) * coalesce(s.avg_width, 0) ) AS tpl_data_size
-        FROM pg_attribute AS att
-          JOIN pg_class AS tbl ON att.attrelid = tbl.oid
-          JOIN pg_namespace AS ns ON ns.oid = tbl.relnamespace
-          LEFT JOIN pg_stats AS s ON s.schemaname=ns.nspname
-            AND s.tablename = tbl.relname AND s.inherited=false AND s.attname=att.attname
-          LEFT JOIN pg_class AS toast ON tbl.reltoastrelid = toast.oid
-        WHERE NOT att.attisdropped
-          AND tbl.relkind = 'r'
-        GROUP BY 1,2,3,4,5,6,7,8,9,10
-        ORDER BY 2,3
-      ) AS s
-    ) AS s2
-  ) AS s3
-) AS s4;
-    """  # noqa
-
-
-class probe_btree_bloat(SqlProbe):
+
+    def run_bloat(self, conn, conninfo, bloat):
+        size = sum(t['real_size'] for t in bloat['tables'])
+        bloat_size = sum(t['bloat_size'] for t in bloat['tables'])
+        return [dict(
+            dbname=conninfo['dbname'],
+            ratio=float(bloat_size) / size * 100 if size else None,
+        )]
+
+
+class probe_btree_bloat(BloatProbe):
     # Btree index bloat estimation probe
-    timeout = 30
-    level = 'database'
-    sql = """
-SELECT
-  current_database() AS dbname,
-  SUM(bloat_size) / SUM(indexes_size) * 100 AS ratio
-FROM (
-  SELECT
-    SUM(pg_relation_size(quote_ident(schemaname) || '.' || quote_ident(indexname)))::BIGINT AS indexes_size
-  FROM pg_catalog.pg_indexes
-  GROUP BY schemaname
-) AS indexes,
-(
-  SELECT
-    SUM(bloat_size) AS bloat_size,
-    schemaname
-  FROM (
-    %s
-  ) AS a
-  GROUP BY schemaname
-) AS ibloat
-WHERE schemaname !~ '^pg_temp'
-AND schemaname !~ '^pg_toast';
-"""  % (INDEX_BTREE_BLOAT_SQL) # noqa
+
+    def run_bloat(self, conn, conninfo, bloat):
+        # Ratio of btree bloat over size of all indexes.
+        size = conn.queryscalar("""\
+        SELECT SUM(pg_relation_size(
+          quote_ident(schemaname) || '.' || quote_ident(indexname)))::BIGINT
+        FROM pg_catalog.pg_indexes
+        WHERE schemaname !~ '^pg_temp' AND schemaname !~ '^pg_toast'
+        """)
+        bloat_size = sum(
+            i['bloat_size'] for i in bloat['indexes']
+            if not re.match(r'pg_(temp|toast)', i['schemaname']))
+        return [dict(
+            dbname=conninfo['dbname'],
+            ratio=float(bloat_size) / size * 100 if size else None,
+        )]
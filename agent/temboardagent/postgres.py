@@ -211,7 +211,7 @@ class ConnectionPool(ThreadedConnectionPool):
 class DBConnectionPool:
     # Pool one connection per database.
     #
-    # Not thread-safe.
+    # Not thread-safe, except for threads using distinct databases.
 
     def __init__(self, postgres):
         self.postgres = postgres
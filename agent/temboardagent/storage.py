@@ -0,0 +1,43 @@
+"""Local SQLite storage shared by agent components.
+
+monitoring.db, dashboard.db and core.db are accessed through a single
+connection per process, thread and database file. SQLite caches prepared
+statements per connection, reusing the connection saves both opening the file
+and preparing statements at each call.
+
+Databases are in WAL journal mode: readers like /monitoring/history never
+block a collector writing to the same database, and conversely.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+# Connections by pid, thread and database file. Connections inherited from
+# parent process are kept referenced but never used, closing them in a forked
+# child could corrupt parent's state. sqlite3 forbids sharing a connection
+# between threads.
+_connections = {}
+
+
+def connect(path, dbname):
+    """Returns the connection of this thread to SQLite database dbname.
+
+    Use connection as a context manager to commit writes.
+    """
+    filename = os.path.join(path, dbname)
+    key = os.getpid(), threading.current_thread().ident, filename
+    conn = _connections.get(key)
+    if conn is None:
+        logger.debug("Opening SQLite database %s.", filename)
+        conn = sqlite3.connect(filename, cached_statements=256)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode, NORMAL synchronous is safe from corruption and syncs
+        # only on checkpoint instead of each commit.
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        _connections[key] = conn
+    return conn
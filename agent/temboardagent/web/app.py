@@ -10,7 +10,7 @@ from bottle import (
     default_app, request, response,
 )
 
-from ..toolkit.http import format_date
+from ..toolkit.http import compressobj, format_date, negotiate_encoding
 from ..toolkit.signing import InvalidSignature, canonicalize_request, verify_v1
 from ..toolkit.utils import JSONEncoder, utcnow
 
@@ -31,6 +31,7 @@ def create_app(temboard):
     app.temboard = temboard
     app.add_hook('before_request', before_request_log)
     # First declared, first executed.
+    app.install(CompressionPlugin())
     app.install(JSONPlugin())
     app.install(SignaturePlugin())
     app.install(PostgresPlugin())
@@ -155,6 +156,57 @@ class JSONPlugin(object):
         return wrapper
 
 
+class CompressionPlugin(object):
+    # Compress response body according to Accept-Encoding request header.
+    # Must wrap JSONPlugin to compress serialized body.
+    name = 'compression'
+    # Compressing small bodies is not worth it.
+    min_size = 1024
+
+    def apply(self, callback, route):
+        @functools.wraps(callback)
+        def wrapper(*a, **kw):
+            res = callback(*a, **kw)
+            coding = negotiate_encoding(
+                request.headers.get('Accept-Encoding'))
+            if not coding:
+                return res
+
+            is_response = isinstance(res, HTTPResponse)
+            body = res.body if is_response else res
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+
+            if isinstance(body, bytes):
+                if len(body) < self.min_size:
+                    return res
+                compressor = compressobj(coding)
+                body = compressor.compress(body) + compressor.flush()
+            elif inspect.isgenerator(body):
+                body = compress_chunks(body, compressobj(coding))
+            else:
+                return res
+
+            headers = res if is_response else response
+            headers.set_header('Content-Encoding', coding)
+            headers.add_header('Vary', 'Accept-Encoding')
+            if is_response:
+                res.body = body
+                return res
+            return body
+        return wrapper
+
+
+def compress_chunks(chunks, compressor):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
 class SignaturePlugin(object):
     name = 'signature'
 
@@ -1,6 +1,8 @@
 import logging
+import select
 import ssl
 from socket import error as SocketError
+from time import time
 from wsgiref.simple_server import (
     make_server,
     ServerHandler,
@@ -64,12 +66,102 @@ class HTTPDService(Service):
         except Exception as e:
             raise UserError("Failed to setup SSL: {}.".format(e))
         self.server.timeout = 1
+        # Let request handler give up idle connection to service loop.
+        self.server.service = self
 
     def serve1(self):
         self.server.handle_request()
 
 
+class KeepAliveServerHandler(ServerHandler):
+    # Answer with HTTP/1.1 and keep connection open when the response body
+    # has a known length.
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        # A streamed body is delimited by connection close. A request body
+        # may be left unread by the application, desynchronizing the
+        # connection.
+        if ('Content-Length' not in self.headers or
+                int(self.environ.get('CONTENT_LENGTH') or 0)):
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def handle_error(self):
+        # A response interrupted by an error can't be followed by another
+        # one.
+        self.request_handler.close_connection = True
+        ServerHandler.handle_error(self)
+
+
 class CustomWSGIRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Seconds to wait for the next request on an idle keep-alive connection.
+    # UI polls agent every minute and evicts idle connections before agent
+    # closes them.
+    keepalive_timeout = 120
+
+    def handle(self):
+        # Serve requests on the same connection until client or response
+        # asks to close it, or another client connects.
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_next_request():
+            self.handle_one_request()
+
+    def wait_next_request(self):
+        # Server is single-threaded. An idle connection must not hold other
+        # clients nor service loop: give up as soon as another client is
+        # waiting or service has a signal to handle.
+        if getattr(self.connection, 'pending', lambda: 0)():
+            return True
+        deadline = time() + self.keepalive_timeout
+        while not self.service_interrupted():
+            timeout = min(self.server.timeout or 1, deadline - time())
+            if timeout <= 0:
+                return False
+            ready, _, _ = select.select(
+                [self.connection, self.server.socket], [], [], timeout)
+            if ready:
+                return (
+                    self.connection in ready and
+                    self.server.socket not in ready)
+        return False
+
+    def service_interrupted(self):
+        service = getattr(self.server, 'service', None)
+        if service is None:
+            return False
+        return (
+            service.sighup or service.sigchld or
+            not service.check_parent_running())
+
+    def handle_one_request(self):
+        # Same as WSGIRequestHandler.handle(), with keep-alive server handler.
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            # Client closed connection.
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=False,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
     def get_environ(self):
         env = super(CustomWSGIRequestHandler, self).get_environ()
 
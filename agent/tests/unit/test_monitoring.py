@@ -1,5 +1,7 @@
 from copy import deepcopy
+from decimal import Decimal
 import json
+import time
 
 
 # As returned by db.get_metrics(). Copy-pasted payload from dev env.
@@ -398,3 +400,288 @@ def test_open_metrics_from_data():
     assert 'node_procs_blocked 0\n' in text
     assert 'node_procs_running 6\n' in text
     assert 'xnode_procs_total 2500\n' in text
+
+
+def test_history_cursor(tmp_path):
+    from temboardagent.plugins.monitoring import (
+        db, format_cursor, generate_ndjson_history, parse_cursor,
+    )
+
+    home = str(tmp_path)
+    db.bootstrap(home, 'monitoring.db')
+    now = time.time()
+    for i in range(3):
+        db.add_metric(home, 'monitoring.db', now + i, dict(i=i, data={}))
+
+    lines = list(generate_ndjson_history(
+        db.iter_metrics(home, 'monitoring.db', limit=None, after=0)))
+    assert 3 == len(lines)
+    first = json.loads(lines[0])
+    assert 0 == first['i']
+
+    after = parse_cursor(first['cursor'])
+    assert now == after
+    rows = list(db.iter_metrics(home, 'monitoring.db', None, after=after))
+    assert [now + 1, now + 2] == [t for t, _ in rows]
+    assert format_cursor(after) == first['cursor']
+
+
+def test_delta_last_measures(tmp_path):
+    import sqlite3
+    from temboardagent.plugins.monitoring import db
+    from temboardagent.plugins.monitoring.probes import probe_xacts
+
+    home = str(tmp_path)
+    db.bootstrap(home, 'monitoring.db')
+    probe = probe_xacts(dict())
+    probe.set_home(home)
+
+    delta = probe.delta('postgres', dict(n_commit=10))
+    assert 'measure_interval' not in delta
+    delta = probe.delta('postgres', dict(n_commit=15))
+    assert 5 == delta['n_commit']
+
+    filename = str(tmp_path / 'monitoring.db')
+    query = "SELECT count(*) FROM last_measures"
+    with sqlite3.connect(filename) as conn:
+        # Measures are kept in memory until checkpoint.
+        assert (0,) == conn.execute(query).fetchone()
+    db.get_last_measures(home, 'monitoring.db').checkpoint()
+    with sqlite3.connect(filename) as conn:
+        assert (1,) == conn.execute(query).fetchone()
+
+    store = db.LastMeasures(home, 'monitoring.db')
+    assert 15 == store.get('xactspostgres')['data']['n_commit']
+
+
+def test_purge_metrics(tmp_path):
+    from temboardagent import storage
+    from temboardagent.plugins.monitoring import db
+
+    home = str(tmp_path)
+    db.bootstrap(home, 'monitoring.db')
+    conn = storage.connect(home, 'monitoring.db')
+    assert conn is storage.connect(home, 'monitoring.db')
+    assert ('wal',) == conn.execute("PRAGMA journal_mode").fetchone()
+
+    now = time.time()
+    db.add_metric(home, 'monitoring.db', now - 7 * 3600, dict(i=0))
+    db.add_metric(home, 'monitoring.db', now, dict(i=1))
+    # Insert does not purge.
+    assert 2 == len(db.get_metrics(home, 'monitoring.db', None, 1))
+
+    assert 1 == db.purge_metrics(home, 'monitoring.db')
+    rows = db.get_metrics(home, 'monitoring.db', None, 1)
+    assert [now] == [t for t, _ in rows]
+
+
+def test_run_probes():
+    from temboardagent.plugins.monitoring.probes import (
+        HostProbe, SqlProbe, run_probes,
+    )
+
+    class FakeConn(object):
+        def __init__(self, dbname):
+            self.dbname = dbname
+            self.timeouts = []
+
+        def execute(self, sql, args):
+            self.timeouts.append(args[0])
+
+    class FakePool(object):
+        def __init__(self):
+            self.conns = {}
+
+        def getconn(self, dbname):
+            return self.conns.setdefault(dbname, FakeConn(dbname))
+
+    class probe_host(HostProbe):
+        def run(self):
+            return [dict(value=1)]
+
+    class probe_slow(HostProbe):
+        timeout = .1
+
+        def run(self):
+            time.sleep(1)
+            return [dict(value=0)]
+
+    class probe_db(SqlProbe):
+        level = 'database'
+
+        def run(self, conn, conninfo):
+            return [dict(dbname=conn.dbname)]
+
+    class probe_bloat(probe_db):
+        timeout = 30
+
+    instance = dict(
+        available=True, version_num=150000, database='postgres',
+        dbnames=[dict(dbname='postgres'), dict(dbname='app')],
+    )
+    pool = FakePool()
+    probes = [
+        p(dict()) for p in (probe_host, probe_slow, probe_db, probe_bloat)]
+    output = run_probes(probes, pool, [instance], workers=2)
+
+    assert ['bloat', 'db', 'host'] == sorted(output)
+    assert [1] == [r['value'] for r in output['host']]
+    assert ['postgres', 'app'] == [r['dbname'] for r in output['db']]
+    assert output['db'][0]['datetime'] == output['host'][0]['datetime']
+    # statement_timeout is set once per probe budget change.
+    assert [10, 30] == pool.conns['app'].timeouts
+
+
+def test_probe_is_due():
+    from temboardagent.plugins.monitoring.probes import (
+        probe_db_size, probe_xacts,
+    )
+
+    size = probe_db_size(dict())
+    assert 300 == size.interval
+    assert size.is_due(None, 1000.)
+    assert not size.is_due((1000., 1.), 1240.)
+    # Tolerate scheduling jitter.
+    assert size.is_due((1000., 1.), 1299., tolerance=30)
+
+    xacts = probe_xacts(dict())
+    assert xacts.is_due((1000., .1), 1060.)
+    # Slow probe backs off to twice its run time.
+    assert not xacts.is_due((1000., 40.), 1060.)
+    assert xacts.is_due((1000., 40.), 1080.)
+
+
+def test_bloat_cache(tmp_path):
+    from temboardagent.plugins.maintenance import functions
+    from temboardagent.plugins.monitoring.probes import probe_heap_bloat
+
+    class FakeConn(object):
+        def __init__(self):
+            self.signatures = [
+                dict(oid=1, relkind='r', signature='a'),
+                dict(oid=2, relkind='r', signature='b'),
+            ]
+            self.estimated = []
+
+        def queryscalar(self, sql):
+            return 'app'
+
+        def query(self, sql, *args):
+            if sql == functions.BLOAT_SIGNATURES_SQL:
+                return iter(self.signatures)
+            assert sql == functions.TABLE_BLOAT_BY_OID_SQL
+            oids, = args[0]
+            self.estimated.extend(oids)
+            return iter([
+                dict(tblid=oid, schemaname='public', tblname='t%s' % oid,
+                     real_size=Decimal(1000), bloat_size=Decimal(100 * oid))
+                for oid in oids])
+
+    conn = FakeConn()
+    probe = probe_heap_bloat(dict())
+    probe.set_home(str(tmp_path))
+    conninfo = dict(instance='test', dbname='app')
+    out, = probe.run(conn, conninfo)
+    assert 15 == out['ratio']
+    assert [1, 2] == sorted(conn.estimated)
+
+    # Only changed relations are estimated again.
+    conn.estimated[:] = []
+    conn.signatures[1]['signature'] = 'c'
+    out, = probe.run(conn, conninfo)
+    assert 15 == out['ratio']
+    assert [2] == conn.estimated
+
+    # Dropped relations are forgotten.
+    conn.estimated[:] = []
+    del conn.signatures[1]
+    bloat = functions.estimate_bloat(conn, str(tmp_path))
+    assert ['t1'] == [t['tblname'] for t in bloat['tables']]
+    assert [] == conn.estimated
+
+
+def test_delta_across_forked_collects(tmp_path):
+    import multiprocessing
+    from temboardagent.plugins.monitoring import db
+
+    home = str(tmp_path)
+    # Like serve, bootstrap in main process, then collect in forked tasks.
+    db.bootstrap(home, 'monitoring.db')
+    db.get_last_measures(home, 'monitoring.db')
+
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    for n_commit in 10, 15:
+        process = ctx.Process(
+            target=collect_xacts, args=(home, n_commit, queue))
+        process.start()
+        first = queue.get(timeout=10)
+        process.join()
+        assert 0 == process.exitcode
+        if n_commit == 10:
+            assert 'measure_interval' not in first
+
+    assert 'measure_interval' in first
+    assert 5 == first['n_commit']
+
+
+def collect_xacts(home, n_commit, queue):
+    from temboardagent.plugins.monitoring import db
+    from temboardagent.plugins.monitoring.probes import probe_xacts
+
+    probe = probe_xacts(dict())
+    probe.set_home(home)
+    queue.put(probe.delta('postgres', dict(n_commit=n_commit)))
+    db.get_last_measures(home, 'monitoring.db').checkpoint()
+
+
+def test_run_probes_failures():
+    from temboardagent.plugins.monitoring.probes import (
+        HostProbe, SqlProbe, run_probes,
+    )
+
+    class BrokenConn(object):
+        dbname = 'postgres'
+
+        def execute(self, sql, args):
+            if args[0] == 30:
+                raise Exception("Connection lost.")
+
+    class FakePool(object):
+        def getconn(self, dbname):
+            return BrokenConn()
+
+    class probe_slow1(HostProbe):
+        timeout = .5
+
+        def run(self):
+            time.sleep(2)
+            return []
+
+    class probe_slow2(probe_slow1):
+        pass
+
+    class probe_bloat(SqlProbe):
+        level = 'instance'
+        timeout = 30
+
+        def run(self, conn, conninfo):
+            return [dict(dbname=conn.dbname)]
+
+    class probe_db(probe_bloat):
+        timeout = 10
+
+    instance = dict(
+        available=True, version_num=150000, database='postgres',
+        instance='test', dbnames=[dict(dbname='postgres')],
+    )
+    probes = [
+        p(dict()) for p in (probe_slow1, probe_slow2, probe_bloat, probe_db)]
+    start = time.time()
+    output = run_probes(probes, FakePool(), [instance])
+    # Host probes budgets overlap, waiting them in turn would take 1s.
+    assert time.time() - start < .9
+    # Failing SET fails only its probe.
+    assert [] == output['bloat']
+    assert ['postgres'] == [r['dbname'] for r in output['db']]
+    assert 'slow1' not in output
@@ -0,0 +1,142 @@
+import gzip
+from wsgiref.util import setup_testing_defaults
+
+
+def call(app, path, **environ):
+    setup_testing_defaults(environ)
+    environ['PATH_INFO'] = path
+    out = dict()
+
+    def start_response(status, headers):
+        out['status'] = status
+        out['headers'] = dict(headers)
+
+    out['body'] = b''.join(app(environ, start_response))
+    return out
+
+
+def test_compression():
+    from bottle import Bottle
+    from temboardagent.web.app import CompressionPlugin, JSONPlugin
+
+    app = Bottle(autojson=False)
+    app.install(CompressionPlugin())
+    app.install(JSONPlugin())
+
+    @app.get('/json')
+    def get_json():
+        return dict(data=['x' * 2048])
+
+    @app.get('/stream')
+    def get_stream():
+        for i in range(3):
+            yield '{"i": %s}\n' % i
+
+    res = call(app, '/json')
+    assert 'Content-Encoding' not in res['headers']
+
+    res = call(app, '/json', HTTP_ACCEPT_ENCODING='gzip')
+    assert 'gzip' == res['headers']['Content-Encoding']
+    assert gzip.decompress(res['body']).startswith(b'{"data": ["xxx')
+
+    res = call(app, '/stream', HTTP_ACCEPT_ENCODING='gzip')
+    assert 'gzip' == res['headers']['Content-Encoding']
+    assert b'{"i": 2}\n' in gzip.decompress(res['body'])
+
+
+def test_keepalive():
+    import http.client
+    import threading
+    from wsgiref.simple_server import make_server
+    from bottle import Bottle
+    from temboardagent.web.service import CustomWSGIRequestHandler
+
+    app = Bottle()
+
+    @app.get('/json')
+    def get_json():
+        return dict(ok=True)
+
+    @app.get('/stream')
+    def get_stream():
+        yield '{"i": 0}\n'
+
+    server = make_server(
+        '127.0.0.1', 0, app, handler_class=CustomWSGIRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/json')
+        res = conn.getresponse()
+        assert b'{"ok": true}' == res.read()
+        assert not res.will_close
+        sock = conn.sock
+        conn.request('GET', '/json')
+        assert b'{"ok": true}' == conn.getresponse().read()
+        # Connection has been reused.
+        assert sock is conn.sock
+
+        # Another client is not blocked by idle connection.
+        other = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+        other.request('GET', '/json')
+        assert 200 == other.getresponse().status
+        other.close()
+
+        # Streamed body is delimited by connection close.
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/stream')
+        res = conn.getresponse()
+        assert res.will_close
+        assert b'{"i": 0}\n' == res.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_keepalive_interrupted():
+    import http.client
+    import threading
+    import time
+    from wsgiref.simple_server import make_server
+    from bottle import Bottle
+    from temboardagent.web.service import CustomWSGIRequestHandler
+
+    app = Bottle()
+
+    @app.get('/json')
+    def get_json():
+        return dict(ok=True)
+
+    class Service(object):
+        sighup = False
+        sigchld = False
+
+        def check_parent_running(self):
+            return True
+
+    server = make_server(
+        '127.0.0.1', 0, app, handler_class=CustomWSGIRequestHandler)
+    server.timeout = .1
+    server.service = Service()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/json')
+        assert b'{"ok": true}' == conn.getresponse().read()
+
+        # Idle connection is given up to let service handle signal.
+        server.service.sighup = True
+        start = time.time()
+        assert b'' == conn.sock.recv(1)
+        assert time.time() - start < 2
+    finally:
+        server.shutdown()
+        server.server_close()
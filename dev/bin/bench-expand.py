@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Compare raw monitoring chart queries: former expand_data_by_instance_id()
+# plpgsql function versus static query filtering _history rows on index.
+#
+# Connects to temBoard repository using libpq environment variables. Generates
+# metric_xacts_history rows with negative instance_id in a transaction rolled
+# back afterward. Exits with an error if static query scans all _history rows
+# or is slower than former function.
+#
+#     $ PGHOST=0.0.0.0 PGUSER=temboard PGPASSWORD=temboard \
+#       dev/bin/bench-expand.py --instances 500 --days 90
+#
+
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import create_engine
+
+from temboardui.plugins.monitoring.chartdata import (
+    METRICS, format_metric_query)
+
+
+logger = logging.getLogger('bench-expand')
+METRIC = 'tps'
+OLD_EXPAND = """\
+expand_data_by_instance_id(
+  'metric_xacts', tstzrange(%(start)s, %(end)s), %(instance_id)s)
+AS (datetime timestamp with time zone, instance_id integer, dbname text,
+    record metric_xacts_record)"""
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format='%(levelname).1s: %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--instances', type=int, default=500,
+        help="Number of instances. Default: %(default)s.")
+    parser.add_argument(
+        '--days', type=int, default=90,
+        help="Days of history per instance. Default: %(default)s.")
+    parser.add_argument(
+        '--databases', type=int, default=1,
+        help="Number of databases per instance. Default: %(default)s.")
+    args = parser.parse_args()
+
+    engine = create_engine('postgresql://')
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SET search_path TO monitoring")
+        now = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        generate(cur, now, args.instances, args.days, args.databases)
+
+        # Chart a day in the middle of history of an instance.
+        end = now - timedelta(days=args.days // 2)
+        start = end - timedelta(days=1)
+        old = explain(cur, old_query(cur, start, end))
+        new = explain(cur, format_metric_query(
+            cur, METRICS[METRIC], start, end, None, -1, None, None))
+    finally:
+        conn.rollback()
+        conn.close()
+
+    for name, plan in (('function', old), ('static', new)):
+        logger.info(
+            "%-8s: %8.3fms, %d rows, %d buffers.",
+            name, plan['Execution Time'], plan['Plan']['Actual Rows'],
+            buffers(plan['Plan']))
+
+    scans = list(seq_scans(new['Plan'], 'metric_xacts_history'))
+    if scans:
+        logger.error("Static query scans %s.", ', '.join(scans))
+        return 1
+    if new['Execution Time'] > old['Execution Time']:
+        logger.error("Static query is slower than function.")
+        return 1
+
+
+def generate(cur, now, instances, days, databases):
+    first = now - timedelta(days=days)
+    cur.execute("SHOW server_version_num")
+    if int(cur.fetchone()[0]) >= 110000:
+        month = first
+        while month <= now:
+            cur.execute(
+                "SELECT create_partition('metric_xacts_history', %s)",
+                (month,))
+            month = (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+    logger.info(
+        "Generating %s days of history for %s instances.", days, instances)
+    # One _history row per instance, database and day, one record per
+    # minute, like archiving does.
+    cur.execute("""\
+    INSERT INTO metric_xacts_history
+    SELECT tstzrange(day, day + '1 day' - '1 minute'::INTERVAL),
+           -i, 'db' || j,
+           ARRAY(
+             SELECT ROW(
+               day + m * '1 minute'::INTERVAL, '1 minute'::INTERVAL, m, 0
+             )::metric_xacts_record
+             FROM generate_series(0, 1439) AS m
+           )
+    FROM generate_series(1, %(instances)s) AS i,
+         generate_series(1, %(databases)s) AS j,
+         generate_series(%(first)s, %(last)s, '1 day') AS day
+    """, dict(
+        instances=instances, databases=databases,
+        first=first, last=now - timedelta(days=1)))
+    logger.info("Generated %s _history rows.", cur.rowcount)
+    cur.execute("ANALYZE metric_xacts_history")
+
+
+def old_query(cur, start, end):
+    template = METRICS[METRIC]['sql_nozoom'].replace(
+        '%(expand)s', OLD_EXPAND)
+    return cur.mogrify(
+        template, dict(start=start, end=end, instance_id=-1)).decode('utf-8')
+
+
+def explain(cur, query):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+    plan = cur.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def buffers(node):
+    return node.get('Shared Hit Blocks', 0) + node.get('Shared Read Blocks', 0)
+
+
+def seq_scans(node, table):
+    if 'Seq Scan' == node['Node Type'] and \
+            node['Relation Name'].startswith(table):
+        yield node['Relation Name']
+    for child in node.get('Plans', []):
+        for scan in seq_scans(child, table):
+            yield scan
+
+
+if '__main__' == __name__:
+    sys.exit(main())
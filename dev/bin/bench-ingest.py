@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Compare monitoring metrics ingestion throughput: one INSERT and COMMIT per
+# point versus bulk insert_metrics().
+#
+# Connects to temBoard repository using libpq environment variables. Points
+# are inserted with negative host_id and instance_id and deleted afterward.
+#
+#     $ PGHOST=0.0.0.0 PGUSER=temboard PGPASSWORD=temboard \
+#       dev/bin/bench-ingest.py --agents 20 --databases 50
+#
+
+import argparse
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from temboardui.plugins.monitoring.model import db
+from temboardui.plugins.monitoring.tools import insert_metrics
+
+
+logger = logging.getLogger('bench-ingest')
+HOST_ID = INSTANCE_ID = -1
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format='%(levelname).1s: %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--agents', type=int, default=10,
+        help="Number of payloads to insert. Default: %(default)s.")
+    parser.add_argument(
+        '--databases', type=int, default=20,
+        help="Number of databases per instance. Default: %(default)s.")
+    args = parser.parse_args()
+
+    engine = create_engine('postgresql://')
+    Session = sessionmaker(bind=engine)
+    payloads = [
+        generate_payload(i, args.databases) for i in range(args.agents)]
+    nrows = sum(
+        len(rows)
+        for payload in payloads
+        for rows in db.group_metric_rows(
+            HOST_ID, INSTANCE_ID, payload).values())
+    logger.info(
+        "Inserting %s rows from %s payloads.", nrows, len(payloads))
+
+    session = Session()
+    try:
+        elapsed = bench(session, insert_rowwise, payloads)
+        logger.info(
+            "row-wise: %.3fs, %.0f rows/s.", elapsed, nrows / elapsed)
+        elapsed = bench(session, insert_metrics, payloads)
+        logger.info(
+            "bulk:     %.3fs, %.0f rows/s.", elapsed, nrows / elapsed)
+    finally:
+        cleanup(session)
+        session.close()
+
+
+def bench(session, insert, payloads):
+    start = perf_counter()
+    for payload in payloads:
+        insert(session, HOST_ID, INSTANCE_ID, payload)
+    return perf_counter() - start
+
+
+def insert_rowwise(session, host_id, instance_id, data):
+    # Mimic former ingestion: one INSERT and one COMMIT per point.
+    tables = db.group_metric_rows(host_id, instance_id, data)
+    for table, rows in tables.items():
+        for row in rows:
+            db.insert_metric_rows(session, table, [row])
+            session.commit()
+
+
+def cleanup(session):
+    for spec in db.METRIC_TABLES.values():
+        session.execute(
+            "DELETE FROM monitoring.%s WHERE %s = :id" % (
+                spec['table'], spec['id']),
+            dict(id=HOST_ID if 'host_id' == spec['id'] else INSTANCE_ID))
+    session.commit()
+
+
+def generate_payload(i, ndatabases):
+    # Build a payload shaped like agent /monitoring/history data.
+    dt = datetime.now(timezone.utc) - timedelta(minutes=i)
+    dt = dt.strftime('%Y-%m-%d %H:%M:%S +0000')
+    data = dict()
+    for name, spec in db.METRIC_TABLES.items():
+        keys = [None]
+        if spec['key'] in ('dbname',):
+            keys = ['db%03d' % j for j in range(ndatabases)]
+        elif spec['key']:
+            keys = ['%s0' % spec['key']]
+
+        data[name] = points = []
+        for key in keys:
+            point = dict(datetime=dt)
+            if key:
+                point[spec['key']] = key
+            for field in spec['record']:
+                point[field] = generate_value(field)
+            points.append(point)
+    return data
+
+
+def generate_value(field):
+    if 'measure_interval' == field:
+        return 60.
+    if field in ('device',):
+        return '/dev/sda1'
+    if field in ('current_location',):
+        return '0/1000000'
+    if field in ('stats_reset',):
+        return '2023-01-01 00:00:00+00'
+    return 1
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Compare pivot of chart CSV: former two pass implementation with
+# csv.DictReader versus single pass pivot_timeserie().
+#
+# Pivots db_size like CSV for many databases over many points. Exits with an
+# error if outputs differ or if pivot_timeserie() is slower than former
+# implementation.
+#
+#     $ dev/bin/bench-pivot.py --databases 500 --points 100
+#
+
+import argparse
+import csv
+import logging
+import sys
+import timeit
+from io import StringIO
+
+from temboardui.plugins.monitoring.pivot import pivot_timeserie
+
+
+logger = logging.getLogger('bench-pivot')
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format='%(levelname).1s: %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--databases', type=int, default=500,
+        help="Number of databases. Default: %(default)s.")
+    parser.add_argument(
+        '--points', type=int, default=100,
+        help="Number of points per database. Default: %(default)s.")
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="Keep best time of this number of runs. Default: %(default)s.")
+    args = parser.parse_args()
+
+    in_ = generate(args.databases, args.points)
+
+    def run(pivot):
+        out_ = StringIO()
+        pivot(in_, index='date', key='dbname', value='size', output=out_)
+        return out_.getvalue()
+
+    if run(pivot_reference) != run(pivot_timeserie):
+        logger.error("Pivot output differs from reference.")
+        return 1
+
+    reference = min(timeit.repeat(
+        lambda: run(pivot_reference), number=1, repeat=args.repeat))
+    elapsed = min(timeit.repeat(
+        lambda: run(pivot_timeserie), number=1, repeat=args.repeat))
+    logger.info(
+        "pivot: %.3fs, two pass reference: %.3fs.", elapsed, reference)
+    if elapsed > reference:
+        logger.error("Pivot is slower than reference.")
+        return 1
+
+
+def generate(databases, points):
+    in_ = StringIO()
+    in_.write("date,dbname,size\n")
+    for t in range(points):
+        for d in range(databases):
+            in_.write("2023-01-01 %02d:%02d:00+00,db%03d,%d\n" % (
+                t // 60 % 24, t % 60, d, t * d))
+    return in_
+
+
+def pivot_reference(fd, index, key, value, output):
+    # Former two pass implementation, with csv.DictReader.
+    fd.seek(0)
+    keys = {}
+    for r in csv.DictReader(fd):
+        if r[key] not in keys:
+            keys[r[key]] = len(keys) + 1
+    sk = sorted(keys, key=keys.get)
+    line = [index] + sk
+    p_index = ''
+    fd.seek(0)
+    for r in csv.DictReader(fd):
+        if r[index] != p_index:
+            output.write(','.join(line) + '\n')
+            line = [''] * (len(keys) + 1)
+            line[0] = r[index]
+        line[keys[r[key]]] = r[value]
+        p_index = r[index]
+    output.write(','.join(line) + '\n')
+
+
+if '__main__' == __name__:
+    sys.exit(main())
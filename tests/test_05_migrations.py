@@ -0,0 +1,117 @@
+from pathlib import Path
+
+import pytest
+
+
+VERSIONSDIR = Path('ui/temboardui/model/versions')
+
+
+@pytest.fixture
+def migratedb(psql):
+    """Returns a function applying repository migrations to a scratch db."""
+    dbname = 'temboard-migrations'
+    psql(c=f'DROP DATABASE IF EXISTS "{dbname}";')
+    psql(c=f'CREATE DATABASE "{dbname}";')
+    db = psql.bake('--set=ON_ERROR_STOP=1', '--quiet', d=dbname)
+
+    def migrate(until=None):
+        for path in sorted(VERSIONSDIR.glob('*.sql')):
+            if until and path.name > until:
+                break
+            if path.name <= migrate.version:
+                continue
+            db(_in=path.read_text())
+            migrate.version = path.name
+
+    migrate.db = db
+    migrate.version = ''
+
+    yield migrate
+
+    psql(c=f'DROP DATABASE "{dbname}";')
+
+
+def test_partition_single_record_history(migratedb):
+    migratedb('011_monitoring-aggregate-watermark.sql')
+
+    # A day with a single record archived as an empty range.
+    migratedb.db(_in="""\
+    SET search_path TO monitoring, public;
+    INSERT INTO hosts (hostname, os, os_version)
+    VALUES ('test.lan', 'Linux', '5.10');
+    INSERT INTO metric_loadavg_history
+    SELECT tstzrange(min(datetime), max(datetime)), 1,
+           array_agg(ROW(datetime, 0.1, 0.2, 0.3)::metric_loadavg_record)
+    FROM (VALUES ('2021-06-01 00:05:00+00'::TIMESTAMPTZ)) AS r(datetime);
+    """)
+
+    migratedb('012_monitoring-partitions.sql')
+
+    out = migratedb.db(
+        '--tuples-only', '--no-align',
+        c=(
+            "SELECT isempty(history_range), "
+            "lower(history_range) = upper(history_range) "
+            "FROM monitoring.metric_loadavg_history;"
+        ),
+    )
+    assert 'f|t' == str(out).strip()
+
+    # Upgrade up to latest version with partitioned history.
+    migratedb()
+
+
+def test_rollup_tier_backfill(migratedb):
+    migratedb('012_monitoring-partitions.sql')
+
+    migratedb.db(_in="""\
+    SET search_path TO monitoring, public;
+    INSERT INTO hosts (hostname, os, os_version)
+    VALUES ('test.lan', 'Linux', '5.10');
+    INSERT INTO metric_loadavg_history
+    SELECT tstzrange(min(datetime), max(datetime), '[]'), 1,
+           array_agg(ROW(datetime, 0.1, 0.2, 0.3)::metric_loadavg_record)
+    FROM (VALUES
+      ('2021-06-01 00:05:00+00'::TIMESTAMPTZ),
+      ('2021-06-01 00:06:00+00'::TIMESTAMPTZ)
+    ) AS r(datetime);
+    """)
+
+    # New 5m and 1d tiers are backfilled from months old history.
+    migratedb('013_monitoring-rollup-tiers.sql')
+    out = migratedb.db('--tuples-only', '--no-align', _in="""\
+    SET search_path TO monitoring, public;
+    SELECT tblname, nb_rows
+    FROM aggregate_data_single(
+      'metric_loadavg', 'metric_loadavg_record',
+      metric_tables_config()->'metric_loadavg'->>'aggregate'
+    )
+    WHERE tblname = 'metric_loadavg_5m_current';
+    """)
+    assert 'metric_loadavg_5m_current|1' == str(out).strip()
+
+    migratedb()
+
+
+def test_archive_new_history_table(migratedb):
+    migratedb()
+
+    # History table created after columnar migration gets field arrays.
+    out = migratedb.db('--tuples-only', '--no-align', _in="""\
+    SET search_path TO monitoring, public;
+    DROP TABLE metric_loadavg_history;
+    SELECT COUNT(*) FROM create_tables();
+    INSERT INTO hosts (hostname, os, os_version)
+    VALUES ('test.lan', 'Linux', '5.10');
+    INSERT INTO metric_loadavg_current
+    VALUES (NOW(), 1, ROW(NULL, 0.1, 0.2, 0.3));
+    SELECT tblname, nb_rows
+    FROM archive_current_metrics(
+      'metric_loadavg', 'metric_loadavg_record',
+      metric_tables_config()->'metric_loadavg'->>'history'
+    );
+    SELECT load1 FROM metric_loadavg_history;
+    """)
+    lines = str(out).split()
+    assert 'metric_loadavg_history|1' in lines
+    assert '{0.1}' == lines[-1]
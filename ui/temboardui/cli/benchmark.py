@@ -0,0 +1,526 @@
+#
+# Measure read paths of temBoard UI against a synthetic fleet.
+#
+# `temboard benchmark fill` stores hosts, instances, monitoring metrics,
+# alerting states and statements of a synthetic fleet in the repository.
+# Synthetic hosts are named bench-NNNN.test and are removed by `temboard
+# benchmark clean`. `temboard benchmark run` times chart and dashboard queries
+# on random synthetic instances and prints percentiles, to compare repository
+# changes at a given fleet size.
+#
+# Requires Python 3. Like prometheus command, the command is not exposed.
+# Run with python -m temboardui.cli.benchmark.
+#
+import logging
+import random
+import sys
+from datetime import timedelta
+from math import ceil
+from timeit import default_timer
+
+from flask import current_app, g
+
+from .app import app
+from ..model import Session
+from ..model.orm import Instances, Roles
+from ..toolkit.app import SubCommand
+from ..toolkit.errors import UserError
+from ..toolkit.utils import utcnow
+
+
+logger = logging.getLogger(__name__)
+HOSTNAME_PATTERN = 'bench-%.test'
+GROUP = 'bench'
+FIRST_AGENT_PORT = 2345
+FIRST_PG_PORT = 5432
+FIRST_DBID = 16384
+# Raw metrics more recent than this are left in _current tables.
+CURRENT_DELAY = timedelta(hours=3)
+# Text value of record fields, as SQL expressions. Other fields are random
+# integers.
+FIELD_VALUES = dict(
+    measure_interval="'00:01:00'",
+    device="'/dev/sda1'",
+    current_location="'0/1000000'",
+    stats_reset="'2023-01-01 00:00:00+00'",
+    connected="'1'",
+)
+PERCENTILES = (50, 90, 99)
+
+
+@app.command
+class Benchmark(SubCommand):
+    """ Benchmark UI read paths on a synthetic fleet. """
+
+    def main(self, args):
+        raise UserError("Missing sub-command. See --help for details.")
+
+
+def define_fleet_arguments(parser):
+    parser.add_argument(
+        '--databases', type=int, default=10,
+        help="Number of databases per instance. Default: %(default)s.",
+    )
+    parser.add_argument(
+        '--days', type=int, default=7,
+        help="Days of data up to now. Default: %(default)s.",
+    )
+
+
+@Benchmark.command
+class Fill(SubCommand):
+    """ Store a synthetic fleet in repository. """
+
+    def define_arguments(self, parser):
+        parser.add_argument(
+            '--hosts', type=int, default=10,
+            help="Number of hosts. Default: %(default)s.",
+        )
+        parser.add_argument(
+            '--instances', type=int, default=1,
+            help="Number of instances per host. Default: %(default)s.",
+        )
+        define_fleet_arguments(parser)
+        parser.add_argument(
+            '--role', default='admin',
+            help="Role granted access to fleet. Default: %(default)s.",
+        )
+
+    def main(self, args):
+        session = Session()
+        cur = session.connection().connection.cursor()
+        cur.execute("SET search_path TO monitoring")
+        cur.execute(
+            "SELECT 1 FROM monitoring.hosts WHERE hostname LIKE %s LIMIT 1",
+            (HOSTNAME_PATTERN,))
+        if cur.fetchone():
+            raise UserError(
+                "Repository already has a synthetic fleet. "
+                "Run temboard benchmark clean first.")
+
+        end = utcnow().replace(second=0, microsecond=0)
+        start = end.replace(hour=0, minute=0) - timedelta(days=args.days)
+        logger.info(
+            "Generating %s hosts of %s instances with %s databases from %s.",
+            args.hosts, args.instances, args.databases, start)
+        host_ids, instance_ids = fill_inventory(
+            cur, args.hosts, args.instances, args.role)
+        fill_metrics(cur, host_ids, instance_ids, args.databases, start, end)
+        fill_alerting(cur, instance_ids, start, end)
+        fill_statements(cur, args.databases, start, end)
+        session.commit()
+        logger.info("Synthetic fleet stored.")
+        return 0
+
+
+@Benchmark.command
+class Run(SubCommand):
+    """ Time read paths on synthetic fleet. """
+
+    def define_arguments(self, parser):
+        define_fleet_arguments(parser)
+        parser.add_argument(
+            '--repeat', type=int, default=10,
+            help="Number of runs of each read path. Default: %(default)s.",
+        )
+        parser.add_argument(
+            '--role', default='admin',
+            help="Role listing instances on home. Default: %(default)s.",
+        )
+
+    def main(self, args):
+        session = Session()
+        role = session.query(Roles).filter(
+            Roles.role_name == args.role).one_or_none()
+        if role is None:
+            raise UserError("Unknown role %s." % args.role)
+        instances = session.query(Instances).filter(
+            Instances.hostname.like(HOSTNAME_PATTERN)).all()
+        if not instances:
+            raise UserError(
+                "No synthetic fleet. Run temboard benchmark fill first.")
+        session.rollback()
+
+        end = utcnow()
+        start = end - timedelta(days=args.days)
+        timings = dict()
+        for i in range(args.repeat):
+            instance = random.choice(instances)
+            logger.info(
+                "Run %s/%s on %s:%s.",
+                i + 1, args.repeat, instance.hostname, instance.pg_port)
+            for path, func in iter_read_paths(
+                    session, role, instance, args.databases, start, end):
+                t0 = default_timer()
+                func()
+                timings.setdefault(path, []).append(default_timer() - t0)
+                session.rollback()
+
+        sys.stdout.write(format_timings(timings))
+        return 0
+
+
+@Benchmark.command
+class Clean(SubCommand):
+    """ Remove synthetic fleet from repository. """
+
+    def main(self, args):
+        session = Session()
+        cur = session.connection().connection.cursor()
+        cur.execute("""\
+        SELECT array_agg(DISTINCT h.host_id), array_agg(i.instance_id)
+        FROM monitoring.hosts AS h
+        LEFT OUTER JOIN monitoring.instances AS i ON i.host_id = h.host_id
+        WHERE h.hostname LIKE %s
+        """, (HOSTNAME_PATTERN,))
+        host_ids, instance_ids = cur.fetchone()
+        host_ids = host_ids or []
+        instance_ids = [i for i in instance_ids or [] if i is not None]
+
+        # Tables referencing hosts or instances, without partitions.
+        cur.execute("""\
+        SELECT c.relname, a.attname
+        FROM pg_catalog.pg_attribute AS a
+        JOIN pg_catalog.pg_class AS c ON c.oid = a.attrelid
+        JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'monitoring' AND c.relkind IN ('r', 'p')
+          AND NOT EXISTS (
+            SELECT 1 FROM pg_catalog.pg_inherits WHERE inhrelid = c.oid)
+          AND c.relname NOT IN ('hosts', 'instances')
+          AND a.attname IN ('host_id', 'instance_id')
+        ORDER BY 1, 2
+        """)
+        for table, column in cur.fetchall():
+            ids = host_ids if 'host_id' == column else instance_ids
+            cur.execute(
+                "DELETE FROM monitoring.%s WHERE %s = ANY(%%s)" % (
+                    table, column), (ids,))
+            if cur.rowcount:
+                logger.info("Deleted %s rows from %s.", cur.rowcount, table)
+
+        cur.execute(
+            "DELETE FROM monitoring.instances WHERE instance_id = ANY(%s)",
+            (instance_ids,))
+        cur.execute(
+            "DELETE FROM monitoring.hosts WHERE host_id = ANY(%s)",
+            (host_ids,))
+        # Cascades to plugins, groups and statements.
+        cur.execute(
+            "DELETE FROM application.instances WHERE hostname LIKE %s",
+            (HOSTNAME_PATTERN,))
+        cur.execute(
+            "DELETE FROM application.groups WHERE group_name = %s",
+            (GROUP,))
+        session.commit()
+        logger.info(
+            "Removed %s hosts and %s instances.",
+            len(host_ids), len(instance_ids))
+        return 0
+
+
+def fill_inventory(cur, hosts, instances, role):
+    cur.execute("""\
+    INSERT INTO monitoring.hosts (hostname, os, os_version, cpu_count, memory_size)
+    SELECT 'bench-' || lpad(i::TEXT, 4, '0') || '.test',
+           'Linux', '5.10.0', 4, 8589934592
+    FROM generate_series(1, %s) AS i
+    RETURNING host_id
+    """, (hosts,))  # noqa
+    host_ids = [row[0] for row in cur.fetchall()]
+
+    cur.execute("""\
+    INSERT INTO monitoring.instances
+      (host_id, port, local_name, version, version_num, data_directory)
+    SELECT host_id, %(port)s + j, 'pg' || j, '15.4', 150004,
+           '/var/lib/postgresql/15/pg' || j
+    FROM unnest(%(host_ids)s) AS host_id,
+         generate_series(0, %(instances)s - 1) AS j
+    RETURNING instance_id
+    """, dict(port=FIRST_PG_PORT, host_ids=host_ids, instances=instances))
+    instance_ids = [row[0] for row in cur.fetchall()]
+
+    cur.execute("""\
+    INSERT INTO application.instances
+      (agent_address, agent_port, hostname, cpu, memory_size,
+       pg_port, pg_version, pg_version_summary, pg_data)
+    SELECT h.hostname, %(agent_port)s + i.port - %(pg_port)s, h.hostname,
+           h.cpu_count, h.memory_size, i.port, i.version,
+           'PostgreSQL ' || i.version, i.data_directory
+    FROM monitoring.instances AS i
+    JOIN monitoring.hosts AS h ON h.host_id = i.host_id
+    WHERE i.instance_id = ANY(%(ids)s)
+    """, dict(
+        agent_port=FIRST_AGENT_PORT, pg_port=FIRST_PG_PORT,
+        ids=instance_ids))
+    cur.execute("""\
+    INSERT INTO application.plugins
+    SELECT agent_address, agent_port, plugin
+    FROM application.instances,
+         unnest(ARRAY['dashboard', 'monitoring', 'statements']) AS plugin
+    WHERE hostname LIKE %s
+    """, (HOSTNAME_PATTERN,))
+
+    # Grant role access to the fleet.
+    cur.execute("""\
+    INSERT INTO application.groups VALUES
+      (%(group)s, 'Synthetic fleet', 'instance'),
+      (%(group)s, 'Synthetic fleet', 'role');
+    INSERT INTO application.instance_groups (agent_address, agent_port, group_name)
+    SELECT agent_address, agent_port, %(group)s
+    FROM application.instances WHERE hostname LIKE %(pattern)s;
+    INSERT INTO application.role_groups (role_name, group_name)
+    VALUES (%(role)s, %(group)s);
+    INSERT INTO application.access_role_instance
+      (role_group_name, instance_group_name)
+    VALUES (%(group)s, %(group)s);
+    """, dict(group=GROUP, pattern=HOSTNAME_PATTERN, role=role))  # noqa
+
+    for instance_id in instance_ids:
+        cur.execute(
+            "SELECT monitoring.insert_instance_availability(NOW(), %s, true)",
+            (instance_id,))
+    return host_ids, instance_ids
+
+
+def fill_metrics(cur, host_ids, instance_ids, databases, start, end):
+    from ..plugins.monitoring.chartdata import RECORDS
+    from ..plugins.monitoring.model.db import METRIC_TABLES
+
+    cur.execute(
+        "SELECT json_object_keys(monitoring.rate_tables_config())")
+    rates = set(row[0] for row in cur.fetchall())
+    cur.execute(
+        "SELECT period, EXTRACT(EPOCH FROM period::INTERVAL)"
+        " FROM monitoring.rollup_tiers ORDER BY 2")
+    tiers = [(period, int(seconds)) for period, seconds in cur.fetchall()]
+    recent = end - CURRENT_DELAY
+
+    # Partitions of past months, on PostgreSQL 11+.
+    cur.execute("""\
+    SELECT monitoring.create_partition(c.relname, month)
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace,
+         generate_series(
+           date_trunc('month', %s::TIMESTAMPTZ), NOW(), '1 month'
+         ) AS month
+    WHERE n.nspname = 'monitoring' AND c.relkind = 'p'
+    """, (start,))
+
+    for spec in sorted(METRIC_TABLES.values(), key=lambda s: s['table']):
+        name = spec['table'][:-len('_current')]
+        record_type, fields = RECORDS[name]
+        ids = host_ids if 'host_id' == spec['id'] else instance_ids
+        keys = metric_keys(spec['key'], databases)
+        logger.info("Generating %s.", name)
+
+        # Raw points, archived except the most recent ones. Archiving moves
+        # all points of _current table, including those of real instances.
+        fill_metric_table(
+            cur, name + '_current', record_type, fields, ids, keys,
+            start, recent, 60)
+        cur.execute(
+            "SELECT * FROM monitoring.archive_current_metrics(%s, %s, '')",
+            (name, record_type))
+        fill_metric_table(
+            cur, name + '_current', record_type, fields, ids, keys,
+            recent, end, 60)
+
+        for period, seconds in tiers:
+            fill_metric_table(
+                cur, '%s_%s_current' % (name, period), record_type, fields,
+                ids, keys, start, end, seconds, weight=seconds // 60)
+            if name in rates:
+                cur.execute(
+                    "SELECT monitoring.aggregate_rates(%s, %s, %s)",
+                    (name, period, start))
+
+
+def fill_metric_table(cur, table, record_type, fields, ids, keys, start,
+                      end, step, weight=None):
+    # Insert one point per id, key and step, with datetime of record NULL
+    # like ingestion does.
+    values = [
+        FIELD_VALUES.get(field, '(random() * 100)::INTEGER')
+        for field in fields[1:]
+    ]
+    record = "('(,' || concat_ws(',', %s) || ')')::monitoring.%s" % (
+        ', '.join("'\"' || %s || '\"'" % v for v in values), record_type)
+    columns = ['ts', 'id'] + (['key'] if keys else []) + [record]
+    if weight:
+        columns.append(str(weight))
+    cur.execute("""\
+    INSERT INTO monitoring.%(table)s
+    SELECT %(columns)s
+    FROM generate_series(%%(start)s, %%(end)s - INTERVAL '1 second', %%(step)s) AS ts,
+         unnest(%%(ids)s) AS id %(keys)s
+    """ % dict(  # noqa
+        table=table, columns=', '.join(columns),
+        keys=', unnest(%(keys)s) AS key' if keys else '',
+    ), dict(
+        start=start, end=end, step=timedelta(seconds=step), ids=ids,
+        keys=keys,
+    ))
+
+
+def fill_alerting(cur, instance_ids, start, end):
+    from ..plugins.monitoring.alerting import check_specs
+
+    logger.info("Generating alerting checks and states.")
+    cur.execute("""\
+    INSERT INTO monitoring.checks
+      (host_id, instance_id, enabled, name, warning, critical, description)
+    SELECT host_id, instance_id, true, name, 80, 90, name
+    FROM monitoring.instances, unnest(%(names)s) AS name
+    WHERE instance_id = ANY(%(ids)s)
+    RETURNING check_id
+    """, dict(names=sorted(check_specs), ids=instance_ids))
+    check_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("""\
+    INSERT INTO monitoring.check_states (check_id, key, state)
+    SELECT check_id,
+           '',
+           (ARRAY['OK', 'WARNING', 'CRITICAL'])[1 + (random() * 2)::INTEGER]::monitoring.check_state_type
+    FROM unnest(%(ids)s) AS check_id;
+    -- One state change per check and hour.
+    INSERT INTO monitoring.state_changes
+      (datetime, check_id, state, key, value, warning, critical)
+    SELECT ts, check_id,
+           (ARRAY['OK', 'WARNING', 'CRITICAL'])[1 + (random() * 2)::INTEGER]::monitoring.check_state_type,
+           '', random() * 100, 80, 90
+    FROM unnest(%(ids)s) AS check_id,
+         generate_series(%(start)s, %(end)s, '1 hour') AS ts;
+    """, dict(ids=check_ids, start=start, end=end))  # noqa
+
+
+def fill_statements(cur, databases, start, end):
+    logger.info("Generating statements.")
+    # Counters are cumulative, one record per minute, coalesced by hour in
+    # statements_history_db, last hour in statements_history_current_db.
+    record = """\
+    ROW(
+      ts, {m} * 10, {m} * 1.5, {m} * 5, {m} * 100, {m} * 3, 0, 0, 0, 0, 0, 0,
+      0, 0, 0, 0, 0, 0, 0, 0
+    )::statements.statements_history_record""".format(
+        m="(EXTRACT(EPOCH FROM ts - %(start)s) / 60)::BIGINT")
+    recent = end - timedelta(hours=1)
+    params = dict(
+        pattern=HOSTNAME_PATTERN, start=start, recent=recent, end=end,
+        dbids=list(range(FIRST_DBID, FIRST_DBID + databases)),
+    )
+    cur.execute("""\
+    INSERT INTO statements.metas (agent_address, agent_port)
+    SELECT agent_address, agent_port
+    FROM application.instances WHERE hostname LIKE %(pattern)s;
+
+    INSERT INTO statements.statements_history_db
+    SELECT i.agent_address, i.agent_port, dbid, 'db' || (dbid - {first}),
+           tstzrange(h, h + '59 minutes'::INTERVAL, '[]'),
+           r.records, r.records[1], r.records[60]
+    FROM application.instances AS i,
+         unnest(%(dbids)s) AS dbid,
+         generate_series(%(start)s, %(recent)s - '1 hour'::INTERVAL, '1 hour') AS h,
+         LATERAL (
+           SELECT array_agg({record} ORDER BY ts) AS records
+           FROM generate_series(h, h + '59 minutes'::INTERVAL, '1 minute') AS ts
+         ) AS r
+    WHERE i.hostname LIKE %(pattern)s;
+
+    INSERT INTO statements.statements_history_current_db
+    SELECT i.agent_address, i.agent_port, dbid, 'db' || (dbid - {first}),
+           {record}
+    FROM application.instances AS i,
+         unnest(%(dbids)s) AS dbid,
+         generate_series(%(recent)s, %(end)s, '1 minute') AS ts
+    WHERE i.hostname LIKE %(pattern)s;
+    """.format(first=FIRST_DBID, record=record), params)  # noqa
+
+
+def metric_keys(key, databases):
+    # Values of key column of synthetic metrics.
+    if not key:
+        return []
+    if 'dbname' == key:
+        return ['db%d' % i for i in range(databases)]
+    return ['%s0' % key]
+
+
+def iter_read_paths(session, role, instance, databases, start, end):
+    # Generate (name, callable) of each read path for an instance.
+    from ..plugins.monitoring.chartdata import (
+        DEFAULT_POINTS, METRICS, RAW_TIER,
+        get_metric_data_csv, get_rollup_tiers,
+    )
+    from ..plugins.monitoring.handlers.alerting import alerts
+    from ..plugins.statements import getstatdata_sample
+    from ..plugins.monitoring.tools import get_request_ids
+    from ..web.routes import home_instances
+
+    request = BenchRequest(session, instance)
+    host_id, instance_id = get_request_ids(request)
+    tiers = [RAW_TIER] + get_rollup_tiers(session)
+
+    for name in sorted(METRICS):
+        metric = METRICS[name]
+        key = None
+        if len(metric['expand']) > 2:
+            key = metric_keys(metric['expand'][2], databases)[0]
+        for tier in tiers:
+            # Same range as select_tier() would pick this tier for.
+            span = min(end - start, timedelta(
+                seconds=tier[1] * DEFAULT_POINTS))
+            yield (
+                'chart %s %s' % (name, tier[0] or 'raw'),
+                bind(get_metric_data_csv, session, name, end - span, end,
+                     host_id, instance_id, key, tier),
+            )
+
+    def home():
+        # Request teardown closes g.db_session.
+        with current_app.test_request_context('/home/instances'):
+            g.current_user = role
+            g.db_session = Session()
+            home_instances()
+
+    yield 'home instances', home
+    yield 'alerts.json', bind(getattr(alerts, '__wrapped__', alerts), request)
+    yield 'statements instance chart', bind(
+        getstatdata_sample, request, 'instance', start, end)
+    yield 'statements database chart', bind(
+        getstatdata_sample, request, 'db', start, end, FIRST_DBID)
+
+
+def bind(func, *args):
+    return lambda: func(*args)
+
+
+class BenchRequest(object):
+    # Minimal request for handlers reading repository only.
+
+    def __init__(self, db_session, instance):
+        self.db_session = db_session
+        self.instance = instance
+
+
+def format_timings(timings):
+    header = '%-48s %5s' + ' %9s' * (len(PERCENTILES) + 1) + '\n'
+    lines = [header % (
+        ('path', 'n') + tuple('p%d ms' % p for p in PERCENTILES)
+        + ('max ms',))]
+    for path in sorted(timings):
+        values = sorted(timings[path])
+        row = [percentile(values, p) for p in PERCENTILES] + [values[-1]]
+        lines.append(header.replace('%9s', '%9.1f') % (
+            (path, len(values)) + tuple(v * 1000 for v in row)))
+    return ''.join(lines)
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values.
+    rank = int(ceil(p / 100. * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+if "__main__" == __name__:
+    from ..__main__ import main
+
+    sys.exit(main(argv=["benchmark"] + sys.argv[1:]))
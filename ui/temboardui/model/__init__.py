@@ -67,11 +67,11 @@ def check_connectivity(engine):
         raise Exception(msg % pgversion)
 
 
-def worker_engine(dbconf):
+def worker_engine(dbconf, **kw):
     """Create a new stand-alone SQLAlchemy engine to be instantiated in worker
     context.
     """
-    return create_engine(format_dsn(dbconf))
+    return create_engine(format_dsn(dbconf), **kw)
 
 
 def check_schema():
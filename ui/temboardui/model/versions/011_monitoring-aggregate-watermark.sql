@@ -0,0 +1,59 @@
+-- Track how far aggregation went for each rollup table. Next run aggregates
+-- points from the last aggregated bucket onward, instead of searching
+-- MAX(datetime) in rollup.
+CREATE TABLE monitoring.aggregate_watermarks (
+  tablename TEXT PRIMARY KEY,
+  -- Start of the last bucket upserted in rollup.
+  last_bucket TIMESTAMPTZ NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION monitoring.aggregate_data_single(table_name TEXT, record_type TEXT, query TEXT)
+RETURNS TABLE(tblname TEXT, nb_rows INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_agg_periods TEXT[] := array['30m', '6h'];
+  v_agg_table TEXT;
+  i_period TEXT;
+  v_query TEXT;
+  v_watermark TIMESTAMPTZ;
+  v_last_bucket TIMESTAMPTZ;
+  i INTEGER;
+BEGIN
+  FOREACH i_period IN ARRAY v_agg_periods LOOP
+    v_agg_table := table_name || '_' || i_period || '_current';
+    -- Lock watermark to serialize concurrent runs on the same rollup.
+    SELECT last_bucket INTO v_watermark
+    FROM monitoring.aggregate_watermarks
+    WHERE tablename = v_agg_table
+    FOR UPDATE;
+    IF NOT FOUND THEN
+      -- First run since upgrade, bootstrap from rollup content.
+      EXECUTE 'SELECT MAX(datetime) FROM monitoring.' || v_agg_table INTO v_watermark;
+    END IF;
+
+    -- Build and run 'aggregate' query for type of metric, restricted to
+    -- points from the watermark bucket onward.
+    v_query := replace(
+      query,
+      '(SELECT tstzrange(MAX(datetime), NOW()) FROM #agg_table#)',
+      quote_literal(tstzrange(v_watermark, NOW())) || '::TSTZRANGE'
+    );
+    v_query := replace(v_query, '#agg_table#', v_agg_table);
+    v_query := replace(v_query, '#interval#', i_period);
+    v_query := replace(v_query, '#record_type#', record_type);
+    v_query := replace(v_query, '#name#', table_name);
+    EXECUTE 'WITH upserted AS (' || v_query || ' RETURNING datetime) '
+      || 'SELECT COUNT(*), MAX(datetime) FROM upserted'
+    INTO i, v_last_bucket;
+
+    IF v_last_bucket IS NOT NULL THEN
+      INSERT INTO monitoring.aggregate_watermarks AS w (tablename, last_bucket)
+      VALUES (v_agg_table, v_last_bucket)
+      ON CONFLICT (tablename) DO UPDATE
+      SET last_bucket = GREATEST(w.last_bucket, EXCLUDED.last_bucket);
+    END IF;
+    RETURN QUERY SELECT v_agg_table, i;
+  END LOOP;
+END;
+$$;
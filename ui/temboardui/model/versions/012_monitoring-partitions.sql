@@ -0,0 +1,289 @@
+-- Partition monitoring _history and rollup tables by month.
+--
+-- Retention drops whole partitions instead of deleting rows. _current tables
+-- are truncated by archiving and are kept unpartitioned. Partitioning
+-- requires PostgreSQL 11 for unique constraints on partitioned rollup tables.
+-- On older PostgreSQL, tables are left untouched and purge keeps deleting
+-- rows.
+--
+-- A partition named <table>_pYYYYMM holds rows up to the end of month
+-- YYYYMM.
+
+SET search_path TO monitoring, public;
+
+CREATE OR REPLACE FUNCTION create_partition(i_parent TEXT, i_month TIMESTAMPTZ)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_start TIMESTAMP := date_trunc('month', i_month AT TIME ZONE 'UTC');
+  v_name TEXT := i_parent || to_char(v_start, '"_p"YYYYMM');
+BEGIN
+  PERFORM 1 FROM pg_tables WHERE tablename = v_name AND schemaname = 'monitoring';
+  IF FOUND THEN
+    RETURN NULL;
+  END IF;
+  BEGIN
+    EXECUTE format(
+      'CREATE TABLE monitoring.%I PARTITION OF monitoring.%I FOR VALUES FROM (%L) TO (%L)',
+      v_name, i_parent,
+      v_start AT TIME ZONE 'UTC', (v_start + '1 month'::INTERVAL) AT TIME ZONE 'UTC'
+    );
+  EXCEPTION WHEN invalid_object_definition THEN
+    -- Month is already covered by a partition converted from legacy table.
+    RETURN NULL;
+  END;
+  RETURN v_name;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_partitions(i_upcoming INTEGER DEFAULT 2)
+RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_parent TEXT;
+  v_name TEXT;
+  i INTEGER;
+BEGIN
+  -- Ensure partitions exist for current month and i_upcoming next months.
+  FOR v_parent IN
+    SELECT c.relname
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'monitoring' AND c.relkind = 'p'
+    ORDER BY 1
+  LOOP
+    FOR i IN 0..i_upcoming LOOP
+      v_name := monitoring.create_partition(
+        v_parent, date_trunc('month', NOW()) + i * '1 month'::INTERVAL
+      );
+      IF v_name IS NOT NULL THEN
+        RETURN QUERY SELECT v_name;
+      END IF;
+    END LOOP;
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION drop_partitions(i_before TIMESTAMPTZ)
+RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  r RECORD;
+BEGIN
+  -- Drop partitions holding only rows older than i_before.
+  FOR r IN
+    SELECT c.relname::TEXT AS relname
+    FROM pg_catalog.pg_inherits AS i
+    JOIN pg_catalog.pg_class AS c ON c.oid = i.inhrelid
+    JOIN pg_catalog.pg_class AS p ON p.oid = i.inhparent
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = p.relnamespace
+    WHERE n.nspname = 'monitoring' AND p.relkind = 'p'
+      AND c.relname ~ '_p[0-9]{6}$'
+    ORDER BY 1
+  LOOP
+    IF (to_date(right(r.relname, 6), 'YYYYMM') + '1 month'::INTERVAL) AT TIME ZONE 'UTC' <= i_before THEN
+      EXECUTE format('DROP TABLE monitoring.%I', r.relname);
+      RETURN QUERY SELECT r.relname;
+    END IF;
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_tables() RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  c JSON;
+  v_agg_periods TEXT[] := array['30m', '6h'];
+  v_create_tbl_cols_cur TEXT;
+  v_create_idx_cols_cur TEXT;
+  v_create_tbl_cols_hist TEXT;
+  v_create_idx_cols_hist TEXT;
+  v_tablename TEXT;
+  v_like_tablename TEXT;
+  v_partition_by_hist TEXT := '';
+  v_partition_by_agg TEXT := '';
+  i_period TEXT;
+BEGIN
+  IF current_setting('server_version_num')::INTEGER >= 110000 THEN
+    v_partition_by_hist := ' PARTITION BY RANGE (lower(history_range))';
+    v_partition_by_agg := ' PARTITION BY RANGE (datetime)';
+  END IF;
+
+  -- Tables creation if they do not exist
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_create_tbl_cols_cur := 'datetime TIMESTAMPTZ NOT NULL';
+    v_create_idx_cols_cur := 'datetime';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_cur := v_create_tbl_cols_cur||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_cur := v_create_idx_cols_cur||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+  -- Creation of current table.
+    v_tablename := trim((t->'name')::TEXT, '"')||'_current';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_cur||', record '||trim((t->'record_type')::TEXT, '"')||')';
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_cur||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Creation of history table.
+    v_create_tbl_cols_hist := 'history_range TSTZRANGE NOT NULL';
+    v_create_idx_cols_hist := 'history_range';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_hist := v_create_tbl_cols_hist||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_hist := v_create_idx_cols_hist||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+    v_tablename := trim((t->'name')::TEXT, '"')||'_history';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_hist||', records '||trim((t->'record_type')::TEXT, '"')||'[])'||v_partition_by_hist;
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_hist||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Aggregate tables creation.
+    FOREACH i_period IN ARRAY v_agg_periods LOOP
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_current';
+      v_like_tablename := trim((t->'name')::TEXT, '"')||'_current';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        -- Weight: number of record aggregated
+        EXECUTE 'CREATE TABLE '||v_tablename||' (LIKE '||v_like_tablename||', w INTEGER DEFAULT 1, UNIQUE ('||v_create_idx_cols_cur||'))'||v_partition_by_agg;
+        RETURN QUERY SELECT v_tablename;
+      END IF;
+    END LOOP;
+  END LOOP;
+
+  RETURN QUERY SELECT * FROM monitoring.create_partitions();
+END;
+$$;
+
+
+-- Convert existing tables to partitioned tables. Existing table is attached
+-- as a single partition holding all rows up to the end of the current month or
+-- later, without rewriting rows. This partition is dropped once all its rows are
+-- older than purge_after.
+DO $$
+DECLARE
+  t JSON;
+  c JSON;
+  v_table TEXT;
+  v_legacy TEXT;
+  v_key TEXT;
+  v_cols TEXT;
+  v_max TIMESTAMPTZ;
+  v_end TIMESTAMP;
+  i_suffix TEXT;
+BEGIN
+  -- Archiving used to write tstzrange(min, max) which is empty for a day with
+  -- a single record. lower() of an empty range is NULL, which no partition
+  -- accepts. Close these ranges on the record datetime.
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_table := trim((t->'name')::TEXT, '"')||'_history';
+    EXECUTE format(
+      'UPDATE %I SET history_range = tstzrange((records[1]).datetime, (records[1]).datetime, ''[]'') '
+      'WHERE isempty(history_range)',
+      v_table
+    );
+  END LOOP;
+
+  IF current_setting('server_version_num')::INTEGER < 110000 THEN
+    RAISE NOTICE 'Partitioning requires PostgreSQL 11. Skipping.';
+    RETURN;
+  END IF;
+
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    FOREACH i_suffix IN ARRAY array['history', '30m_current', '6h_current'] LOOP
+      v_table := trim((t->'name')::TEXT, '"')||'_'||i_suffix;
+      PERFORM 1
+      FROM pg_catalog.pg_class AS cl
+      JOIN pg_catalog.pg_namespace AS n ON n.oid = cl.relnamespace
+      WHERE n.nspname = 'monitoring' AND cl.relname = v_table AND cl.relkind = 'r';
+      CONTINUE WHEN NOT FOUND;
+
+      v_cols := '';
+      FOR c IN SELECT json_array_elements(t->'columns') LOOP
+        v_cols := v_cols||', '||trim((c->'name')::TEXT, '"');
+      END LOOP;
+
+      IF 'history' = i_suffix THEN
+        v_key := 'lower(history_range)';
+        v_cols := 'history_range'||v_cols;
+        -- btree on ranges sorts on lower bound first.
+        EXECUTE format('SELECT lower(history_range) FROM %I ORDER BY history_range DESC LIMIT 1', v_table) INTO v_max;
+      ELSE
+        v_key := 'datetime';
+        v_cols := 'datetime'||v_cols;
+        EXECUTE format('SELECT MAX(datetime) FROM %I', v_table) INTO v_max;
+      END IF;
+
+      -- Legacy partition ends with the month of its most recent row, at
+      -- least the current month.
+      v_end := date_trunc('month', GREATEST(NOW(), v_max) AT TIME ZONE 'UTC');
+      v_legacy := v_table||to_char(v_end, '"_p"YYYYMM');
+      v_end := v_end + '1 month'::INTERVAL;
+
+      EXECUTE format('ALTER TABLE %I RENAME TO %I', v_table, v_legacy);
+      IF 'history' = i_suffix THEN
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', 'idx_'||v_table, 'idx_'||v_legacy);
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS) PARTITION BY RANGE (%s)', v_table, v_legacy, v_key);
+        EXECUTE format('CREATE INDEX %I ON %I (%s)', 'idx_'||v_table, v_table, v_cols);
+      ELSE
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS, UNIQUE (%s)) PARTITION BY RANGE (%s)', v_table, v_legacy, v_cols, v_key);
+      END IF;
+      -- Reuses legacy indexes matching parent ones.
+      EXECUTE format(
+        'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (MINVALUE) TO (%L)',
+        v_table, v_legacy, v_end AT TIME ZONE 'UTC'
+      );
+      RAISE NOTICE 'Partitioned %.', v_table;
+    END LOOP;
+  END LOOP;
+
+  PERFORM create_partitions();
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION archive_current_metrics(table_name TEXT, record_type TEXT, query TEXT)
+RETURNS TABLE(tblname TEXT, nb_rows INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_table_current TEXT;
+  v_table_history TEXT;
+  v_query TEXT;
+  i INTEGER;
+BEGIN
+  v_table_current := table_name || '_current';
+  v_table_history := table_name || '_history';
+  -- Lock _current table to prevent concurrent updates
+  EXECUTE 'LOCK TABLE ' || v_table_current || ' IN SHARE MODE';
+  v_query := replace(query, '#history_table#', v_table_history);
+  v_query := replace(v_query, '#current_table#', v_table_current);
+  v_query := replace(v_query, '#record_type#', record_type);
+  -- Include upper bound so that a single record day has a non-empty range.
+  v_query := replace(
+    v_query,
+    'tstzrange(min(datetime), max(datetime))',
+    'tstzrange(min(datetime), max(datetime), ''[]'')'
+  );
+  -- Move data into _history table
+  EXECUTE v_query;
+  GET DIAGNOSTICS i = ROW_COUNT;
+  -- Truncate _current table
+  EXECUTE 'TRUNCATE '||v_table_current;
+  -- Return each history table name and the number of rows inserted
+  RETURN QUERY SELECT v_table_history, i;
+END;
+$$;
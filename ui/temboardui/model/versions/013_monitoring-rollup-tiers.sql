@@ -0,0 +1,188 @@
+-- Configurable ladder of rollup tiers. Each tier has its own
+-- metric_<name>_<period>_current tables, created by create_tables() and
+-- maintained by aggregate_data_single(). Charts pick the coarsest tier giving
+-- enough points for the requested range.
+--
+-- Period must be understood by truncate_time(): minutes dividing an hour,
+-- hours dividing a day, or 1d. After changing tiers, run
+-- SELECT monitoring.create_tables(); or wait for daily partitions
+-- maintenance. A new tier is backfilled by aggregation from raw metrics still
+-- in repository.
+
+SET search_path TO monitoring, public;
+
+CREATE TABLE rollup_tiers (
+  period TEXT PRIMARY KEY CHECK (period ~ '^[0-9]+[mhd]$')
+);
+
+INSERT INTO rollup_tiers (period) VALUES ('5m'), ('30m'), ('6h'), ('1d');
+
+
+CREATE OR REPLACE FUNCTION rollup_periods()
+RETURNS TEXT[]
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT COALESCE(array_agg(period ORDER BY period::INTERVAL), '{}')
+  FROM monitoring.rollup_tiers;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_partitions_since(i_parent TEXT, i_since TIMESTAMPTZ)
+RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_month TIMESTAMP := date_trunc('month', i_since AT TIME ZONE 'UTC');
+  v_name TEXT;
+BEGIN
+  -- Ensure partitions exist from i_since month up to current month, for
+  -- backfilling a new table from existing metrics. Does nothing if i_since is
+  -- NULL.
+  WHILE v_month < NOW() AT TIME ZONE 'UTC' LOOP
+    v_name := monitoring.create_partition(i_parent, v_month AT TIME ZONE 'UTC');
+    IF v_name IS NOT NULL THEN
+      RETURN QUERY SELECT v_name;
+    END IF;
+    v_month := v_month + '1 month'::INTERVAL;
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_tables() RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  c JSON;
+  v_agg_periods TEXT[] := monitoring.rollup_periods();
+  v_create_tbl_cols_cur TEXT;
+  v_create_idx_cols_cur TEXT;
+  v_create_tbl_cols_hist TEXT;
+  v_create_idx_cols_hist TEXT;
+  v_tablename TEXT;
+  v_like_tablename TEXT;
+  v_since TIMESTAMPTZ;
+  v_partition_by_hist TEXT := '';
+  v_partition_by_agg TEXT := '';
+  i_period TEXT;
+BEGIN
+  IF current_setting('server_version_num')::INTEGER >= 110000 THEN
+    v_partition_by_hist := ' PARTITION BY RANGE (lower(history_range))';
+    v_partition_by_agg := ' PARTITION BY RANGE (datetime)';
+  END IF;
+
+  -- Tables creation if they do not exist
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_create_tbl_cols_cur := 'datetime TIMESTAMPTZ NOT NULL';
+    v_create_idx_cols_cur := 'datetime';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_cur := v_create_tbl_cols_cur||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_cur := v_create_idx_cols_cur||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+  -- Creation of current table.
+    v_tablename := trim((t->'name')::TEXT, '"')||'_current';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_cur||', record '||trim((t->'record_type')::TEXT, '"')||')';
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_cur||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Creation of history table.
+    v_create_tbl_cols_hist := 'history_range TSTZRANGE NOT NULL';
+    v_create_idx_cols_hist := 'history_range';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_hist := v_create_tbl_cols_hist||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_hist := v_create_idx_cols_hist||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+    v_tablename := trim((t->'name')::TEXT, '"')||'_history';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_hist||', records '||trim((t->'record_type')::TEXT, '"')||'[])'||v_partition_by_hist;
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_hist||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Aggregate tables creation.
+    FOREACH i_period IN ARRAY v_agg_periods LOOP
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_current';
+      v_like_tablename := trim((t->'name')::TEXT, '"')||'_current';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        -- Weight: number of record aggregated
+        EXECUTE 'CREATE TABLE '||v_tablename||' (LIKE '||v_like_tablename||', w INTEGER DEFAULT 1, UNIQUE ('||v_create_idx_cols_cur||'))'||v_partition_by_agg;
+        RETURN QUERY SELECT v_tablename;
+        IF v_partition_by_agg <> '' THEN
+          -- New tier is backfilled from oldest raw metrics.
+          EXECUTE format(
+            'SELECT LEAST((SELECT lower(history_range) FROM %I ORDER BY history_range LIMIT 1), (SELECT MIN(datetime) FROM %I))',
+            trim((t->'name')::TEXT, '"')||'_history', v_like_tablename
+          ) INTO v_since;
+          RETURN QUERY SELECT * FROM monitoring.create_partitions_since(v_tablename, v_since);
+        END IF;
+      END IF;
+    END LOOP;
+  END LOOP;
+
+  RETURN QUERY SELECT * FROM monitoring.create_partitions();
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION aggregate_data_single(table_name TEXT, record_type TEXT, query TEXT)
+RETURNS TABLE(tblname TEXT, nb_rows INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_agg_periods TEXT[] := monitoring.rollup_periods();
+  v_agg_table TEXT;
+  i_period TEXT;
+  v_query TEXT;
+  v_watermark TIMESTAMPTZ;
+  v_last_bucket TIMESTAMPTZ;
+  i INTEGER;
+BEGIN
+  FOREACH i_period IN ARRAY v_agg_periods LOOP
+    v_agg_table := table_name || '_' || i_period || '_current';
+    -- Lock watermark to serialize concurrent runs on the same rollup.
+    SELECT last_bucket INTO v_watermark
+    FROM monitoring.aggregate_watermarks
+    WHERE tablename = v_agg_table
+    FOR UPDATE;
+    IF NOT FOUND THEN
+      -- First run since upgrade, bootstrap from rollup content.
+      EXECUTE 'SELECT MAX(datetime) FROM monitoring.' || v_agg_table INTO v_watermark;
+    END IF;
+
+    -- Build and run 'aggregate' query for type of metric, restricted to
+    -- points from the watermark bucket onward.
+    v_query := replace(
+      query,
+      '(SELECT tstzrange(MAX(datetime), NOW()) FROM #agg_table#)',
+      quote_literal(tstzrange(v_watermark, NOW())) || '::TSTZRANGE'
+    );
+    v_query := replace(v_query, '#agg_table#', v_agg_table);
+    v_query := replace(v_query, '#interval#', i_period);
+    v_query := replace(v_query, '#record_type#', record_type);
+    v_query := replace(v_query, '#name#', table_name);
+    EXECUTE 'WITH upserted AS (' || v_query || ' RETURNING datetime) '
+      || 'SELECT COUNT(*), MAX(datetime) FROM upserted'
+    INTO i, v_last_bucket;
+
+    IF v_last_bucket IS NOT NULL THEN
+      INSERT INTO monitoring.aggregate_watermarks AS w (tablename, last_bucket)
+      VALUES (v_agg_table, v_last_bucket)
+      ON CONFLICT (tablename) DO UPDATE
+      SET last_bucket = GREATEST(w.last_bucket, EXCLUDED.last_bucket);
+    END IF;
+    RETURN QUERY SELECT v_agg_table, i;
+  END LOOP;
+END;
+$$;
+
+
+SELECT * FROM create_tables();
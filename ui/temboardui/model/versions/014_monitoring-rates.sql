@@ -0,0 +1,265 @@
+-- Materialize rates and percentages derived from rollups at aggregation
+-- time. Each tier of metric tables listed in rate_tables_config() has a
+-- metric_<name>_<period>_rates table, one row per host or instance and
+-- bucket. Charts read them with a range scan on (id, datetime) instead of
+-- grouping databases and dividing by measure interval on each page view.
+
+SET search_path TO monitoring, public;
+
+CREATE OR REPLACE FUNCTION rate_tables_config()
+RETURNS JSON
+LANGUAGE sql
+IMMUTABLE
+AS $$
+-- For each metric table: id column, rate columns and the matching
+-- expressions, aggregating rollup rows of the same bucket and id.
+SELECT json_build_object(
+  'metric_blocks', json_build_object(
+    'id', 'instance_id',
+    'columns', json_build_array('blks_read_s', 'blks_hit_s', 'hit_read_ratio'),
+    'select', $_$
+      ROUND(SUM((record).blks_read)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0)),
+      ROUND(SUM((record).blks_hit)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0)),
+      CASE WHEN (SUM((record).blks_hit) + SUM((record).blks_read)) > 0
+      THEN ROUND((SUM((record).blks_hit)::FLOAT/(SUM((record).blks_hit) + SUM((record).blks_read)::FLOAT) * 100)::numeric, 2)
+      ELSE 100 END
+    $_$
+  ),
+  'metric_xacts', json_build_object(
+    'id', 'instance_id',
+    'columns', json_build_array('n_commit_s', 'n_rollback_s'),
+    'select', $_$
+      ROUND(SUM((record).n_commit)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0)),
+      ROUND(SUM((record).n_rollback)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0))
+    $_$
+  ),
+  'metric_wal_files', json_build_object(
+    'id', 'instance_id',
+    'columns', json_build_array('written_size_s'),
+    'select', $_$
+      ROUND(SUM((record).written_size)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0))
+    $_$
+  ),
+  'metric_process', json_build_object(
+    'id', 'host_id',
+    'columns', json_build_array('context_switches_s', 'forks_s'),
+    'select', $_$
+      ROUND(SUM((record).context_switches)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0)),
+      ROUND(SUM((record).forks)/NULLIF(extract('epoch' from MIN((record).measure_interval)), 0))
+    $_$
+  ),
+  'metric_cpu', json_build_object(
+    'id', 'host_id',
+    'columns', json_build_array('user_pct', 'system_pct', 'iowait_pct', 'steal_pct'),
+    'select', $_$
+      ROUND((SUM((record).time_user)/NULLIF(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal), 0)::FLOAT*100)::numeric, 1),
+      ROUND((SUM((record).time_system)/NULLIF(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal), 0)::FLOAT*100)::numeric, 1),
+      ROUND((SUM((record).time_iowait)/NULLIF(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal), 0)::FLOAT*100)::numeric, 1),
+      ROUND((SUM((record).time_steal)/NULLIF(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal), 0)::FLOAT*100)::numeric, 1)
+    $_$
+  )
+);
+$$;
+
+
+CREATE OR REPLACE FUNCTION aggregate_rates(i_table TEXT, i_period TEXT, i_since TIMESTAMPTZ)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_rates JSON := monitoring.rate_tables_config()->i_table;
+  v_id TEXT;
+  v_columns TEXT;
+  v_set TEXT;
+  i INTEGER;
+BEGIN
+  -- Compute rates of buckets from i_since onward, all buckets if NULL.
+  IF v_rates IS NULL THEN
+    RETURN 0;
+  END IF;
+  v_id := v_rates->>'id';
+  SELECT string_agg(quote_ident(c), ', '), string_agg(format('%I = EXCLUDED.%I', c, c), ', ')
+  INTO v_columns, v_set
+  FROM json_array_elements_text(v_rates->'columns') AS c;
+
+  EXECUTE format(
+    'INSERT INTO monitoring.%I (datetime, %I, %s) '
+    'SELECT datetime, %I, %s FROM monitoring.%I WHERE datetime >= %L GROUP BY datetime, %I '
+    'ON CONFLICT (%I, datetime) DO UPDATE SET %s',
+    i_table || '_' || i_period || '_rates', v_id, v_columns,
+    v_id, v_rates->>'select', i_table || '_' || i_period || '_current',
+    COALESCE(i_since, '-infinity'::TIMESTAMPTZ), v_id,
+    v_id, v_set
+  );
+  GET DIAGNOSTICS i = ROW_COUNT;
+  RETURN i;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_tables() RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  c JSON;
+  v_agg_periods TEXT[] := monitoring.rollup_periods();
+  v_create_tbl_cols_cur TEXT;
+  v_create_idx_cols_cur TEXT;
+  v_create_tbl_cols_hist TEXT;
+  v_create_idx_cols_hist TEXT;
+  v_tablename TEXT;
+  v_like_tablename TEXT;
+  v_rates JSON;
+  v_rates_cols TEXT;
+  v_since TIMESTAMPTZ;
+  v_partition_by_hist TEXT := '';
+  v_partition_by_agg TEXT := '';
+  i_period TEXT;
+BEGIN
+  IF current_setting('server_version_num')::INTEGER >= 110000 THEN
+    v_partition_by_hist := ' PARTITION BY RANGE (lower(history_range))';
+    v_partition_by_agg := ' PARTITION BY RANGE (datetime)';
+  END IF;
+
+  -- Tables creation if they do not exist
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_create_tbl_cols_cur := 'datetime TIMESTAMPTZ NOT NULL';
+    v_create_idx_cols_cur := 'datetime';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_cur := v_create_tbl_cols_cur||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_cur := v_create_idx_cols_cur||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+  -- Creation of current table.
+    v_tablename := trim((t->'name')::TEXT, '"')||'_current';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_cur||', record '||trim((t->'record_type')::TEXT, '"')||')';
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_cur||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Creation of history table.
+    v_create_tbl_cols_hist := 'history_range TSTZRANGE NOT NULL';
+    v_create_idx_cols_hist := 'history_range';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_hist := v_create_tbl_cols_hist||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_hist := v_create_idx_cols_hist||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+    v_tablename := trim((t->'name')::TEXT, '"')||'_history';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_hist||', records '||trim((t->'record_type')::TEXT, '"')||'[])'||v_partition_by_hist;
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_hist||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Aggregate tables creation.
+    FOREACH i_period IN ARRAY v_agg_periods LOOP
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_current';
+      v_like_tablename := trim((t->'name')::TEXT, '"')||'_current';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        -- Weight: number of record aggregated
+        EXECUTE 'CREATE TABLE '||v_tablename||' (LIKE '||v_like_tablename||', w INTEGER DEFAULT 1, UNIQUE ('||v_create_idx_cols_cur||'))'||v_partition_by_agg;
+        RETURN QUERY SELECT v_tablename;
+        IF v_partition_by_agg <> '' THEN
+          -- New tier is backfilled from oldest raw metrics.
+          EXECUTE format(
+            'SELECT LEAST((SELECT lower(history_range) FROM %I ORDER BY history_range LIMIT 1), (SELECT MIN(datetime) FROM %I))',
+            trim((t->'name')::TEXT, '"')||'_history', v_like_tablename
+          ) INTO v_since;
+          RETURN QUERY SELECT * FROM monitoring.create_partitions_since(v_tablename, v_since);
+        END IF;
+      END IF;
+
+      -- Rates tables creation.
+      v_rates := monitoring.rate_tables_config()->trim((t->'name')::TEXT, '"');
+      CONTINUE WHEN v_rates IS NULL;
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_rates';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        SELECT string_agg(quote_ident(c)||' NUMERIC', ', ') INTO v_rates_cols
+        FROM json_array_elements_text(v_rates->'columns') AS c;
+        EXECUTE format(
+          'CREATE TABLE %I (datetime TIMESTAMPTZ NOT NULL, %I INTEGER NOT NULL, %s, UNIQUE (%I, datetime))%s',
+          v_tablename, v_rates->>'id', v_rates_cols, v_rates->>'id', v_partition_by_agg
+        );
+        RETURN QUERY SELECT v_tablename;
+        IF v_partition_by_agg <> '' THEN
+          -- Rates are computed from existing rollups.
+          EXECUTE format(
+            'SELECT MIN(datetime) FROM %I',
+            trim((t->'name')::TEXT, '"')||'_'||i_period||'_current'
+          ) INTO v_since;
+          RETURN QUERY SELECT * FROM monitoring.create_partitions_since(v_tablename, v_since);
+        END IF;
+      END IF;
+    END LOOP;
+  END LOOP;
+
+  RETURN QUERY SELECT * FROM monitoring.create_partitions();
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION aggregate_data_single(table_name TEXT, record_type TEXT, query TEXT)
+RETURNS TABLE(tblname TEXT, nb_rows INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_agg_periods TEXT[] := monitoring.rollup_periods();
+  v_agg_table TEXT;
+  i_period TEXT;
+  v_query TEXT;
+  v_watermark TIMESTAMPTZ;
+  v_last_bucket TIMESTAMPTZ;
+  i INTEGER;
+BEGIN
+  FOREACH i_period IN ARRAY v_agg_periods LOOP
+    v_agg_table := table_name || '_' || i_period || '_current';
+    -- Lock watermark to serialize concurrent runs on the same rollup.
+    SELECT last_bucket INTO v_watermark
+    FROM monitoring.aggregate_watermarks
+    WHERE tablename = v_agg_table
+    FOR UPDATE;
+    IF NOT FOUND THEN
+      -- First run since upgrade, bootstrap from rollup content.
+      EXECUTE 'SELECT MAX(datetime) FROM monitoring.' || v_agg_table INTO v_watermark;
+    END IF;
+
+    -- Build and run 'aggregate' query for type of metric, restricted to
+    -- points from the watermark bucket onward.
+    v_query := replace(
+      query,
+      '(SELECT tstzrange(MAX(datetime), NOW()) FROM #agg_table#)',
+      quote_literal(tstzrange(v_watermark, NOW())) || '::TSTZRANGE'
+    );
+    v_query := replace(v_query, '#agg_table#', v_agg_table);
+    v_query := replace(v_query, '#interval#', i_period);
+    v_query := replace(v_query, '#record_type#', record_type);
+    v_query := replace(v_query, '#name#', table_name);
+    EXECUTE 'WITH upserted AS (' || v_query || ' RETURNING datetime) '
+      || 'SELECT COUNT(*), MAX(datetime) FROM upserted'
+    INTO i, v_last_bucket;
+
+    IF v_last_bucket IS NOT NULL THEN
+      INSERT INTO monitoring.aggregate_watermarks AS w (tablename, last_bucket)
+      VALUES (v_agg_table, v_last_bucket)
+      ON CONFLICT (tablename) DO UPDATE
+      SET last_bucket = GREATEST(w.last_bucket, EXCLUDED.last_bucket);
+    END IF;
+    PERFORM monitoring.aggregate_rates(table_name, i_period, v_watermark);
+    RETURN QUERY SELECT v_agg_table, i;
+  END LOOP;
+END;
+$$;
+
+
+-- Create rates tables and compute rates of existing rollups.
+SELECT * FROM create_tables();
+
+SELECT aggregate_rates(t, p, NULL)
+FROM json_object_keys(rate_tables_config()) AS t, UNNEST(rollup_periods()) AS p;
@@ -0,0 +1,27 @@
+-- Index _history tables on host or instance id and lower bound of
+-- history_range. Charts read raw points with static queries filtering
+-- _history rows on these columns before unnesting records, instead of
+-- expand_data_by_*() functions. A _history row holds at most one day of
+-- records, thus a lower bound condition is enough to select rows overlapping
+-- a time range. On partitioned tables, lower(history_range) is the partition
+-- key and the index cascades to all partitions.
+
+SET search_path TO monitoring, public;
+
+DO $$
+DECLARE
+  t JSON;
+  v_table TEXT;
+  v_id TEXT;
+BEGIN
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_table := (t->>'name')||'_history';
+    -- First column is either host_id or instance_id.
+    v_id := t->'columns'->0->>'name';
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON %I (%I, lower(history_range))',
+      'idx_'||v_table||'_'||v_id, v_table, v_id
+    );
+  END LOOP;
+END;
+$$;
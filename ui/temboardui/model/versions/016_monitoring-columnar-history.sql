@@ -0,0 +1,316 @@
+-- Store archived metrics as one array per record field instead of an array
+-- of composite records. A composite array element carries a tuple header and
+-- a null bitmap for each point, while a field array stores bare values, which
+-- TOAST compresses further. Readers detoast only the arrays of fields they
+-- use.
+--
+-- _history tables get a <field> <type>[] column for each field of their
+-- record type, including datetime. archive_current_metrics() fills these
+-- columns and leaves records NULL. Rows archived before this migration keep
+-- their records array until purged. Both formats are readable by
+-- expand_data*() functions through history_relation(). create_tables()
+-- creates new _history tables with field arrays.
+
+SET search_path TO monitoring, public;
+
+CREATE OR REPLACE FUNCTION record_fields(i_record_type TEXT)
+RETURNS TABLE(attnum INTEGER, attname TEXT, atttype TEXT)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT a.attnum::INTEGER, a.attname::TEXT, format_type(a.atttypid, a.atttypmod)
+  FROM pg_catalog.pg_type AS t
+  JOIN pg_catalog.pg_attribute AS a ON a.attrelid = t.typrelid
+  WHERE t.oid = ('monitoring.'||i_record_type)::regtype
+    AND a.attnum > 0 AND NOT a.attisdropped
+  ORDER BY a.attnum;
+$$;
+
+
+CREATE OR REPLACE FUNCTION history_relation(i_name TEXT)
+RETURNS TEXT
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+  t JSON := metric_tables_config()->i_name;
+  v_keys TEXT;
+  v_fields TEXT;
+  v_row TEXT;
+BEGIN
+  -- Returns a subquery of _history table exposing both legacy and columnar
+  -- rows as a records array, for queries written against the legacy format.
+  SELECT string_agg(quote_ident(c->>'name'), ', ') INTO v_keys
+  FROM json_array_elements(t->'columns') AS c;
+  SELECT string_agg(quote_ident(f.attname), ', ' ORDER BY f.attnum),
+         string_agg('u.'||quote_ident(f.attname), ', ' ORDER BY f.attnum)
+  INTO v_fields, v_row
+  FROM monitoring.record_fields(t->>'record_type') AS f;
+
+  RETURN format(
+    '(SELECT history_range, %s, COALESCE(records, ARRAY('
+    'SELECT ROW(%s)::%s FROM unnest(%s) AS u(%s)'
+    ')) AS records FROM %I) AS history',
+    v_keys, v_row, t->>'record_type', v_fields, v_fields,
+    (t->>'name')||'_history'
+  );
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_tables() RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  c JSON;
+  v_agg_periods TEXT[] := monitoring.rollup_periods();
+  v_create_tbl_cols_cur TEXT;
+  v_create_idx_cols_cur TEXT;
+  v_create_tbl_cols_hist TEXT;
+  v_create_idx_cols_hist TEXT;
+  v_fields_hist TEXT;
+  v_tablename TEXT;
+  v_like_tablename TEXT;
+  v_rates JSON;
+  v_rates_cols TEXT;
+  v_since TIMESTAMPTZ;
+  v_partition_by_hist TEXT := '';
+  v_partition_by_agg TEXT := '';
+  i_period TEXT;
+BEGIN
+  IF current_setting('server_version_num')::INTEGER >= 110000 THEN
+    v_partition_by_hist := ' PARTITION BY RANGE (lower(history_range))';
+    v_partition_by_agg := ' PARTITION BY RANGE (datetime)';
+  END IF;
+
+  -- Tables creation if they do not exist
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_create_tbl_cols_cur := 'datetime TIMESTAMPTZ NOT NULL';
+    v_create_idx_cols_cur := 'datetime';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_cur := v_create_tbl_cols_cur||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_cur := v_create_idx_cols_cur||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+  -- Creation of current table.
+    v_tablename := trim((t->'name')::TEXT, '"')||'_current';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_cur||', record '||trim((t->'record_type')::TEXT, '"')||')';
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_cur||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Creation of history table.
+    v_create_tbl_cols_hist := 'history_range TSTZRANGE NOT NULL';
+    v_create_idx_cols_hist := 'history_range';
+    FOR c IN SELECT json_array_elements(t->'columns') LOOP
+      v_create_tbl_cols_hist := v_create_tbl_cols_hist||', '||trim((c->'name')::TEXT, '"')||' '||trim((c->'data_type')::TEXT, '"');
+      v_create_idx_cols_hist := v_create_idx_cols_hist||', '||trim((c->'name')::TEXT, '"');
+    END LOOP;
+
+    v_tablename := trim((t->'name')::TEXT, '"')||'_history';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+    IF NOT FOUND THEN
+      -- Legacy records array and one array per record field.
+      SELECT string_agg(format('%I %s[]', f.attname, f.atttype), ', ' ORDER BY f.attnum) INTO v_fields_hist
+      FROM monitoring.record_fields(t->>'record_type') AS f;
+      EXECUTE 'CREATE TABLE '||v_tablename||' ('||v_create_tbl_cols_hist||', records '||trim((t->'record_type')::TEXT, '"')||'[], '||v_fields_hist||')'||v_partition_by_hist;
+      EXECUTE 'CREATE INDEX idx_'||v_tablename||' ON '||v_tablename||' ('||v_create_idx_cols_hist||')';
+      RETURN QUERY SELECT v_tablename;
+    END IF;
+
+    -- Aggregate tables creation.
+    FOREACH i_period IN ARRAY v_agg_periods LOOP
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_current';
+      v_like_tablename := trim((t->'name')::TEXT, '"')||'_current';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        -- Weight: number of record aggregated
+        EXECUTE 'CREATE TABLE '||v_tablename||' (LIKE '||v_like_tablename||', w INTEGER DEFAULT 1, UNIQUE ('||v_create_idx_cols_cur||'))'||v_partition_by_agg;
+        RETURN QUERY SELECT v_tablename;
+        IF v_partition_by_agg <> '' THEN
+          -- New tier is backfilled from oldest raw metrics.
+          EXECUTE format(
+            'SELECT LEAST((SELECT lower(history_range) FROM %I ORDER BY history_range LIMIT 1), (SELECT MIN(datetime) FROM %I))',
+            trim((t->'name')::TEXT, '"')||'_history', v_like_tablename
+          ) INTO v_since;
+          RETURN QUERY SELECT * FROM monitoring.create_partitions_since(v_tablename, v_since);
+        END IF;
+      END IF;
+
+      -- Rates tables creation.
+      v_rates := monitoring.rate_tables_config()->trim((t->'name')::TEXT, '"');
+      CONTINUE WHEN v_rates IS NULL;
+      v_tablename := trim((t->'name')::TEXT, '"')||'_'||i_period||'_rates';
+      PERFORM 1 FROM pg_tables WHERE tablename = v_tablename AND schemaname = current_schema();
+      IF NOT FOUND THEN
+        SELECT string_agg(quote_ident(c)||' NUMERIC', ', ') INTO v_rates_cols
+        FROM json_array_elements_text(v_rates->'columns') AS c;
+        EXECUTE format(
+          'CREATE TABLE %I (datetime TIMESTAMPTZ NOT NULL, %I INTEGER NOT NULL, %s, UNIQUE (%I, datetime))%s',
+          v_tablename, v_rates->>'id', v_rates_cols, v_rates->>'id', v_partition_by_agg
+        );
+        RETURN QUERY SELECT v_tablename;
+        IF v_partition_by_agg <> '' THEN
+          -- Rates are computed from existing rollups.
+          EXECUTE format(
+            'SELECT MIN(datetime) FROM %I',
+            trim((t->'name')::TEXT, '"')||'_'||i_period||'_current'
+          ) INTO v_since;
+          RETURN QUERY SELECT * FROM monitoring.create_partitions_since(v_tablename, v_since);
+        END IF;
+      END IF;
+    END LOOP;
+  END LOOP;
+
+  RETURN QUERY SELECT * FROM monitoring.create_partitions();
+END;
+$$;
+
+-- Add field arrays to _history tables. Adding nullable columns does not
+-- rewrite tables and cascades to partitions.
+DO $$
+DECLARE
+  t JSON;
+  f RECORD;
+BEGIN
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    FOR f IN SELECT * FROM record_fields(t->>'record_type') LOOP
+      EXECUTE format(
+        'ALTER TABLE %I ADD COLUMN IF NOT EXISTS %I %s[]',
+        (t->>'name')||'_history', f.attname, f.atttype
+      );
+    END LOOP;
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION archive_current_metrics(table_name TEXT, record_type TEXT, query TEXT)
+RETURNS TABLE(tblname TEXT, nb_rows INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_table_current TEXT;
+  v_table_history TEXT;
+  v_keys TEXT;
+  v_fields TEXT;
+  v_arrays TEXT;
+  i INTEGER;
+BEGIN
+  -- query is the legacy 'history' template of metric_tables_config(),
+  -- ignored since history is stored as field arrays.
+  v_table_current := table_name || '_current';
+  v_table_history := table_name || '_history';
+  SELECT string_agg(quote_ident(c->>'name'), ', ') INTO v_keys
+  FROM json_array_elements(metric_tables_config()->table_name->'columns') AS c;
+  -- datetime of records is NULL in _current tables.
+  SELECT string_agg(quote_ident(f.attname), ', ' ORDER BY f.attnum),
+         string_agg(
+           format('array_agg(%s ORDER BY datetime)', CASE
+             WHEN 'datetime' = f.attname THEN 'datetime'
+             ELSE '(record).'||quote_ident(f.attname) END),
+           ', ' ORDER BY f.attnum)
+  INTO v_fields, v_arrays
+  FROM monitoring.record_fields(record_type) AS f;
+
+  -- Lock _current table to prevent concurrent updates
+  EXECUTE 'LOCK TABLE ' || v_table_current || ' IN SHARE MODE';
+  -- Move data into _history table, one row per day and id.
+  EXECUTE format(
+    'INSERT INTO %I (history_range, %s, %s) '
+    'SELECT tstzrange(min(datetime), max(datetime), ''[]''), %s, %s FROM %I '
+    'GROUP BY date_trunc(''day'', datetime), %s',
+    v_table_history, v_keys, v_fields,
+    v_keys, v_arrays, v_table_current,
+    v_keys
+  );
+  GET DIAGNOSTICS i = ROW_COUNT;
+  -- Truncate _current table
+  EXECUTE 'TRUNCATE '||v_table_current;
+  -- Return each history table name and the number of rows inserted
+  RETURN QUERY SELECT v_table_history, i;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION build_expand_data_query(i_name TEXT, i_range TSTZRANGE) RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  v_query TEXT;
+BEGIN
+  SELECT metric_tables_config()->i_name INTO t;
+  v_query := t->>'expand';
+  v_query := replace(v_query, '#history_table#', monitoring.history_relation(i_name));
+  v_query := replace(v_query, '#current_table#', (t->>'name')||'_current');
+  v_query := replace(v_query, '#record_type#', t->>'record_type');
+  v_query := replace(v_query, '#where_current#', 'datetime <@ '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#where_history#', 'history_range && '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#tstzrange#', ''''||i_range::TEXT||'''::TSTZRANGE');
+  RETURN v_query;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION expand_data_by_host_id(i_name TEXT, i_range TSTZRANGE, host_id INTEGER) RETURNS SETOF RECORD
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  v_query TEXT;
+BEGIN
+  SELECT metric_tables_config()->i_name INTO t;
+  v_query := t->>'expand';
+  v_query := replace(v_query, '#history_table#', monitoring.history_relation(i_name));
+  v_query := replace(v_query, '#current_table#', (t->>'name')||'_current');
+  v_query := replace(v_query, '#record_type#', t->>'record_type');
+  v_query := replace(v_query, '#where_current#', 'host_id = '||host_id||' AND datetime <@ '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#where_history#', 'host_id = '||host_id||' AND history_range && '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#tstzrange#', ''''||i_range::TEXT||'''::TSTZRANGE');
+  RETURN QUERY EXECUTE v_query;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION expand_data_by_instance_id(i_name TEXT, i_range TSTZRANGE, instance_id INTEGER) RETURNS SETOF RECORD
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  v_query TEXT;
+BEGIN
+  SELECT metric_tables_config()->i_name INTO t;
+  v_query := t->>'expand';
+  v_query := replace(v_query, '#history_table#', monitoring.history_relation(i_name));
+  v_query := replace(v_query, '#current_table#', (t->>'name')||'_current');
+  v_query := replace(v_query, '#record_type#', t->>'record_type');
+  v_query := replace(v_query, '#where_current#', 'instance_id = '||instance_id||' AND datetime <@ '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#where_history#', 'instance_id = '||instance_id||' AND history_range && '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#tstzrange#', ''''||i_range::TEXT||'''::TSTZRANGE');
+  RETURN QUERY EXECUTE v_query;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION expand_data_by_dbname(i_name TEXT, i_range TSTZRANGE, instance_id INTEGER, dbname TEXT) RETURNS SETOF RECORD
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  v_query TEXT;
+BEGIN
+  SELECT metric_tables_config()->i_name INTO t;
+  v_query := t->>'expand';
+  v_query := replace(v_query, '#history_table#', monitoring.history_relation(i_name));
+  v_query := replace(v_query, '#current_table#', (t->>'name')||'_current');
+  v_query := replace(v_query, '#record_type#', t->>'record_type');
+  v_query := replace(v_query, '#where_current#', 'instance_id = '||instance_id||' AND dbname = '||quote_literal(dbname)||' AND datetime <@ '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#where_history#', 'instance_id = '||instance_id||' AND dbname = '||quote_literal(dbname)||' AND history_range && '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#tstzrange#', ''''||i_range::TEXT||'''::TSTZRANGE');
+  RETURN QUERY EXECUTE v_query;
+END;
+$$;
@@ -0,0 +1,6 @@
+-- Store the fingerprint of the agent inventory merged in monitoring hosts and
+-- instances tables. Collector tasks merge inventory again only when the
+-- fingerprint changes.
+
+ALTER TABLE "monitoring"."collector_status"
+ADD COLUMN "inventory_fingerprint" TEXT;
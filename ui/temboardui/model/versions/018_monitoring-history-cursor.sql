@@ -0,0 +1,6 @@
+-- Store the opaque cursor of the last monitoring history record stored, along
+-- with last_insert. Next collector task resumes history stream after this
+-- record.
+
+ALTER TABLE "monitoring"."collector_status"
+ADD COLUMN "history_cursor" TEXT;
@@ -0,0 +1,48 @@
+-- Bound the _history scan of aggregation by the rollup watermark.
+-- aggregate_data_single() reads points from the watermark onward with
+-- expand_data_limit(). The history_range && range condition can't use a
+-- btree index, so each run scanned the whole _history table. A _history row
+-- holds at most one day of records: add a lower bound on lower(history_range),
+-- indexed and used for partition pruning.
+
+SET search_path TO monitoring, public;
+
+DO $$
+DECLARE
+  t JSON;
+  v_table TEXT;
+BEGIN
+  FOR t IN SELECT metric_tables_config()->json_object_keys(metric_tables_config()) LOOP
+    v_table := (t->>'name')||'_history';
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON %I (lower(history_range))',
+      'idx_'||v_table||'_lower', v_table
+    );
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION build_expand_data_query(i_name TEXT, i_range TSTZRANGE) RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  t JSON;
+  v_query TEXT;
+  v_where_history TEXT;
+BEGIN
+  SELECT metric_tables_config()->i_name INTO t;
+  v_where_history := 'history_range && '''||i_range::TEXT||'''::TSTZRANGE';
+  IF NOT lower_inf(i_range) THEN
+    v_where_history := v_where_history||' AND lower(history_range) >= '''||lower(i_range)::TEXT||'''::TIMESTAMPTZ - INTERVAL ''1 day''';
+  END IF;
+  v_query := t->>'expand';
+  v_query := replace(v_query, '#history_table#', monitoring.history_relation(i_name));
+  v_query := replace(v_query, '#current_table#', (t->>'name')||'_current');
+  v_query := replace(v_query, '#record_type#', t->>'record_type');
+  v_query := replace(v_query, '#where_current#', 'datetime <@ '''||i_range::TEXT||'''::TSTZRANGE');
+  v_query := replace(v_query, '#where_history#', v_where_history);
+  v_query := replace(v_query, '#tstzrange#', ''''||i_range::TEXT||'''::TSTZRANGE');
+  RETURN v_query;
+END;
+$$;
@@ -0,0 +1,135 @@
+-- Add a DEFAULT partition to each partitioned monitoring table. A row out of
+-- pre-created months, e.g. when create_partitions worker did not run or on
+-- agent clock skew, lands in DEFAULT partition instead of failing the whole
+-- batch of archiving or aggregation. create_partition() moves rows of the new
+-- month out of DEFAULT partition.
+--
+-- DEFAULT partition and legacy partition converted from table, bounded from
+-- MINVALUE, are never dropped by drop_partitions(). Purge deletes their
+-- expired rows.
+
+SET search_path TO monitoring, public;
+
+CREATE OR REPLACE FUNCTION create_partition(i_parent TEXT, i_month TIMESTAMPTZ)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_start TIMESTAMP := date_trunc('month', i_month AT TIME ZONE 'UTC');
+  v_name TEXT := i_parent || to_char(v_start, '"_p"YYYYMM');
+  v_default TEXT := i_parent || '_default';
+  v_key TEXT;
+BEGIN
+  PERFORM 1 FROM pg_tables WHERE tablename = v_name AND schemaname = 'monitoring';
+  IF FOUND THEN
+    RETURN NULL;
+  END IF;
+  BEGIN
+    PERFORM 1 FROM pg_tables WHERE tablename = v_default AND schemaname = 'monitoring';
+    IF FOUND THEN
+      -- Move rows of the month out of DEFAULT partition, PostgreSQL refuses
+      -- to create a partition for rows stored in DEFAULT partition.
+      v_key := substring(
+        pg_get_partkeydef(format('monitoring.%I', i_parent)::regclass)
+        FROM 'RANGE \((.*)\)'
+      );
+      EXECUTE format(
+        'CREATE TEMPORARY TABLE pg_temp.%I (LIKE monitoring.%I)',
+        v_name, i_parent
+      );
+      EXECUTE format(
+        'WITH moved AS (DELETE FROM monitoring.%I WHERE %s >= %L AND %s < %L RETURNING *) '
+        'INSERT INTO pg_temp.%I SELECT * FROM moved',
+        v_default,
+        v_key, v_start AT TIME ZONE 'UTC',
+        v_key, (v_start + '1 month'::INTERVAL) AT TIME ZONE 'UTC',
+        v_name
+      );
+    END IF;
+    EXECUTE format(
+      'CREATE TABLE monitoring.%I PARTITION OF monitoring.%I FOR VALUES FROM (%L) TO (%L)',
+      v_name, i_parent,
+      v_start AT TIME ZONE 'UTC', (v_start + '1 month'::INTERVAL) AT TIME ZONE 'UTC'
+    );
+    IF v_key IS NOT NULL THEN
+      EXECUTE format(
+        'INSERT INTO monitoring.%I SELECT * FROM pg_temp.%I',
+        v_name, v_name
+      );
+      EXECUTE format('DROP TABLE pg_temp.%I', v_name);
+    END IF;
+  EXCEPTION WHEN invalid_object_definition THEN
+    -- Month is already covered by a partition converted from legacy table.
+    RETURN NULL;
+  END;
+  RETURN v_name;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION create_partitions(i_upcoming INTEGER DEFAULT 2)
+RETURNS TABLE(tblname TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_parent TEXT;
+  v_name TEXT;
+  i INTEGER;
+BEGIN
+  -- Ensure DEFAULT partition and partitions for current month and
+  -- i_upcoming next months exist.
+  FOR v_parent IN
+    SELECT c.relname
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'monitoring' AND c.relkind = 'p'
+    ORDER BY 1
+  LOOP
+    v_name := v_parent || '_default';
+    PERFORM 1 FROM pg_tables WHERE tablename = v_name AND schemaname = 'monitoring';
+    IF NOT FOUND THEN
+      EXECUTE format(
+        'CREATE TABLE monitoring.%I PARTITION OF monitoring.%I DEFAULT',
+        v_name, v_parent
+      );
+      RETURN QUERY SELECT v_name;
+    END IF;
+
+    FOR i IN 0..i_upcoming LOOP
+      v_name := monitoring.create_partition(
+        v_parent, date_trunc('month', NOW()) + i * '1 month'::INTERVAL
+      );
+      IF v_name IS NOT NULL THEN
+        RETURN QUERY SELECT v_name;
+      END IF;
+    END LOOP;
+  END LOOP;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION purged_partitions()
+RETURNS TABLE(tblname TEXT, parent TEXT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  -- Returns partitions not dropped by drop_partitions(), whose rows must be
+  -- purged: DEFAULT partitions and legacy partitions bounded from MINVALUE.
+  IF current_setting('server_version_num')::INTEGER < 110000 THEN
+    RETURN;
+  END IF;
+
+  RETURN QUERY
+  SELECT c.relname::TEXT, p.relname::TEXT
+  FROM pg_catalog.pg_inherits AS i
+  JOIN pg_catalog.pg_class AS c ON c.oid = i.inhrelid
+  JOIN pg_catalog.pg_class AS p ON p.oid = i.inhparent
+  JOIN pg_catalog.pg_namespace AS n ON n.oid = p.relnamespace
+  WHERE n.nspname = 'monitoring' AND p.relkind = 'p'
+    AND pg_get_expr(c.relpartbound, c.oid) ~ '^DEFAULT$|MINVALUE'
+  ORDER BY 1;
+END;
+$$;
+
+
+SELECT * FROM create_partitions();
@@ -14,17 +14,32 @@
 #   inventory.
 # - collector(host, port, key) inserts metrics history in metric_*_current
 #   table.
+# - collector_sweep(agents) queries all agents concurrently and stores
+#   history as agents respond. Enabled by collector_concurrency setting.
 # - history_tables_worker() move data from metric_*_current to
 #   metric_*_history, grouped by time range. metric table is truncated
-# - aggregate_data_worker() aggregates data in metric_*_30m_current and
-#   metric_*_6h_current.
+# - aggregate_data_worker() aggregates data in metric_*_<period>_current, for
+#   each period of monitoring.rollup_tiers: 5m, 30m, 6h and 1d by default.
+#   Rates and percentages charted from rollups are computed at the same time
+#   in metric_*_<period>_rates.
+# - Both workers above process metric tables concurrently, up to
+#   maintenance_concurrency tables at once.
+# - On PostgreSQL 11+, _history and aggregated tables are partitioned by
+#   month, with a DEFAULT partition for rows out of created months.
+#   create_partitions_worker() creates upcoming partitions and
+#   purge_data_worker() drops expired ones. Expired rows of DEFAULT
+#   partition and of legacy partition converted from table are deleted.
+# - create_partitions_worker() also creates tables of new rollup tiers.
 #
 
 from builtins import str
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+import http.client
 import logging
 import os
 import shutil
+from time import time
 try:
     from itertools import zip_longest
 except ImportError:
@@ -57,25 +72,24 @@ from temboardui.model import worker_engine
 
 from .model.orm import (
     Check,
-    CollectorStatus,
     Host,
     Instance,
 )
 from ...toolkit.errors import UserError
 from ...toolkit.configuration import OptionSpec
+from ...toolkit.http import ACCEPT_ENCODING
 from .model.db import insert_availability
 from .alerting import (
     check_specs,
 )
+from .chartdata import chart_cache
 from .handlers import blueprint
 from .tools import (
     check_preprocessed_data,
     get_host_id,
-    get_instance_checks,
     get_instance_id,
     insert_metrics,
-    merge_agent_info,
-    populate_host_checks,
+    inventory_cache,
     preprocess_data,
     update_collector_status,
     Stopwatch,
@@ -92,7 +106,11 @@ class MonitoringPlugin(object):
     except AttributeError:  # Python 2.7
         prometheus = None
     options_specs = [
+        OptionSpec(s, 'chart_cache_size', default=32, validator=int),
         OptionSpec(s, 'collect_max_duration', default=30, validator=int),
+        OptionSpec(s, 'collector_concurrency', default=0, validator=int),
+        OptionSpec(s, 'collector_timeout', default=30, validator=int),
+        OptionSpec(s, 'maintenance_concurrency', default=4, validator=int),
         OptionSpec(s, 'prometheus', default=prometheus, validator=v.file_),
     ]
 
@@ -108,6 +126,9 @@ class MonitoringPlugin(object):
         # Import Flask routes
         __import__(__name__ + '.routes')
         self.app.tornado_app.add_rules(blueprint.rules)
+        # Cache size is configured in MiB.
+        chart_cache.max_size = (
+            self.app.config.monitoring.chart_cache_size << 20)
         self.app.tornado_app.add_rules([
             (r"/js/monitoring/(.*)",
              tornado.web.StaticFileHandler,
@@ -121,35 +142,9 @@ class MonitoringPlugin(object):
 @workers.register(pool_size=1)
 def aggregate_data_worker(app):
     # Worker in charge of aggregate data
-    stopwatch = Stopwatch()
-    engine = worker_engine(app.config.repository)
-    with engine.connect() as conn:
-        conn.execute("SET search_path TO monitoring")
-        res = conn.execute("SELECT * FROM metric_tables_config()")
-        tables_config, = res.fetchone()
-        for config in tables_config.values():
-            logger.info("Aggregating data for metric %s.", config['name'])
-            try:
-                with conn.begin(), stopwatch:
-                    res = conn.execute(
-                        "SELECT * FROM aggregate_data_single(%s, %s, %s)", (
-                            config['name'], config['record_type'],
-                            config['aggregate'],
-                        )
-                    )
-                    # Call here pg_sleep() using conn.execute() to fake slow
-                    # aggregation.
-                    table_name, nb_rows = res.fetchone()
-                logger.debug(
-                    "table=%s insert=%s timedelta=%s",
-                    table_name, nb_rows, stopwatch.last_delta)
-            except Exception as e:
-                logger.error("Failed to archive data: %s.", e)
-                # search_path is lost on exception. Define it again.
-                conn.execute("SET search_path TO monitoring")
-
+    process_metric_tables(
+        app, 'aggregate_data_single', 'aggregate', 'aggregating')
     logger.info("Monitoring data aggregation done.")
-    logger.debug("Total time in SQL %s.", stopwatch.delta)
 
 
 @workers.schedule(id='history_tables', redo_interval=3 * 60 * 60)  # 3h
@@ -162,35 +157,61 @@ def history_tables_worker(app):
     #
     # This task is triggered every 3 hours by monitoring_boostrap() below.
     #
-    stopwatch = Stopwatch()
+    process_metric_tables(
+        app, 'archive_current_metrics', 'history', 'archiving')
+    logger.info("Monitoring data archiving done.")
+
+
+def process_metric_tables(app, function, target, action):
+    # Call SQL function for each metric table, one table per connection, on
+    # at most maintenance_concurrency connections. Total time is bound by the
+    # slowest table instead of the sum of all tables.
     engine = worker_engine(app.config.repository)
     with engine.connect() as conn:
-        conn.execute("SET search_path TO monitoring")
-        res = conn.execute("SELECT * FROM metric_tables_config()")
+        res = conn.execute("SELECT * FROM monitoring.metric_tables_config()")
         tables_config, = res.fetchone()
+
+    def process(config):
+        stopwatch = Stopwatch()
+        with engine.connect() as conn:
+            conn.execute("SET search_path TO monitoring")
+            with conn.begin(), stopwatch:
+                res = conn.execute(
+                    "SELECT * FROM %s(%%s, %%s, %%s)" % function, (
+                        config['name'], config['record_type'],
+                        config[target],
+                    )
+                )
+                # Call here pg_sleep() using conn.execute() to fake slow
+                # processing.
+                table_name, nb_rows = res.fetchone()
+        return table_name, nb_rows, stopwatch.last_delta
+
+    start = time()
+    total = timedelta()
+    concurrency = app.config.monitoring.maintenance_concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = dict()
         for config in tables_config.values():
-            logger.info("Archiving data for metric %s.", config['name'])
+            logger.info(
+                "%s data for metric %s.", action.title(), config['name'])
+            futures[executor.submit(process, config)] = config['name']
+
+        for future in as_completed(futures):
             try:
-                with conn.begin(), stopwatch:
-                    res = conn.execute(
-                        "SELECT * FROM archive_current_metrics(%s, %s, %s)", (
-                            config['name'], config['record_type'],
-                            config['history'],
-                        )
-                    )
-                    # Call here pg_sleep() using conn.execute() to fake slow
-                    # archiving.
-                    table_name, nb_rows = res.fetchone()
-                logger.debug(
-                    "table=%s insert=%s timedelta=%s",
-                    table_name, nb_rows, stopwatch.last_delta)
+                table_name, nb_rows, delta = future.result()
             except Exception as e:
-                logger.error("Failed to archive data: %s.", e)
-                # search_path is lost on exception. Define it again.
-                conn.execute("SET search_path TO monitoring")
+                logger.error(
+                    "Failed %s data for metric %s: %s.",
+                    action, futures[future], e)
+                continue
+            total += delta
+            logger.debug(
+                "table=%s insert=%s timedelta=%s", table_name, nb_rows, delta)
 
-    logger.info("Monitoring data archiving done.")
-    logger.debug("Total time in SQL %s.", stopwatch.delta)
+    logger.debug(
+        "Total time in SQL %s, elapsed %.3fs.", total, time() - start)
+    engine.dispose()
 
 
 @workers.register(pool_size=10)
@@ -228,7 +249,18 @@ def purge_data_worker(app):
     engine = worker_engine(app.config.repository)
 
     with engine.connect() as conn:
-        # Get tablename list to purge from metric_tables_config()
+        # Drop partitions before deleting rows from remaining tables.
+        with conn.begin():
+            res = conn.execute(
+                text("SELECT * FROM monitoring.drop_partitions("
+                     "NOW() - ':nday days'::INTERVAL)"),
+                nday=app.config.monitoring.purge_after,
+            )
+            for tablename, in res.fetchall():
+                logger.info("Dropped partition %s.", tablename)
+
+        # Get unpartitioned tablename list to purge from
+        # metric_tables_config()
         res = conn.execute(
             dedent("""
                 SELECT
@@ -238,28 +270,43 @@ def purge_data_worker(app):
                         tablename_prefix||'_'||suffix AS tablename
                     FROM
                         json_object_keys(monitoring.metric_tables_config()) AS tablename_prefix,
-                        UNNEST(ARRAY['30m_current', '6h_current', 'current', 'history']) AS suffix
+                        UNNEST(ARRAY['current', 'history'] || ARRAY(
+                            SELECT period||'_'||kind
+                            FROM UNNEST(monitoring.rollup_periods()) AS period,
+                                UNNEST(ARRAY['current', 'rates']) AS kind
+                        )) AS suffix
                 ) AS q
                 WHERE EXISTS (
                     SELECT 1
                     FROM
-                        pg_catalog.pg_tables AS pgt
+                        pg_catalog.pg_class AS c
+                        JOIN pg_catalog.pg_namespace AS n
+                            ON n.oid = c.relnamespace
                     WHERE
-                        pgt.tablename=q.tablename
-                        AND pgt.schemaname = 'monitoring'
+                        c.relname = q.tablename
+                        AND c.relkind = 'r'
+                        AND n.nspname = 'monitoring'
                 )
                 ORDER BY tablename;
             """)  # noqa
         )
-        tablenames = [r['tablename'] for r in res.fetchall()]
-        tablenames.extend(['state_changes', 'check_changes'])
+        tablenames = [
+            (r['tablename'], r['tablename']) for r in res.fetchall()]
+        # DEFAULT and legacy partitions are never dropped, delete their
+        # expired rows.
+        res = conn.execute("SELECT * FROM monitoring.purged_partitions()")
+        tablenames.extend(tuple(r) for r in res.fetchall())
+        tablenames.extend([
+            ('state_changes', 'state_changes'),
+            ('check_changes', 'check_changes'),
+        ])
 
         purge_query_base = "DELETE FROM :tablename WHERE "
 
-        for tablename in tablenames:
+        for tablename, parent in tablenames:
 
             # With history tables, we have to deal with tstzrange
-            if tablename.endswith("_history"):
+            if parent.endswith("_history"):
                 query = purge_query_base + \
                         "NOT (history_range && tstzrange(NOW() " + \
                         "- ':nday days'::INTERVAL, NOW()))"
@@ -289,6 +336,19 @@ def purge_data_worker(app):
     logger.info("End of monitoring data purge worker.")
 
 
+@workers.schedule(id='create_partitions', redo_interval=24 * 60 * 60)  # 24h
+@workers.register(pool_size=1)
+def create_partitions_worker(app):
+    # Create partitions of upcoming months for partitioned monitoring tables,
+    # and tables of rollup tiers added since last run.
+    engine = worker_engine(app.config.repository)
+    with engine.begin() as conn:
+        res = conn.execute("SELECT * FROM monitoring.create_tables()")
+        for tablename, in res.fetchall():
+            logger.info("Created table %s.", tablename)
+    engine.dispose()
+
+
 @workers.register(pool_size=1)
 def notify_state_change(app, check_id, key, value, state, prev_state):
     # check if at least one notifications transport is configured
@@ -402,8 +462,15 @@ def schedule_collector(app):
             "SELECT agent_address, agent_port, agent_key "
             "FROM application.instances ORDER BY 1, 2"
         )
+        rows = res.fetchall()
 
-        for batch in grouper(16, res.fetchall()):
+    if app.config.monitoring.collector_concurrency:
+        agents = [row.values() for row in rows]
+        logger.info(
+            "Scheduling concurrent collector for %s agents.", len(agents))
+        collector_sweep.defer(app, agents=agents)
+    else:
+        for batch in grouper(16, rows):
             batch = [row.values() for row in batch if row]
 
             logger.info(
@@ -429,60 +496,110 @@ def collector_batch(app, batch):
             logger.exception("Failed to collect %s:%s: %s", address, port, e)
 
 
+@workers.register(pool_size=1)
+def collector_sweep(app, agents):
+    # Concurrent collector. Query and store history of all agents at once,
+    # in threads. Each thread reads history stream of its agent while
+    # storing it. A sweep lasts about the time of the slowest agent.
+    concurrency = app.config.monitoring.collector_concurrency
+    timeout = app.config.monitoring.collector_timeout
+    # One repository connection per thread. Never wait for a connection
+    # used by another agent.
+    engine = worker_engine(
+        app.config.repository, pool_size=concurrency, max_overflow=0)
+    engine.connect().close()  # Warm pool.
+
+    def collect(address, port, key):
+        start = time()
+        payload = fetch_history(
+            app, engine, address, port, key, timeout=timeout)
+        if payload:
+            store_history(app, engine, *payload)
+        latency = time() - start
+        logger.debug("agent=%s:%s latency=%.3f", address, port, latency)
+        return latency
+
+    start = time()
+    latencies = dict()
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = dict()
+        for address, port, key in agents:
+            future = executor.submit(collect, address, port, key)
+            futures[future] = "%s:%s" % (address, port)
+
+        for future in as_completed(futures):
+            agent_id = futures[future]
+            try:
+                latencies[agent_id] = future.result()
+            except Exception as e:
+                errors += 1
+                logger.exception("Failed to collect %s: %s", agent_id, e)
+
+    logger.info(
+        "Collected %s agents in %.3fs with %s errors.",
+        len(agents), time() - start, errors)
+    if latencies:
+        agent_id, latency = max(latencies.items(), key=lambda i: i[1])
+        logger.info("Slowest agent is %s in %.3fs.", agent_id, latency)
+
+
 @workers.register(pool_size=20)
 def collector(app, address, port, key=None, engine=None):
+    engine = engine or worker_engine(app.config.repository)
+    payload = fetch_history(app, engine, address, port, key)
+    if payload:
+        store_history(app, engine, *payload)
+
+
+def fetch_history(app, engine, address, port, key=None, timeout=None):
+    # Query monitoring history from agent. Returns a tuple of arguments for
+    # store_history() or None if agent is not available.
     agent_id = "%s:%s" % (address, port)
     logger.info("Starting monitoring collector for %s.", agent_id)
 
     client = TemboardAgentClient.factory(app.config, address, port, key)
+    if timeout:
+        client.timeout = timeout
     # Start new ORM DB session
-    engine = engine or worker_engine(app.config.repository)
     worker_session = Session(bind=engine)
 
     instance = get_instance(worker_session, address, port)
     worker_session.expunge(instance)
-    host_id = instance_id = None
-    # Agent monitoring API endpoint
+    # Agent monitoring API endpoint. Agent streaming history ignores limit.
     history_url = '/monitoring/history?limit=100'
-    try:
-        # Trying to find host_id, instance_id and the datetime of the latest
-        # inserted record.
-
-        # Find host_id and instance_id by hostname and PG port
-        host_id = get_host_id(worker_session, instance.hostname)
-        instance_id = get_instance_id(
-            worker_session,
-            host_id,
-            instance.pg_port
-        )
-        logger.info(
-            "Found host #%s and instance #%s %s.",
-            host_id, instance_id, instance)
-    except Exception:
-        # This case happens on the very first pull when no data have been
-        # previously added.
-        logger.debug(
-            "Could not find host or instance records in monitoring inventory "
-            "tables for %s.", instance,
-        )
-    else:
-        # Get last inserted data timestamp from collector status
-        collector_status = worker_session.query(CollectorStatus).filter(
-            CollectorStatus.instance_id == instance_id
-        ).first()
-
-        if collector_status and collector_status.last_insert:
-            start = (
-                collector_status.last_insert + timedelta(seconds=1)
-            ).strftime("%Y-%m-%dT%H:%M:%SZ")
-            history_url += "&start=%s" % start
+    entry = inventory_cache.get(agent_id)
+    if not entry:
+        entry = lookup_inventory(worker_session, agent_id, instance)
+    instance_id = entry['instance_id'] if entry else None
+
+    if entry and entry['last_insert']:
+        start = (
+            entry['last_insert'] + timedelta(seconds=1)
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        # Agent without history cursor support ignores cursor and returns
+        # history from start.
+        history_url += "&start=%s" % start
+        if entry.get('cursor'):
+            history_url += "&cursor=%s" % entry['cursor']
+    # Release repository connection while waiting for agent.
+    worker_session.commit()
 
     # Finally, let's call /monitoring/history agent API for getting metrics
     # history.
     try:
         logger.info("Querying monitoring history from %s.", instance)
-        response = client.get(history_url)
+        if timeout:
+            # Stop querying agent after timeout, from connection to reading
+            # history, even if agent still sends data.
+            client.deadline = time() + timeout
+        # Stream history as newline delimited JSON, if supported by agent.
+        response = client.get(history_url, headers={
+            'Accept': 'application/x-ndjson',
+            'Accept-Encoding': ACCEPT_ENCODING,
+        })
         response.raise_for_status()
+        rows = response.iter_json()
     except (OSError, client.ConnectionError, client.Error) as e:
         logger.error("Failed to query history for %s: %s", instance, e)
         logger.error("Agent or host may be down or misconfigured.")
@@ -495,14 +612,43 @@ def collector(app, address, port, key=None, engine=None):
                 last_pull=datetime.utcnow(),
             )
             worker_session.commit()
-        worker_session.close()
         return
-    else:
-        rows = response.json()
+    finally:
+        worker_session.close()
+
+    discover_etag = response.headers.get('X-TemBoard-Discover-ETag')
+    return instance, instance_id, discover_etag, rows
+
+
+def lookup_inventory(session, agent_id, instance):
+    # Returns monitoring inventory entry of instance, or None.
+    try:
+        # Find host_id and instance_id by hostname and PG port
+        host_id = get_host_id(session, instance.hostname)
+        instance_id = get_instance_id(session, host_id, instance.pg_port)
+        logger.info(
+            "Found host #%s and instance #%s %s.",
+            host_id, instance_id, instance)
+    except Exception:
+        # This case happens on the very first pull when no data have been
+        # previously added.
+        logger.debug(
+            "Could not find host or instance records in monitoring inventory "
+            "tables for %s.", instance,
+        )
+        return None
+
+    return inventory_cache.load(session, agent_id, host_id, instance_id)
+
+
+def store_history(app, engine, instance, instance_id, discover_etag, rows):
+    # Store monitoring history rows fetched by fetch_history().
+    address, port = instance.agent_address, instance.agent_port
+    agent_id = "%s:%s" % (address, port)
+    worker_session = Session(bind=engine)
 
     # monitoring is still the better place to queue a discover. This allow us
     # to have sub-minute reactivity on instance change.
-    discover_etag = response.headers.get('X-TemBoard-Discover-ETag')
     if discover_etag:
         if discover_etag != instance.discover_etag:
             logger.info("Detected discover data changes.")
@@ -514,10 +660,9 @@ def collector(app, address, port, key=None, engine=None):
     else:
         logger.debug("Agent did not send discover ETag.")
 
-    if not rows:
-        logger.info("Instance %s returned no monitoring data.", instance)
-
-    for row in rows:
+    count = 0
+    for row in iter_history(instance, rows):
+        count += 1
         logger.info("Got points for %s at %s.", instance, row['datetime'])
         hostinfo = row['hostinfo']
         data = row['data']
@@ -525,11 +670,11 @@ def collector(app, address, port, key=None, engine=None):
 
         try:
             # Try to insert collected data
-
-            logger.info("Update the inventory for %s.", instance)
-            host = merge_agent_info(worker_session, hostinfo, instance_d)
-            instance_id = get_instance_id(
-                worker_session, host.host_id, instance.pg_port)
+            entry = inventory_cache.resolve(
+                worker_session, agent_id, instance.pg_port,
+                hostinfo, instance_d, discover_etag,
+            )
+            host_id, instance_id = entry['host_id'], entry['instance_id']
             logger.info("Insert instance availability for %s.", instance)
             insert_availability(
                 worker_session,
@@ -540,7 +685,7 @@ def collector(app, address, port, key=None, engine=None):
             worker_session.commit()
             logger.info("Insert collected metrics for %s.", instance)
             insert_metrics(
-                worker_session, host.host_id, instance_id, data, dict(
+                worker_session, host_id, instance_id, data, dict(
                     agent=agent_id,
                     timestamp=(
                         # transform to ISOFORMAT (same as journalctl)
@@ -569,40 +714,39 @@ def collector(app, address, port, key=None, engine=None):
             logger.exception(str(e))
             worker_session.rollback()
             if instance_id:
-                logger.info("Set collector status to FAIL for %s.", host)
+                logger.info("Set collector status to FAIL for %s.", instance)
                 update_collector_status(
                     worker_session,
                     instance_id,
                     u'FAIL',
                     last_pull=datetime.utcnow(),
                     last_insert=last_insert,
+                    history_cursor=row.get('cursor'),
                 )
                 worker_session.commit()
+                if agent_id in inventory_cache:
+                    inventory_cache[agent_id].update(
+                        cursor=row.get('cursor'), last_insert=last_insert)
             logger.info("Continue with the next row.")
             continue
 
         logger.debug("Update collector status for agent %s.", agent_id)
+        # This is the datetime format used by the agent
+        entry['last_insert'] = datetime.strptime(
+            row['datetime'], "%Y-%m-%d %H:%M:%S +0000")
+        entry['cursor'] = row.get('cursor')
         update_collector_status(
             worker_session,
             instance_id,
             u'OK',
             last_pull=datetime.utcnow(),
-            # This is the datetime format used by the agent
-            last_insert=datetime.strptime(
-                row['datetime'], "%Y-%m-%d %H:%M:%S +0000"
-            ),
-        )
-        worker_session.commit()
-        logger.info("Populate checks for %s.", host)
-        # ALERTING PART
-        populate_host_checks(
-            worker_session,
-            host.host_id,
-            instance_id,
-            dict(n_cpu=hostinfo['cpu_count']),
+            last_insert=entry['last_insert'],
+            inventory_fingerprint=entry['fingerprint'],
+            history_cursor=entry['cursor'],
         )
         worker_session.commit()
 
+        # ALERTING PART
         logger.info(
             "Apply alerting checks against preprocessed data for agent %s.",
             agent_id)
@@ -618,13 +762,10 @@ def collector(app, address, port, key=None, engine=None):
             check_preprocessed_data(
                 app,
                 worker_session,
-                host.host_id,
+                host_id,
                 instance_id,
                 preprocess_data(
-                    row['data'],
-                    get_instance_checks(worker_session, instance_id),
-                    row['datetime']
-                ),
+                    row['data'], entry['checks'], row['datetime']),
             )
         except Exception:
             logger.exception("Failed to check monitoring data for alerting.")
@@ -632,5 +773,19 @@ def collector(app, address, port, key=None, engine=None):
         logger.debug("Row with datetime=%s inserted", row['datetime'])
         worker_session.commit()
 
+    if not count:
+        logger.info("Instance %s returned no monitoring data.", instance)
     worker_session.close()
     logger.info("End of collector for agent %s.", agent_id)
+
+
+def iter_history(instance, rows):
+    # Yields history rows until end of stream or error. Each row is committed
+    # before reading the next one, so an interrupted stream resumes after the
+    # last stored row on next pull.
+    try:
+        for row in rows:
+            yield row
+    except (OSError, ValueError, http.client.HTTPException,
+            TemboardAgentClient.ConnectionError) as e:
+        logger.error("Failed to read history from %s: %s", instance, e)
@@ -4,11 +4,20 @@ try:
 except Exception:
     # python3
     from io import StringIO
+import calendar
 import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
 from textwrap import dedent
 
 from psycopg2.extensions import AsIs
 
+from .downsample import downsample_columns, downsample_csv
+from .model.db import METRIC_TABLES
 from .pivot import pivot_timeserie
 
 
@@ -19,20 +28,21 @@ SELECT
     datetime AS date,
     ROUND(SUM((record).blks_read)/(extract('epoch' from MIN((record).measure_interval)))) AS blks_read_s,
     ROUND(SUM((record).blks_hit)/(extract('epoch' from MIN((record).measure_interval)))) AS blks_hit_s
-FROM expand_data_by_instance_id('metric_blocks', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_blocks_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    ROUND(SUM((record).blks_read)/(extract('epoch' from MIN((record).measure_interval)))) AS blks_read_s,
-    ROUND(SUM((record).blks_hit)/(extract('epoch' from MIN((record).measure_interval)))) AS blks_hit_s
+    blks_read_s,
+    blks_hit_s
 FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime, instance_id ORDER BY 1,2 ASC
+ORDER BY 1
         """,  # noqa
         probename='blocks',
+        expand=('metric_blocks', 'instance_id', 'dbname'),
+        rates=True,
     ),
     checkpoints=dict(
         sql_nozoom="""
@@ -42,8 +52,7 @@ SELECT
     (record).checkpoints_req AS req,
     ROUND(((record).checkpoint_write_time/1000)::numeric, 1) AS write_time,
     ROUND(((record).checkpoint_sync_time/1000)::numeric,1) AS sync_time
-FROM expand_data_by_instance_id('metric_bgwriter', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_bgwriter_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -57,6 +66,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='bgwriter',
+        expand=('metric_bgwriter', 'instance_id'),
     ),
     cpu=dict(
         sql_nozoom="""
@@ -66,22 +76,23 @@ SELECT
     round((SUM((record).time_system)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS system,
     round((SUM((record).time_iowait)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS iowait,
     round((SUM((record).time_steal)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS steal
-FROM expand_data_by_host_id('metric_cpu', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, cpu text, record metric_cpu_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, host_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    round((SUM((record).time_user)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS user,
-    round((SUM((record).time_system)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS system,
-    round((SUM((record).time_iowait)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS iowait,
-    round((SUM((record).time_steal)/(SUM((record).time_user)+SUM((record).time_system)+SUM((record).time_idle)+SUM((record).time_iowait)+SUM((record).time_steal))::float*100)::numeric, 1) AS steal
+    user_pct AS user,
+    system_pct AS system,
+    iowait_pct AS iowait,
+    steal_pct AS steal
 FROM %(tablename)s
 WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime, host_id ORDER BY datetime
+ORDER BY 1
         """,  # noqa
         probename='cpu',
+        expand=('metric_cpu', 'host_id', 'cpu'),
+        rates=True,
     ),
     cpu_core=dict(
         sql_nozoom="""
@@ -91,8 +102,7 @@ SELECT
     round(((record).time_system/((record).time_user+(record).time_system+(record).time_idle+(record).time_iowait+(record).time_steal)::float*100)::numeric, 1) AS system,
     round(((record).time_iowait/((record).time_user+(record).time_system+(record).time_idle+(record).time_iowait+(record).time_steal)::float*100)::numeric, 1) AS iowait,
     round(((record).time_steal/((record).time_user+(record).time_system+(record).time_idle+(record).time_iowait+(record).time_steal)::float*100)::numeric, 1) AS steal
-FROM expand_data_by_host_id('metric_cpu', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, cpu text, record metric_cpu_record)
+FROM %(expand)s AS expand
 WHERE cpu = %(key)s
 ORDER BY datetime
         """,  # noqa
@@ -108,6 +118,7 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s AN
 ORDER BY datetime
         """,  # noqa
         probename='cpu',
+        expand=('metric_cpu', 'host_id', 'cpu'),
     ),
     ctxforks=dict(
         sql_nozoom="""
@@ -115,20 +126,21 @@ SELECT
     datetime AS date,
     round(SUM((record).context_switches)/(extract('epoch' from MIN((record).measure_interval)))) AS context_switches_s,
     round(SUM((record).forks)/(extract('epoch' from MIN((record).measure_interval)))) AS forks_s
-FROM expand_data_by_host_id('metric_process', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_process_record)
+FROM %(expand)s AS expand
 GROUP BY datetime ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    round(SUM((record).context_switches)/(extract('epoch' from MIN((record).measure_interval)))) AS context_switches_s,
-    round(SUM((record).forks)/(extract('epoch' from MIN((record).measure_interval)))) AS forks_s
+    context_switches_s,
+    forks_s
 FROM %(tablename)s
 WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime ORDER BY datetime
-        """,  # noqa,
+ORDER BY 1
+        """,  # noqa
         probename='process',
+        expand=('metric_process', 'host_id'),
+        rates=True,
     ),
     db_size=dict(
         sql_nozoom="""
@@ -136,8 +148,7 @@ SELECT
     datetime AS date,
     dbname,
     (record).size
-FROM expand_data_by_instance_id('metric_db_size', tstzrange(%(start)s, %(end)s), %(instance_id))
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_db_size_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -149,6 +160,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY datetime, dbname
         """,  # noqa
         probename='db_size',
+        expand=('metric_db_size', 'instance_id', 'dbname'),
         pivot=dict(
             index='date',
             key='dbname',
@@ -161,8 +173,7 @@ SELECT
     datetime AS date,
     mount_point,
     (record).used AS size
-FROM expand_data_by_host_id('metric_filesystems_size', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, mount_point text, record metric_filesystems_size_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -174,6 +185,7 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='filesystems_size',
+        expand=('metric_filesystems_size', 'host_id', 'mount_point'),
         pivot=dict(
             index='date',
             key='mount_point',
@@ -186,8 +198,7 @@ SELECT
     datetime AS date,
     mount_point,
     round((((record).used::FLOAT/(record).total::FLOAT)*100)::numeric, 1) AS usage
-FROM expand_data_by_host_id('metric_filesystems_size', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, mount_point text, record metric_filesystems_size_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -199,6 +210,7 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY 1,2 ASC
         """,  # noqa,
         probename='filesystems_size',
+        expand=('metric_filesystems_size', 'host_id', 'mount_point'),
         pivot=dict(
             index='date',
             key='mount_point',
@@ -210,8 +222,7 @@ ORDER BY 1,2 ASC
 SELECT
     datetime AS date,
     round((((record).used::FLOAT/(record).total::FLOAT)*100)::numeric, 1) AS usage
-FROM expand_data_by_host_id('metric_filesystems_size', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, mount_point text, record metric_filesystems_size_record)
+FROM %(expand)s AS expand
 WHERE mount_point = %(key)s
         """,  # noqa
         sql_zoom="""
@@ -223,6 +234,7 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s AN
 ORDER BY 1,2 ASC
         """,  # noqa,
         probename='filesystems_size',
+        expand=('metric_filesystems_size', 'host_id', 'mount_point'),
     ),
     hitreadratio=dict(
         sql_nozoom="""
@@ -231,21 +243,20 @@ SELECT
     CASE WHEN (SUM((record).blks_hit) + SUM((record).blks_read)) > 0
     THEN ROUND((SUM((record).blks_hit)::FLOAT/(SUM((record).blks_hit) + SUM((record).blks_read)::FLOAT) * 100)::numeric, 2)
     ELSE 100 END AS hit_read_ratio
-FROM expand_data_by_instance_id('metric_blocks', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_blocks_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    CASE WHEN (SUM((record).blks_hit) + SUM((record).blks_read)) > 0
-    THEN ROUND((SUM((record).blks_hit)::FLOAT/(SUM((record).blks_hit) + SUM((record).blks_read)::FLOAT) * 100)::numeric, 2)
-    ELSE 100 END AS hit_read_ratio
+    hit_read_ratio
 FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime, instance_id ORDER BY 1,2 ASC
+ORDER BY 1
         """,  # noqa
         probename='blocks',
+        expand=('metric_blocks', 'instance_id', 'dbname'),
+        rates=True,
     ),
     hitreadratio_db=dict(
         sql_nozoom="""
@@ -254,8 +265,7 @@ SELECT
     CASE WHEN ((record).blks_hit + (record).blks_read) > 0
     THEN ROUND((((record).blks_hit::FLOAT/((record).blks_hit + (record).blks_read)::FLOAT) * 100)::numeric, 2)
     ELSE 100 END AS hit_read_ratio
-FROM expand_data_by_instance_id('metric_blocks', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_blocks_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 ORDER BY datetime
         """,  # noqa
@@ -270,14 +280,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='blocks',
+        expand=('metric_blocks', 'instance_id', 'dbname'),
     ),
     instance_size=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     SUM((record).size) AS size
-FROM expand_data_by_instance_id('metric_db_size', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_db_size_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
@@ -289,6 +299,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 GROUP BY datetime, instance_id ORDER BY 1,2 ASC
         """,  # noqa
         probename='db_size',
+        expand=('metric_db_size', 'instance_id', 'dbname'),
     ),
     loadavg=dict(
         sql_nozoom="""
@@ -297,8 +308,7 @@ SELECT
     (record).load1,
     (record).load5,
     (record).load15
-FROM expand_data_by_host_id( 'metric_loadavg', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_loadavg_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -310,14 +320,14 @@ FROM %(tablename)s WHERE host_id = %(host_id)s AND datetime >= %(start)s AND dat
 ORDER BY datetime ASC
         """,  # noqa
         probename='loadavg',
+        expand=('metric_loadavg', 'host_id'),
     ),
     load1=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).load1
-FROM expand_data_by_host_id( 'metric_loadavg', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_loadavg_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -327,6 +337,7 @@ FROM %(tablename)s WHERE host_id = %(host_id)s AND datetime >= %(start)s AND dat
 ORDER BY datetime ASC
         """,  # noqa
         probename='loadavg',
+        expand=('metric_loadavg', 'host_id'),
     ),
     locks=dict(
         sql_nozoom="""
@@ -341,8 +352,7 @@ SELECT
     SUM((record).exclusive) AS exclusive,
     SUM((record).access_exclusive) AS access_exclusive,
     SUM((record).siread) AS siread
-FROM expand_data_by_instance_id('metric_locks', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_locks_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
@@ -361,6 +371,7 @@ FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 GROUP BY datetime, instance_id ORDER BY 1,2 ASC        """,  # noqa
         probename='locks',
+        expand=('metric_locks', 'instance_id', 'dbname'),
     ),
     memory=dict(
         sql_nozoom="""
@@ -370,8 +381,7 @@ SELECT
     (record).mem_cached AS cached,
     (record).mem_buffers AS buffers,
     ((record).mem_used - (record).mem_cached - (record).mem_buffers) AS other
-FROM expand_data_by_host_id('metric_memory', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_memory_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -385,14 +395,14 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY datetime
         """,  # noqa
         probename='memory',
+        expand=('metric_memory', 'host_id'),
     ),
     memory_usage=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     round(((((record).mem_total - (record).mem_free - (record).mem_cached)::FLOAT/(record).mem_total::FLOAT)*100)::numeric, 1) AS usage
-FROM expand_data_by_host_id('metric_memory', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_memory_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -403,14 +413,14 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY datetime
         """,  # noqa
         probename='memory',
+        expand=('metric_memory', 'host_id'),
     ),
     rollback_db=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     SUM((record).n_rollback) AS rollback
-FROM expand_data_by_instance_id('metric_xacts', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_xacts_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
@@ -423,6 +433,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         probename='xacts',
+        expand=('metric_xacts', 'instance_id', 'dbname'),
     ),
     sessions=dict(
         sql_nozoom="""
@@ -435,8 +446,7 @@ SELECT
     SUM((record).idle_in_xact_aborted) AS idle_in_xact_aborted,
     SUM((record).fastpath) AS fastpath,
     SUM((record).disabled) AS disabled
-FROM expand_data_by_instance_id('metric_sessions', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_sessions_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
@@ -454,14 +464,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 GROUP BY datetime, instance_id ORDER BY 1,2 ASC
         """,  # noqa,
         probename='sessions',
+        expand=('metric_sessions', 'instance_id', 'dbname'),
     ),
     sessions_usage=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     round(((SUM((record).active + (record).waiting + (record).idle + (record).idle_in_xact + (record).idle_in_xact_aborted + (record).fastpath + (record).disabled)::FLOAT/(SELECT setting FROM pg_settings WHERE name = 'max_connections')::FLOAT)*100)::numeric, 1) AS session_usage
-FROM expand_data_by_instance_id('metric_sessions', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_sessions_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
@@ -473,14 +483,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 GROUP BY datetime, instance_id ORDER BY 1,2 ASC
         """,  # noqa,
         probename='sessions',
+        expand=('metric_sessions', 'instance_id', 'dbname'),
     ),
     swap=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).swap_used AS used
-FROM expand_data_by_host_id('metric_memory', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_memory_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -491,14 +501,14 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY datetime
         """,  # noqa
         probename='memory',
+        expand=('metric_memory', 'host_id'),
     ),
     swap_usage=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     round((((record).swap_used::FLOAT/(record).swap_total::FLOAT)*100)::numeric, 1) AS usage
-FROM expand_data_by_host_id('metric_memory', tstzrange(%(start)s, %(end)s), %(host_id)s)
-AS (datetime timestamp with time zone, host_id integer, record metric_memory_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -509,6 +519,7 @@ WHERE host_id = %(host_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 ORDER BY datetime
         """,  # noqa
         probename='memory',
+        expand=('metric_memory', 'host_id'),
     ),
     tblspc_size=dict(
         sql_nozoom="""
@@ -516,8 +527,7 @@ SELECT
     datetime AS date,
     spcname,
     (record).size
-FROM expand_data_by_instance_id('metric_tblspc_size', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, spcname text, record metric_tblspc_size_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -529,6 +539,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa,
         probename='tblspc_size',
+        expand=('metric_tblspc_size', 'instance_id', 'spcname'),
         pivot=dict(
             index='date',
             key='spcname',
@@ -541,20 +552,21 @@ SELECT
     datetime AS date,
     round(SUM((record).n_commit)/(extract('epoch' from MIN((record).measure_interval)))) AS commit,
     round(SUM((record).n_rollback)/(extract('epoch' from MIN((record).measure_interval)))) AS rollback
-FROM expand_data_by_instance_id('metric_xacts', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_xacts_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    round(SUM((record).n_commit)/(extract('epoch' from MIN((record).measure_interval)))) AS commit,
-    round(SUM((record).n_rollback)/(extract('epoch' from MIN((record).measure_interval)))) AS rollback
+    n_commit_s AS commit,
+    n_rollback_s AS rollback
 FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime, instance_id ORDER BY datetime
+ORDER BY 1
         """,  # noqa
         probename='xacts',
+        expand=('metric_xacts', 'instance_id', 'dbname'),
+        rates=True,
     ),
     waiting_locks=dict(
         sql_nozoom="""
@@ -568,8 +580,7 @@ SELECT
     SUM((record).waiting_share_row_exclusive) AS share_row_exclusive,
     SUM((record).waiting_exclusive) AS exclusive,
     SUM((record).waiting_access_exclusive) AS access_exclusive
-FROM expand_data_by_instance_id('metric_locks', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_locks_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
@@ -587,15 +598,15 @@ FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
 GROUP BY datetime, instance_id ORDER BY 1,2 ASC
         """,  # noqa
-        probename='locks'
+        probename='locks',
+        expand=('metric_locks', 'instance_id', 'dbname'),
     ),
     waiting_sessions_db=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).waiting
-FROM expand_data_by_instance_id('metric_sessions', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_sessions_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 ORDER BY datetime
         """,  # noqa
@@ -607,7 +618,8 @@ FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s AND dbname = %(key)s
 ORDER BY 1,2 ASC
         """,  # noqa
-        probename='sessions'
+        probename='sessions',
+        expand=('metric_sessions', 'instance_id', 'dbname'),
     ),
     wal_files_size=dict(
         sql_nozoom="""
@@ -615,8 +627,7 @@ SELECT
     datetime AS date,
     (record).written_size,
     (record).total_size
-FROM expand_data_by_instance_id('metric_wal_files', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_wal_files_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -628,14 +639,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='wal_files',
+        expand=('metric_wal_files', 'instance_id'),
     ),
     wal_files_archive=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).archive_ready
-FROM expand_data_by_instance_id('metric_wal_files', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_wal_files_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -646,6 +657,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='wal_files',
+        expand=('metric_wal_files', 'instance_id'),
     ),
     wal_files_count=dict(
         sql_nozoom="""
@@ -653,8 +665,7 @@ SELECT
     datetime AS date,
     (record).archive_ready,
     (record).total
-FROM expand_data_by_instance_id('metric_wal_files', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_wal_files_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -666,33 +677,34 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='wal_files',
+        expand=('metric_wal_files', 'instance_id'),
     ),
     wal_files_rate=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     round(SUM((record).written_size)/(extract('epoch' from MIN((record).measure_interval)))) AS written_size_s
-FROM expand_data_by_instance_id('metric_wal_files', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_wal_files_record)
+FROM %(expand)s AS expand
 GROUP BY datetime, instance_id ORDER BY datetime
         """,  # noqa
         sql_zoom="""
 SELECT
     datetime AS date,
-    round(SUM((record).written_size)/(extract('epoch' from MIN((record).measure_interval)))) AS written_size_s
+    written_size_s
 FROM %(tablename)s
 WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(end)s
-GROUP BY datetime, instance_id ORDER BY 1,2 ASC
+ORDER BY 1
         """,  # noqa
         probename='wal_files',
+        expand=('metric_wal_files', 'instance_id'),
+        rates=True,
     ),
     wal_files_total=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).total
-FROM expand_data_by_instance_id('metric_wal_files', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_wal_files_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -703,6 +715,7 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='wal_files',
+        expand=('metric_wal_files', 'instance_id'),
     ),
     w_buffers=dict(
         sql_nozoom="""
@@ -711,8 +724,7 @@ SELECT
     (record).buffers_checkpoint AS checkpoint,
     (record).buffers_clean AS clean,
     (record).buffers_backend AS backend
-FROM expand_data_by_instance_id('metric_bgwriter', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_bgwriter_record)
+FROM %(expand)s AS expand
         """,  # noqa
         sql_zoom="""
 SELECT
@@ -725,14 +737,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1,2 ASC
         """,  # noqa
         probename='bgwriter',
+        expand=('metric_bgwriter', 'instance_id'),
     ),
     replication_lag=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).lag AS lag
-FROM expand_data_by_instance_id('metric_replication_lag', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, record metric_replication_lag_record)
+FROM %(expand)s AS expand
 ORDER BY 1
         """,  # noqa
         sql_zoom="""
@@ -744,14 +756,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1
         """,  # noqa
         probename='replication_lag',
+        expand=('metric_replication_lag', 'instance_id'),
     ),
     replication_connection=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).connected AS connected
-FROM expand_data_by_instance_id('metric_replication_connection', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, upstream text, record metric_replication_connection_record)
+FROM %(expand)s AS expand
 WHERE upstream = %(key)s
 ORDER BY 1
         """,  # noqa
@@ -764,14 +776,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1
         """,  # noqa
         probename='replication_connection',
+        expand=('metric_replication_connection', 'instance_id', 'upstream'),
     ),
     temp_files_size_delta=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).size
-FROM expand_data_by_instance_id('metric_temp_files_size_delta', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_temp_files_size_delta_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 ORDER BY 1
         """,  # noqa
@@ -784,14 +796,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1
         """,  # noqa
         probename='temp_files_size_delta',
+        expand=('metric_temp_files_size_delta', 'instance_id', 'dbname'),
     ),
     heap_bloat=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).ratio
-FROM expand_data_by_instance_id('metric_heap_bloat', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_bloat_ratio_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 ORDER BY 1
         """,  # noqa
@@ -804,14 +816,14 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1
         """,  # noqa
         probename='heap_bloat',
+        expand=('metric_heap_bloat', 'instance_id', 'dbname'),
     ),
     btree_bloat=dict(
         sql_nozoom="""
 SELECT
     datetime AS date,
     (record).ratio
-FROM expand_data_by_instance_id('metric_btree_bloat', tstzrange(%(start)s, %(end)s), %(instance_id)s)
-AS (datetime timestamp with time zone, instance_id integer, dbname text, record metric_bloat_ratio_record)
+FROM %(expand)s AS expand
 WHERE dbname = %(key)s
 ORDER BY 1
         """,  # noqa
@@ -825,56 +837,194 @@ WHERE instance_id = %(instance_id)s AND datetime >= %(start)s AND datetime <= %(
 ORDER BY 1
         """,  # noqa
         probename='btree_bloat',
+        expand=('metric_btree_bloat', 'instance_id', 'dbname'),
     ),
 )
 
 
-def zoom_level(start, end):
-    zoom = 0
+# Raw metrics tier, one point per minute by default.
+RAW_TIER = (None, 60)
+# Number of points per chart when client doesn't tell.
+DEFAULT_POINTS = 500
+# Rollup tiers are reloaded from repository after this delay in seconds.
+TIERS_TTL = 300
+_tiers_cache = dict(tiers=None, expires=0)
+# Delay in seconds between two runs of aggregate_data worker.
+AGGREGATE_INTERVAL = 30 * 60
+
+
+def get_rollup_tiers(session):
+    # Returns the list of (period, bucket width in seconds) of rollup tiers,
+    # finer first.
+    now = time.time()
+    if _tiers_cache['expires'] < now:
+        rows = session.execute(
+            "SELECT period, EXTRACT(EPOCH FROM period::INTERVAL)"
+            " FROM monitoring.rollup_tiers ORDER BY 2"
+        ).fetchall()
+        _tiers_cache.update(
+            tiers=[(period, int(seconds)) for period, seconds in rows],
+            expires=now + TIERS_TTL,
+        )
+    return _tiers_cache['tiers']
+
+
+def get_tier_watermarks(session, metric_names):
+    # Returns the epoch up to which each rollup tier is aggregated for all
+    # metrics, by period. A tier added after metrics have been collected is
+    # backfilled from oldest points and lags for a while.
+    #
+    # Watermarks are not cached: select_tier() compares them to the end of
+    # range with a margin of one aggregation run, a stale watermark would
+    # switch charts between tier and raw points.
+    tiers = get_rollup_tiers(session)
+    tablenames = [
+        get_tablename(METRICS[name]['probename'], period)
+        for period, _ in tiers
+        for name in metric_names
+    ]
+    last_buckets = dict(session.execute(
+        "SELECT tablename, EXTRACT(EPOCH FROM last_bucket)"
+        " FROM monitoring.aggregate_watermarks"
+        " WHERE tablename = ANY(:tablenames)",
+        dict(tablenames=tablenames),
+    ).fetchall())
+
+    watermarks = dict()
+    for period, _ in tiers:
+        watermarks[period] = min(
+            last_buckets.get(
+                get_tablename(METRICS[name]['probename'], period), 0)
+            for name in metric_names
+        )
+    return watermarks
+
+
+def select_tier(tiers, start, end, points=None, watermarks=None):
+    # Pick the coarsest tier still giving the requested number of points over
+    # the range. If watermarks are given, skip tiers not aggregated up to the
+    # end of the range.
     if end:
-        d = end - start
+        end = calendar.timegm(end.utctimetuple())
     else:
-        d = datetime.datetime.utcnow() - start
-
-    if d.days > 1 and d.days <= 31:
-        zoom = 1
-    elif d.days > 31 and d.days <= 365:
-        zoom = 2
-    elif d.days > 365:
-        zoom = 2
-    return zoom
-
-
-def get_tablename(probename, zoom):
-    if zoom == 1:
-        return 'metric_%s_30m_current' % (probename)
-    elif zoom == 2:
-        return 'metric_%s_6h_current' % (probename)
-    else:
-        return
+        end = time.time()
+    span = end - calendar.timegm(start.utctimetuple())
+    points = points or DEFAULT_POINTS
+
+    tier = RAW_TIER
+    for candidate in tiers:
+        if span / candidate[1] < points:
+            continue
+        if watermarks is not None:
+            # Last bucket starts at watermark and is refreshed on next
+            # aggregation.
+            covered = watermarks.get(candidate[0], 0) + \
+                candidate[1] + AGGREGATE_INTERVAL
+            if covered < end:
+                continue
+        tier = candidate
+    return tier
+
+
+def get_tablename(probename, period, rates=False):
+    # Metrics with rates=True read rates and percentages materialized by
+    # aggregation in metric_*_<period>_rates instead of rollups.
+    if period:
+        return 'metric_%s_%s_%s' % (
+            probename, period, 'rates' if rates else 'current')
+
+
+# Raw points of a metric from _current and _history tables, for
+# sql_nozoom. _history rows hold at most one day of records, so rows are
+# filtered on (id, lower(history_range)) index before unnesting records.
+# _history rows store either a legacy records array or one array per record
+# field. For the latter, only arrays of fields used by the query are unnested
+# and other fields of record are NULL. Archiving moves rows in a single
+# transaction, hence UNION ALL.
+EXPAND_SQL = """\
+(SELECT datetime, {columns}, record FROM {table}_current
+WHERE {id} = %({id})s
+AND datetime >= %(start)s
+AND datetime < COALESCE(%(end)s, 'infinity'::TIMESTAMPTZ)
+UNION ALL
+SELECT (h.record).datetime, {columns}, h.record
+FROM (
+  SELECT {columns}, unnest(records) AS record FROM {table}_history
+  WHERE {history_filter}
+) AS h
+WHERE (h.record).datetime >= %(start)s
+AND (h.record).datetime < COALESCE(%(end)s, 'infinity'::TIMESTAMPTZ)
+UNION ALL
+SELECT c.datetime, {columns}, ROW({row})::{record_type}
+FROM {table}_history, unnest({fields}) AS c({fields})
+WHERE {history_filter}
+AND c.datetime >= %(start)s
+AND c.datetime < COALESCE(%(end)s, 'infinity'::TIMESTAMPTZ)
+ORDER BY 1)"""
+HISTORY_FILTER = """\
+{id} = %({id})s
+AND lower(history_range) >= %(start)s::TIMESTAMPTZ - INTERVAL '1 day'
+AND lower(history_range) < COALESCE(%(end)s, 'infinity'::TIMESTAMPTZ)"""
+RECORD_FIELD_RE = re.compile(r'\(record\)\.(\w+)')
+# Record type and fields by metric table, from ingestion layout.
+RECORDS = dict(
+    (spec['table'][:-len('_current')], (
+        spec.get('record_type', spec['table'][:-len('current')] + 'record'),
+        ['datetime'] + spec['record'],
+    ))
+    for spec in METRIC_TABLES.values()
+)
+
+
+def format_expand_query(cur, metric, params):
+    table, columns = metric['expand'][0], metric['expand'][1:]
+    record_type, record = RECORDS[table]
+    used = set(RECORD_FIELD_RE.findall(metric['sql_nozoom']))
+    used.add('datetime')
+    fields = [f for f in record if f in used]
+    tpl = EXPAND_SQL.format(
+        table=table, id=columns[0], columns=', '.join(columns),
+        history_filter=HISTORY_FILTER.format(id=columns[0]),
+        record_type=record_type,
+        row=', '.join('c.' + f if f in used else 'NULL' for f in record),
+        fields=', '.join(fields),
+    )
+    return AsIs(cur.mogrify(tpl, params).decode('utf-8'))
+
+
+def format_metric_query(cur, metric, start, end, host_id, instance_id, key,
+                        period):
+    # Load query template
+    q_tpl = metric.get('sql_zoom') if period else metric.get('sql_nozoom')
+    tablename = get_tablename(
+        metric.get('probename'), period, metric.get('rates', False))
+    params = dict(host_id=host_id, instance_id=instance_id,
+                  start=start, end=end, key=key)
+    if not period:
+        params['expand'] = format_expand_query(cur, metric, params)
+    query = cur.mogrify(q_tpl, dict(params, tablename=AsIs(tablename)))
+    return query.strip().decode("utf-8")
 
 
 def get_metric_data_csv(session, metric_name, start, end, host_id=None,
-                        instance_id=None, key=None):
+                        instance_id=None, key=None, tier=None):
     if metric_name not in METRICS:
         raise IndexError("Metric '%s' not found" % metric_name)
 
     metric = METRICS.get(metric_name)
+    # Get the rollup tier, depending on the time interval
+    if tier is None:
+        tier = select_tier(
+            get_rollup_tiers(session), start, end,
+            watermarks=get_tier_watermarks(session, [metric_name]))
     # Instanciate a new string buffer needed by copy_expert()
     data_buffer = StringIO()
     # Get a new psycopg2 cursor from the current sqlalchemy session
     cur = session.connection().connection.cursor()
     # Change working schema to 'monitoring'
     cur.execute("SET search_path TO monitoring")
-    # Get the "zoom level", depending on the time interval
-    level = zoom_level(start, end)
-    # Load query template
-    q_tpl = metric.get('sql_nozoom') if level == 0 else metric.get('sql_zoom')
-    tablename = get_tablename(metric.get('probename'), level)
-    query = cur.mogrify(q_tpl, dict(host_id=host_id, instance_id=instance_id,
-                                    start=start, end=end, key=key,
-                                    tablename=AsIs(tablename)))
-    query = query.strip().decode("utf-8")
+    query = format_metric_query(
+        cur, metric, start, end, host_id, instance_id, key, tier[0])
     # Retreive data using copy_expert()
     cur.copy_expert(dedent("""\
     -- get_metric_data_csv
@@ -905,6 +1055,246 @@ def get_metric_data_csv(session, metric_name, start, end, host_id=None,
     return data
 
 
+def get_metric_data_columns(session, metric_name, start, end, host_id=None,
+                            instance_id=None, key=None, tier=None):
+    # Like get_metric_data_csv() but returns a dict with timestamps in epoch
+    # milliseconds and one array of numbers per serie. Pivot is done on
+    # fetched rows, without CSV round trip.
+    if metric_name not in METRICS:
+        raise IndexError("Metric '%s' not found" % metric_name)
+
+    metric = METRICS.get(metric_name)
+    if tier is None:
+        tier = select_tier(
+            get_rollup_tiers(session), start, end,
+            watermarks=get_tier_watermarks(session, [metric_name]))
+    cur = session.connection().connection.cursor()
+    cur.execute("SET search_path TO monitoring")
+    cur.execute(format_metric_query(
+        cur, metric, start, end, host_id, instance_id, key, tier[0]))
+    names = [c[0] for c in cur.description]
+    rows = cur.fetchall()
+    cur.close()
+
+    pivot = metric.get('pivot')
+    if pivot:
+        return pivot_columns(
+            rows,
+            index=names.index(pivot['index']),
+            key=names.index(pivot['key']),
+            value=names.index(pivot['value']),
+        )
+
+    return dict(
+        timestamps=[epoch_ms(row[0]) for row in rows],
+        series=OrderedDict(
+            (name, [number(row[i]) for row in rows])
+            for i, name in enumerate(names) if i > 0
+        ),
+    )
+
+
+def pivot_columns(rows, index, key, value):
+    # Single pass pivot of rows ordered by index. Series are ordered by first
+    # appearance of key, like pivot_timeserie().
+    timestamps = []
+    series = OrderedDict()
+    previous = None
+    for row in rows:
+        if not timestamps or row[index] != previous:
+            previous = row[index]
+            timestamps.append(epoch_ms(previous))
+        values = series.setdefault(row[key], [])
+        values.extend([None] * (len(timestamps) - 1 - len(values)))
+        if len(values) < len(timestamps):
+            values.append(number(row[value]))
+        else:
+            # Duplicate key for the same index, last value wins.
+            values[-1] = number(row[value])
+
+    for values in series.values():
+        values.extend([None] * (len(timestamps) - len(values)))
+    return dict(timestamps=timestamps, series=series)
+
+
+def epoch_ms(dt):
+    return calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+
+
+def number(value):
+    # Decimal from ROUND() is not JSON serializable. NaN is not valid JSON.
+    if value is None:
+        return None
+    value = float(value)
+    return None if value != value else value
+
+
+# Delay after which a time range can't receive new points: archiving and
+# aggregation have processed it, including late points from agent queue.
+CLOSED_DELAY = 12 * 3600
+
+
+def round_range(start, end, bucket):
+    # Widen start and end to buckets of the rollup tier, so that close ranges
+    # share cache entry.
+    start = floor_datetime(start, bucket)
+    if end:
+        rounded = floor_datetime(end, bucket)
+        if rounded < end:
+            rounded += datetime.timedelta(seconds=bucket)
+        end = rounded
+    return start, end
+
+
+def floor_datetime(dt, seconds):
+    remainder = calendar.timegm(dt.utctimetuple()) % seconds
+    return dt - datetime.timedelta(
+        seconds=remainder, microseconds=dt.microsecond)
+
+
+def is_closed_range(end):
+    if not end:
+        return False
+    return calendar.timegm(end.utctimetuple()) < time.time() - CLOSED_DELAY
+
+
+def get_last_insert(session, instance_id):
+    # Tells when collector stored metrics for this instance for the last time.
+    # This versions cache entries of open ranges.
+    row = session.execute(
+        "SELECT last_insert FROM monitoring.collector_status"
+        " WHERE instance_id = :instance_id",
+        {'instance_id': instance_id},
+    ).fetchone()
+    return row[0] if row else None
+
+
+class ChartCache(object):
+    # Thread-safe LRU cache of chart CSV, bounded by total size of data.
+    #
+    # An entry is a tuple of data, ETag and version. Version is None for closed
+    # ranges, which are kept until evicted. Otherwise, version is the
+    # last_insert of the instance and entry is dropped once newer points are
+    # stored.
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[2] != version:
+                if entry is not None:
+                    self.size -= len(entry[0])
+                self.misses += 1
+                return None
+            # Move entry to most recently used end.
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, data, version=None):
+        etag = '"%s"' % hashlib.sha1(data.encode('utf-8')).hexdigest()
+        entry = data, etag, version
+        if len(data) > self.max_size:
+            return entry
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = entry
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+chart_cache = ChartCache()
+
+
+def get_metric_data_cached(session, metric_name, start, end, host_id=None,
+                           instance_id=None, key=None, points=None,
+                           columnar=False):
+    # Wraps get_metric_data_csv() with chart_cache. Returns data, ETag, last
+    # modification datetime and whether the range is closed.
+    data, etags, last_modified, closed = get_metrics_data_cached(
+        session, [metric_name], start, end,
+        host_id=host_id, instance_id=instance_id, key=key, points=points,
+        columnar=columnar,
+    )
+    return data[metric_name], etags[0], last_modified, closed
+
+
+def get_metrics_data_cached(session, metric_names, start, end, host_id=None,
+                            instance_id=None, key=None, points=None,
+                            columnar=False):
+    # Load several charts of the same range in the current transaction.
+    # Charts are downsampled to `points` rows, if set. Data is CSV or JSON
+    # text of get_metric_data_columns() if columnar is True. Returns a dict of
+    # data by metric, the list of ETags, last modification datetime and
+    # whether the range, once rounded, is closed.
+    for metric_name in metric_names:
+        if metric_name not in METRICS:
+            raise IndexError("Metric '%s' not found" % metric_name)
+
+    tier = select_tier(
+        get_rollup_tiers(session), start, end, points,
+        watermarks=get_tier_watermarks(session, metric_names))
+    start, end = round_range(start, end, tier[1])
+    closed = is_closed_range(end)
+    if closed:
+        version = None
+        last_modified = end
+    else:
+        version = last_modified = get_last_insert(session, instance_id)
+
+    data, etags = {}, []
+    for metric_name in metric_names:
+        cache_key = (
+            metric_name, host_id, instance_id, key, tier[0], start, end,
+            points, columnar)
+        entry = chart_cache.get(cache_key, version)
+        if entry is None:
+            entry = chart_cache.set(cache_key, load_metric_data(
+                session, metric_name, start, end, host_id, instance_id, key,
+                tier, points, columnar,
+            ), version)
+        data[metric_name], etag, _ = entry
+        etags.append(etag)
+    return data, etags, last_modified, closed
+
+
+def load_metric_data(session, metric_name, start, end, host_id, instance_id,
+                     key, tier, points, columnar):
+    if columnar:
+        columns = get_metric_data_columns(
+            session, metric_name, start, end,
+            host_id=host_id, instance_id=instance_id, key=key, tier=tier,
+        )
+        if points:
+            columns = downsample_columns(columns, points)
+        return json.dumps(columns)
+
+    csv = get_metric_data_csv(
+        session, metric_name, start, end,
+        host_id=host_id, instance_id=instance_id, key=key, tier=tier,
+    )
+    if points:
+        csv = downsample_csv(csv, points)
+    return csv
+
+
 def get_unavailability_csv(session, start, end, host_id, instance_id):
 
     # Tell when the instance was not available
@@ -0,0 +1,110 @@
+import calendar
+from collections import OrderedDict
+
+
+def downsample_csv(data, points):
+    # Reduce CSV timeserie to at most `points` rows, using
+    # Largest-Triangle-Three-Buckets over all columns. Whole rows are kept so
+    # that series of the chart stay aligned. First column must be a
+    # PostgreSQL timestamp.
+    lines = data.splitlines()
+    header, rows = lines[:1], [line for line in lines[1:] if line]
+    if points < 3 or len(rows) <= points:
+        return data
+
+    xs, ys = [], []
+    for i, row in enumerate(rows):
+        fields = row.split(',')
+        xs.append(parse_x(fields[0], i))
+        ys.append([parse_y(field) for field in fields[1:]])
+
+    selected = lttb(xs, list(zip(*ys)), points)
+    return '\n'.join(header + [rows[i] for i in selected]) + '\n'
+
+
+def downsample_columns(columns, points):
+    # Same as downsample_csv() for get_metric_data_columns() output.
+    timestamps, series = columns['timestamps'], columns['series']
+    if points < 3 or len(timestamps) <= points:
+        return columns
+
+    ys = [
+        [0. if v is None else v for v in values]
+        for values in series.values()
+    ]
+    selected = lttb(timestamps, ys, points)
+    return dict(
+        timestamps=[timestamps[i] for i in selected],
+        series=OrderedDict(
+            (name, [values[i] for i in selected])
+            for name, values in series.items()
+        ),
+    )
+
+
+def parse_x(value, default):
+    # Fast parse of YYYY-MM-DD HH:MM:SS prefix. Time zone offset is ignored,
+    # since it is the same for all rows of a query.
+    try:
+        return calendar.timegm((
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+        ))
+    except ValueError:
+        return default
+
+
+def parse_y(field):
+    # Missing and NaN values count as 0.
+    try:
+        value = float(field)
+    except ValueError:
+        return 0.
+    return value if value == value else 0.
+
+
+def lttb(xs, series, threshold):
+    # Returns indexes of points selected by Largest-Triangle-Three-Buckets.
+    # First and last points are always kept.
+    #
+    # With several series, the area of a point is the largest area of its
+    # triangles in each series, scaled to the range of the serie. Series of a
+    # chart often sum to a constant (memory, CPU time), a peak of one serie
+    # is lost in the sum but not in its own triangle.
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    scaled = []
+    for ys in series:
+        amplitude = float(max(ys) - min(ys))
+        if amplitude:
+            scaled.append([y / amplitude for y in ys])
+
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+    selected = [0]
+    for i in range(threshold - 2):
+        # Average point of next bucket.
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_count = float(avg_end - avg_start)
+        avg_x = sum(xs[avg_start:avg_end]) / avg_count
+        avg_ys = [sum(ys[avg_start:avg_end]) / avg_count for ys in scaled]
+
+        # Pick point of current bucket forming the largest triangle with
+        # previously selected point and next bucket average.
+        ax = xs[a]
+        best, best_area = None, -1.
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = 0.
+            for ys, avg_y in zip(scaled, avg_ys):
+                ay = ys[a]
+                area = max(area, abs(
+                    (ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay)))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
@@ -1,21 +1,31 @@
+import calendar
+import hashlib
 import logging
+from email.utils import mktime_tz, parsedate_tz
+
+from tornado.httputil import format_timestamp
 
 from temboardui.web.tornado import (
     HTTPError,
+    Response,
     csvify,
+    jsonify,
 )
 
 from . import blueprint, render_template
 from ..chartdata import (
     get_unavailability_csv,
-    get_metric_data_csv,
+    get_metric_data_cached,
+    get_metrics_data_cached,
 )
 from ..tools import (
     get_request_ids,
+    parse_points,
     parse_start_end,
 )
 
 logger = logging.getLogger(__name__)
+JSON = 'application/json; charset=UTF-8'
 
 
 @blueprint.instance_route("/monitoring")
@@ -61,15 +71,108 @@ def data_metric(request, metric_name):
         return csvify(data=[])
 
     start, end = parse_start_end(request)
+    points = parse_points(request)
+    columnar = accepts_columns(request)
     try:
-        data = get_metric_data_csv(
+        data, etag, last_modified, closed = get_metric_data_cached(
             request.db_session, metric_name,
             start, end,
             host_id=host_id,
             instance_id=instance_id,
             key=key,
+            points=points,
+            columnar=columnar,
+        )
+    except IndexError:
+        raise HTTPError(404, 'Unknown metric.')
+
+    headers = cache_headers(closed, etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers, body=None)
+
+    if columnar:
+        response = Response(headers={'Content-Type': JSON}, body=data)
+    else:
+        response = csvify(data=data)
+    response.headers.update(headers)
+    return response
+
+
+@blueprint.instance_route(r'/monitoring/data$')
+def data_metrics(request):
+    # Returns several charts at once as a JSON object of CSV or columns by
+    # metric.
+    metrics = sorted(set(request.handler.get_arguments('metric')))
+    if not metrics:
+        raise HTTPError(406, 'Missing metric.')
+    key = request.handler.get_argument('key', default=None)
+    try:
+        host_id, instance_id = get_request_ids(request)
+    except NameError as e:
+        logger.info("%s. No data.", e)
+        return jsonify(dict((m, u'') for m in metrics))
+
+    start, end = parse_start_end(request)
+    points = parse_points(request)
+    columnar = accepts_columns(request)
+    try:
+        data, etags, last_modified, closed = get_metrics_data_cached(
+            request.db_session, metrics,
+            start, end,
+            host_id=host_id,
+            instance_id=instance_id,
+            key=key,
+            points=points,
+            columnar=columnar,
         )
     except IndexError:
         raise HTTPError(404, 'Unknown metric.')
 
-    return csvify(data=data)
+    etag = '"%s"' % hashlib.sha1(''.join(etags).encode('ascii')).hexdigest()
+    headers = cache_headers(closed, etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers, body=None)
+
+    if columnar:
+        # Columns are cached as JSON text, don't decode them.
+        response = Response(headers={'Content-Type': JSON}, body=u'{%s}' % (
+            u', '.join(u'"%s": %s' % (m, data[m]) for m in metrics)))
+    else:
+        response = jsonify(data)
+    response.headers.update(headers)
+    return response
+
+
+def accepts_columns(request):
+    # Clients asking for JSON get timestamps and series as arrays of numbers
+    # instead of CSV.
+    return 'application/json' in request.headers.get('Accept', '')
+
+
+def cache_headers(closed, etag, last_modified):
+    headers = {
+        'ETag': etag,
+        'Vary': 'Accept',
+        # Closed ranges never change, others must be revalidated.
+        'Cache-Control': (
+            'private, max-age=86400' if closed
+            else 'private, no-cache'),
+    }
+    if last_modified:
+        headers['Last-Modified'] = format_timestamp(last_modified)
+    return headers
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return etag in [t.strip() for t in if_none_match.split(',')]
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if not if_modified_since or not last_modified:
+        return False
+    parsed = parsedate_tz(if_modified_since)
+    if not parsed:
+        return False
+    modified = calendar.timegm(last_modified.utctimetuple())
+    return modified <= mktime_tz(parsed)
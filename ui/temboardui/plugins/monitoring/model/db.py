@@ -1,6 +1,5 @@
 # coding: utf-8
 import logging
-import functools
 from builtins import str
 from textwrap import dedent
 
@@ -8,19 +7,6 @@ from textwrap import dedent
 logger = logging.getLogger(__name__.replace('.db', ''))
 
 
-def handle_keyerror(fun):
-    metric_name = fun.__name__.replace('insert_metric_', '')
-
-    @functools.wraps(fun)
-    def wrapper(*a, **kw):
-        try:
-            return fun(*a, **kw)
-        except KeyError as e:
-            logger.warning("Missing point %s for %s.", e.args[0], metric_name)
-
-    return wrapper
-
-
 def insert_availability(session, dt, instance_id, available):
     session.execute(
         dedent("""
@@ -34,428 +20,184 @@ def insert_availability(session, dt, instance_id, available):
     )
 
 
-@handle_keyerror
-def insert_metric_sessions(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_sessions_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                metric['active'],
-                metric['waiting'],
-                metric['idle'],
-                metric['idle_in_xact'],
-                metric['idle_in_xact_aborted'],
-                metric['fastpath'],
-                metric['disabled'],
-                metric['no_priv']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_xacts(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_xacts_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['n_commit'],
-                metric['n_rollback']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_locks(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_locks_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                metric['access_share'],
-                metric['row_share'],
-                metric['row_exclusive'],
-                metric['share_update_exclusive'],
-                metric['share'],
-                metric['share_row_exclusive'],
-                metric['exclusive'],
-                metric['access_exclusive'],
-                metric['siread'],
-                metric['waiting_access_share'],
-                metric['waiting_row_share'],
-                metric['waiting_row_exclusive'],
-                metric['waiting_share_update_exclusive'],
-                metric['waiting_share'],
-                metric['waiting_share_row_exclusive'],
-                metric['waiting_exclusive'],
-                metric['waiting_access_exclusive']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_blocks(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_blocks_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['blks_read'],
-                metric['blks_hit'],
-                metric['hitmiss_ratio']
-            )
+# Layout of monitoring.metric_*_current tables, by metric name as sent by the
+# agent. Each table has a datetime column, either host_id or instance_id, an
+# optional key column and a composite record. record lists the fields of the
+# composite type, except the leading datetime which is always NULL in
+# _current tables. record_type defaults to metric_<name>_record.
+METRIC_TABLES = dict(
+    sessions=dict(
+        table='metric_sessions_current', id='instance_id', key='dbname',
+        record=[
+            'active', 'waiting', 'idle', 'idle_in_xact',
+            'idle_in_xact_aborted', 'fastpath', 'disabled', 'no_priv',
+        ],
+    ),
+    xacts=dict(
+        table='metric_xacts_current', id='instance_id', key='dbname',
+        record=['measure_interval', 'n_commit', 'n_rollback'],
+    ),
+    locks=dict(
+        table='metric_locks_current', id='instance_id', key='dbname',
+        record=[
+            'access_share', 'row_share', 'row_exclusive',
+            'share_update_exclusive', 'share', 'share_row_exclusive',
+            'exclusive', 'access_exclusive', 'siread',
+            'waiting_access_share', 'waiting_row_share',
+            'waiting_row_exclusive', 'waiting_share_update_exclusive',
+            'waiting_share', 'waiting_share_row_exclusive',
+            'waiting_exclusive', 'waiting_access_exclusive',
+        ],
+    ),
+    blocks=dict(
+        table='metric_blocks_current', id='instance_id', key='dbname',
+        record=['measure_interval', 'blks_read', 'blks_hit', 'hitmiss_ratio'],
+    ),
+    bgwriter=dict(
+        table='metric_bgwriter_current', id='instance_id', key=None,
+        record=[
+            'measure_interval', 'checkpoints_timed', 'checkpoints_req',
+            'checkpoint_write_time', 'checkpoint_sync_time',
+            'buffers_checkpoint', 'buffers_clean', 'maxwritten_clean',
+            'buffers_backend', 'buffers_backend_fsync', 'buffers_alloc',
+            'stats_reset',
+        ],
+    ),
+    db_size=dict(
+        table='metric_db_size_current', id='instance_id', key='dbname',
+        record=['size'],
+    ),
+    tblspc_size=dict(
+        table='metric_tblspc_size_current', id='instance_id', key='spcname',
+        record=['size'],
+    ),
+    filesystems_size=dict(
+        table='metric_filesystems_size_current', id='host_id',
+        key='mount_point',
+        record=['used', 'total', 'device'],
+    ),
+    temp_files_size_delta=dict(
+        table='metric_temp_files_size_delta_current', id='instance_id',
+        key='dbname',
+        record=['measure_interval', 'size'],
+    ),
+    wal_files=dict(
+        table='metric_wal_files_current', id='instance_id', key=None,
+        record=[
+            'measure_interval', 'written_size', 'current_location', 'total',
+            'archive_ready', 'total_size',
+        ],
+    ),
+    cpu=dict(
+        table='metric_cpu_current', id='host_id', key='cpu',
+        record=[
+            'measure_interval', 'time_user', 'time_system', 'time_idle',
+            'time_iowait', 'time_steal',
+        ],
+    ),
+    process=dict(
+        table='metric_process_current', id='host_id', key=None,
+        record=[
+            'measure_interval', 'context_switches', 'forks', 'procs_running',
+            'procs_blocked', 'procs_total',
+        ],
+    ),
+    memory=dict(
+        table='metric_memory_current', id='host_id', key=None,
+        record=[
+            'mem_total', 'mem_used', 'mem_free', 'mem_buffers', 'mem_cached',
+            'swap_total', 'swap_used',
+        ],
+    ),
+    loadavg=dict(
+        table='metric_loadavg_current', id='host_id', key=None,
+        record=['load1', 'load5', 'load15'],
+    ),
+    vacuum_analyze=dict(
+        table='metric_vacuum_analyze_current', id='instance_id',
+        key='dbname',
+        record=[
+            'measure_interval', 'n_vacuum', 'n_analyze', 'n_autovacuum',
+            'n_autoanalyze',
+        ],
+    ),
+    replication_lag=dict(
+        table='metric_replication_lag_current', id='instance_id', key=None,
+        record=['lag'],
+    ),
+    replication_connection=dict(
+        table='metric_replication_connection_current', id='instance_id',
+        key='upstream',
+        record=['connected'],
+    ),
+    heap_bloat=dict(
+        table='metric_heap_bloat_current', id='instance_id', key='dbname',
+        record=['ratio'],
+        record_type='metric_bloat_ratio_record',
+    ),
+    btree_bloat=dict(
+        table='metric_btree_bloat_current', id='instance_id', key='dbname',
+        record=['ratio'],
+        record_type='metric_bloat_ratio_record',
+    ),
+)
+
+
+def build_metric_row(metric_name, host_id, instance_id, point):
+    # Format an agent point as a row of the metric_*_current table. Raises
+    # KeyError on unknown metric or missing field in point.
+    spec = METRIC_TABLES[metric_name]
+    row = [
+        point['datetime'],
+        host_id if 'host_id' == spec['id'] else instance_id,
+    ]
+    if spec['key']:
+        row.append(point[spec['key']])
+    record = [None]
+    for field in spec['record']:
+        value = point[field]
+        if 'measure_interval' == field:
+            value = str(value)
+        record.append(value)
+    row.append(tuple(record))
+    return tuple(row)
+
+
+def group_metric_rows(host_id, instance_id, data):
+    # Group points of an agent payload by target table. Returns a dict of
+    # table name to list of rows. Skips invalid points.
+    tables = dict()
+    for metric_name, points in data.items():
+        if metric_name not in METRIC_TABLES or not points:
+            continue
+        rows = tables.setdefault(METRIC_TABLES[metric_name]['table'], [])
+        for point in points:
+            try:
+                rows.append(build_metric_row(
+                    metric_name, host_id, instance_id, point))
+            except KeyError as e:
+                logger.warning(
+                    "Missing point %s for %s.", e.args[0], metric_name)
+    return tables
+
+
+def insert_metric_rows(session, table, rows, page_size=1000):
+    # Insert rows in table using multi-rows INSERT, page_size rows per
+    # statement. Does not commit.
+    cur = session.connection().connection.cursor()
+    for i in range(0, len(rows), page_size):
+        page = rows[i:i + page_size]
+        # Each row is (datetime, id[, key], record). record is a tuple, which
+        # psycopg2 adapts as a ROW() constructor cast to target composite
+        # type.
+        template = '(' + ', '.join(['%s'] * len(page[0])) + ')'
+        values = b', '.join(cur.mogrify(template, row) for row in page)
+        cur.execute(
+            b'INSERT INTO monitoring.' + table.encode('ascii')
+            + b' VALUES ' + values
         )
-    )
-
-
-@handle_keyerror
-def insert_metric_bgwriter(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_bgwriter_current
-            VALUES (:dt, :instance_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['checkpoints_timed'],
-                metric['checkpoints_req'],
-                metric['checkpoint_write_time'],
-                metric['checkpoint_sync_time'],
-                metric['buffers_checkpoint'],
-                metric['buffers_clean'],
-                metric['maxwritten_clean'],
-                metric['buffers_backend'],
-                metric['buffers_backend_fsync'],
-                metric['buffers_alloc'],
-                metric['stats_reset']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_db_size(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_db_size_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                metric['size']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_tblspc_size(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_tblspc_size_current
-            VALUES (:dt, :instance_id, :spcname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            spcname=metric['spcname'],
-            row=(
-                None,
-                metric['size']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_fs_size(session, host_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_filesystems_size_current
-            VALUES (:dt, :host_id, :mount_point, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            host_id=host_id,
-            mount_point=metric['mount_point'],
-            row=(
-                None,
-                metric['used'],
-                metric['total'],
-                metric['device']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_temp_files_size_delta(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_temp_files_size_delta_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['size']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_wal_files(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_wal_files_current
-            VALUES (:dt, :instance_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['written_size'],
-                metric['current_location'],
-                metric['total'],
-                metric['archive_ready'],
-                metric['total_size']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_cpu(session, host_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_cpu_current
-            VALUES (:dt, :host_id, :cpu, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            host_id=host_id,
-            cpu=metric['cpu'],
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['time_user'],
-                metric['time_system'],
-                metric['time_idle'],
-                metric['time_iowait'],
-                metric['time_steal']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_process(session, host_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_process_current
-            VALUES (:dt, :host_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            host_id=host_id,
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['context_switches'],
-                metric['forks'],
-                metric['procs_running'],
-                metric['procs_blocked'],
-                metric['procs_total']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_memory(session, host_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_memory_current
-            VALUES (:dt, :host_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            host_id=host_id,
-            row=(
-                None,
-                metric['mem_total'],
-                metric['mem_used'],
-                metric['mem_free'],
-                metric['mem_buffers'],
-                metric['mem_cached'],
-                metric['swap_total'],
-                metric['swap_used']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_loadavg(session, host_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_loadavg_current
-            VALUES (:dt, :host_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            host_id=host_id,
-            row=(
-                None,
-                metric['load1'],
-                metric['load5'],
-                metric['load15']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_vacuum_analyze(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_vacuum_analyze_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                str(metric['measure_interval']),
-                metric['n_vacuum'],
-                metric['n_analyze'],
-                metric['n_autovacuum'],
-                metric['n_autoanalyze']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_replication_lag(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_replication_lag_current
-            VALUES (:dt, :instance_id, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            row=(
-                None,
-                metric['lag']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_replication_connection(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_replication_connection_current
-            VALUES (:dt, :instance_id, :upstream, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            upstream=metric['upstream'],
-            row=(
-                None,
-                metric['connected']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_heap_bloat(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_heap_bloat_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                metric['ratio']
-            )
-        )
-    )
-
-
-@handle_keyerror
-def insert_metric_btree_bloat(session, instance_id, metric):
-    session.execute(
-        dedent("""
-            INSERT INTO monitoring.metric_btree_bloat_current
-            VALUES (:dt, :instance_id, :dbname, :row)
-        """),
-        dict(
-            dt=metric['datetime'],
-            instance_id=instance_id,
-            dbname=metric['dbname'],
-            row=(
-                None,
-                metric['ratio']
-            )
-        )
-    )
+    cur.close()
+    return len(rows)
 
 
 def get_host_id(session, hostname):
@@ -509,36 +251,75 @@ def get_agent_keys(session, hostname):
     ).fetchall()
 
 
-def append_state_changes(
-    session, dt, check_id, state, key, value, warning, critical
-):
-    session.execute(
-        dedent("""
-            SELECT monitoring.append_state_changes(
-                :datetime, :check_id, :state, :key, :value, :warning, :critical
-            )
-        """),
-        dict(
-            datetime=dt,
-            check_id=check_id,
-            state=state,
-            key=key,
-            value=value,
-            warning=warning,
-            critical=critical
-        )
+def upsert_check_states(session, rows):
+    # Insert or update check states. rows is a list of (check_id, key, state)
+    # tuples, unique on (check_id, key).
+    if not rows:
+        return
+    cur = session.connection().connection.cursor()
+    values = b', '.join(cur.mogrify('(%s, %s, %s)', row) for row in rows)
+    cur.execute(
+        b'INSERT INTO monitoring.check_states AS cs (check_id, key, state)'
+        b' SELECT check_id, key, state::monitoring.check_state_type'
+        b' FROM (VALUES ' + values + b') AS v(check_id, key, state)'
+        b' ON CONFLICT (check_id, key) DO UPDATE SET state = EXCLUDED.state'
+        b' WHERE cs.state IS DISTINCT FROM EXCLUDED.state'
     )
-
-
-def purge_check_states(session, check_id, keys):
+    cur.close()
+
+
+def append_state_changes(session, rows):
+    # Append state changes to history, only if state differs from the last
+    # known state of the check key. rows is a list of (datetime, check_id,
+    # state, key, value, warning, critical) tuples.
+    if not rows:
+        return
+    cur = session.connection().connection.cursor()
+    template = '(' + ', '.join(['%s'] * 7) + ')'
+    values = b', '.join(cur.mogrify(template, row) for row in rows)
+    cur.execute(dedent("""\
+    INSERT INTO monitoring.state_changes
+        (datetime, check_id, state, key, value, warning, critical)
+    SELECT
+        v.datetime::timestamptz, v.check_id,
+        v.state::monitoring.check_state_type, v.key,
+        v.value::real, v.warning::real, v.critical::real
+    FROM (VALUES {values}) AS v(
+        datetime, check_id, state, key, value, warning, critical)
+    LEFT OUTER JOIN LATERAL (
+        SELECT state FROM monitoring.state_changes AS sc
+        WHERE sc.check_id = v.check_id AND sc.key = v.key
+        ORDER BY sc.datetime DESC
+        LIMIT 1
+    ) AS last ON true
+    WHERE last.state IS NULL OR last.state::text != v.state
+    """).encode('utf-8').replace(b'{values}', values))
+    cur.close()
+
+
+def purge_check_states(session, keys):
+    # Delete states of keys not checked anymore. keys maps check_id to the
+    # list of keys to keep.
+    if not keys:
+        return
+    check_ids, kept_keys = [], []
+    for check_id, ks in sorted(keys.items()):
+        check_ids.extend([check_id] * len(ks))
+        kept_keys.extend(ks)
     session.execute(
         dedent("""
             DELETE FROM monitoring.check_states
-            WHERE check_id = :check_id AND NOT (key = ANY(:keys))
+            WHERE check_id = ANY(:check_ids)
+            AND (check_id, key) NOT IN (
+                SELECT * FROM unnest(
+                    CAST(:check_ids AS integer[]),
+                    CAST(:keys AS varchar[])
+                )
+            )
         """),
         dict(
-            check_id=check_id,
-            keys=keys
+            check_ids=check_ids,
+            keys=kept_keys,
         )
     )
 
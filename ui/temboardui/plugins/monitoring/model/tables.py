@@ -90,5 +90,7 @@ collector_status = Table(
     Column('last_push', DateTime, nullable=True),
     Column('last_insert', DateTime, nullable=True),
     Column('status', UnicodeText),
+    Column('inventory_fingerprint', UnicodeText, nullable=True),
+    Column('history_cursor', UnicodeText, nullable=True),
     schema="monitoring",
 )
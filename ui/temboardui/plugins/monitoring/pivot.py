@@ -1,40 +1,54 @@
 import csv
-import operator
-
-
-def get_csv_data(fd):
-    # CSV parser as generator
-    for r in csv.DictReader(fd):
-        yield r
 
 
 def pivot_timeserie(fd, index, key, value, output):
     # Simple pivot table implementation.
     # Beware, input data *MUST* be ordered by index value.
     fd.seek(0)
-    keys = {}
-    p = 1
-    # We need to get the keys first
-    for r in get_csv_data(fd):
-        if r[key] not in keys:
-            keys[r[key]] = p
-            p += 1
-    sk = sorted(list(keys.items()), key=operator.itemgetter(1))
-    # CSV Header
-    line = [index] + [x[0] for x in sk]
-    p_index = ''
-    fd.seek(0)
-    for r in get_csv_data(fd):
-        if r[index] != p_index:
+    for line in iter_pivot(fd, index, key, value):
+        output.write(line)
+
+
+def iter_pivot(fd, index, key, value):
+    # Single pass pivot, as a generator of CSV lines. Columns are ordered by
+    # first appearance of key. Parsed rows are kept until all keys are known.
+    reader = csv.reader(fd)
+    header = next(reader, None)
+    if header is None:
+        yield index + '\n'
+        return
+    i_index, i_key, i_value = (
+        header.index(index), header.index(key), header.index(value))
+
+    positions = {}
+    lines = list(iter_lines(reader, i_index, i_key, i_value, positions))
+    keys = sorted(positions, key=positions.get)
+    width = len(keys) + 1
+    yield ','.join([index] + keys) + '\n'
+    for line in lines:
+        # Pad lines generated before late keys were discovered.
+        line.extend([''] * (width - len(line)))
+        yield ','.join(line) + '\n'
+
+
+def iter_lines(reader, i_index, i_key, i_value, positions):
+    # Generate one list of values per index value. Unknown keys are appended
+    # to positions, widening next lines.
+    line = None
+    for r in reader:
+        if line is None or r[i_index] != line[0]:
             # As data are ordered if we meet a new index value then the current
             # line is complete.
-            output.write(','.join(line)+'\n')
-            # And start a new line
-            line = [''] * (len(keys)+1)
-            line[0] = r[index]
-        # Append value to the current line
-        line[keys[r[key]]] = r[value]
-        # Keep a track of the index value
-        p_index = r[index]
-    # Write the last line
-    output.write(','.join(line)+'\n')
+            if line is not None:
+                yield line
+            line = [''] * (len(positions) + 1)
+            line[0] = r[i_index]
+        k = r[i_key]
+        p = positions.get(k)
+        if p is None:
+            p = positions[k] = len(positions) + 1
+        if p >= len(line):
+            line.extend([''] * (p + 1 - len(line)))
+        line[p] = r[i_value]
+    if line is not None:
+        yield line
@@ -425,8 +425,11 @@ $(function () {
     }
 
     var params = "?start=" + timestampToIsoDate(startDate) + "&end=" + timestampToIsoDate(endDate) + "&noerror=1";
+    // Don't fetch more points than chart can draw.
+    var width = document.getElementById("chart" + id).offsetWidth;
+    var dataParams = width ? params + "&points=" + width : params;
     var data = null;
-    var dataReq = $.get(apiUrl + "/" + metrics[id].api + params, function (_data) {
+    var dataReq = fetchData(metrics[id].api, dataParams).then(function (_data) {
       data = _data;
     });
     // Get the dates when the instance was unavailable
@@ -435,7 +438,7 @@ $(function () {
     if (metrics[id].category == "postgres") {
       promise = $.when(
         dataReq,
-        $.get(unavailabilityUrl + params, function (_data) {
+        fetchUnavailability(params).then(function (_data) {
           unavailabilityData = _data;
         }),
       );
@@ -477,6 +480,42 @@ $(function () {
     );
   }
 
+  // Charts requested in the same tick for the same range are fetched in one
+  // request.
+  var dataBatches = {};
+  function fetchData(metric, params) {
+    var batch = dataBatches[params];
+    if (!batch) {
+      batch = dataBatches[params] = { metrics: [], deferred: $.Deferred() };
+      setTimeout(function () {
+        delete dataBatches[params];
+        var query = batch.metrics
+          .map(function (metric) {
+            return "&metric=" + encodeURIComponent(metric);
+          })
+          .join("");
+        $.get(apiUrl + params + query).then(batch.deferred.resolve, batch.deferred.reject);
+      });
+    }
+    if (batch.metrics.indexOf(metric) === -1) {
+      batch.metrics.push(metric);
+    }
+    return batch.deferred.then(function (data) {
+      return data[metric];
+    });
+  }
+
+  var unavailabilityRequests = {};
+  function fetchUnavailability(params) {
+    if (!unavailabilityRequests[params]) {
+      unavailabilityRequests[params] = $.get(unavailabilityUrl + params);
+      setTimeout(function () {
+        delete unavailabilityRequests[params];
+      });
+    }
+    return unavailabilityRequests[params];
+  }
+
   function timestampToIsoDate(epochMs) {
     var ndate = new Date(epochMs);
     return ndate.toISOString();
@@ -1,10 +1,10 @@
 from builtins import str
 from dateutil import parser as parse_datetime
 from datetime import datetime, timedelta
+import hashlib
+import json
 import logging
 
-from sqlalchemy.orm.exc import NoResultFound
-
 from .model.orm import (
     Check,
     CheckState,
@@ -112,6 +112,20 @@ def parse_start_end(request):
     return start, end
 
 
+def parse_points(request):
+    # Maximum number of points per chart, usually chart width in pixels.
+    points = request.handler.get_argument('points', default=None)
+    if not points:
+        return None
+    try:
+        points = int(points)
+    except ValueError:
+        raise HTTPError(406, 'Points not valid.')
+    if points < 3:
+        raise HTTPError(406, 'Points not valid.')
+    return points
+
+
 def check_agent_key(session, hostname, pg_data, pg_port, agent_key):
     """Check that the given key matches with the registered one.
     """
@@ -142,28 +156,19 @@ class TimeoutError(UserError):
 
 def insert_metrics(
         session, host_id, instance_id, data, labels=None, max_duration=30):
+    # Insert all points of an agent payload in a single transaction. Points
+    # are grouped by metric table and loaded with one multi-rows INSERT per
+    # table.
     start = datetime.utcnow()
     max_duration = timedelta(seconds=max_duration)
     labels = labels or {}
 
-    for metric_name in list(data.keys()):
-        call_duration = datetime.utcnow() - start
-        if call_duration >= max_duration:
-            logger.warning(
-                "Metrics insertion is too long. "
-                "Maybe another task is locking tables.")
-            logger.warning(
-                "Aborting metrics insertion. Retrying in less than a minute.")
-            raise TimeoutError(
-                "Metrics insertion takes more than %s." % max_duration)
-
+    for metric_name, points in data.items():
         # Do not try to insert empty lines
-        if data[metric_name] is None:
-            continue
-        if len(data[metric_name]) == 0:
+        if not points:
             continue
 
-        for record in generate_logfmt_records(metric_name, data[metric_name]):
+        for record in generate_logfmt_records(metric_name, points):
             try:
                 logger.debug(
                     "up=1 %s %s",
@@ -173,57 +178,27 @@ def insert_metrics(
             except Exception:
                 logger.exception("Failed to format logfmt.")
 
-        # Insert data
-        for metric_data in data[metric_name]:
-            logger.debug("Inserting data for metric %s.", metric_name)
-            if metric_name == 'sessions':
-                db.insert_metric_sessions(session, instance_id, metric_data)
-            elif metric_name == 'xacts':
-                db.insert_metric_xacts(session, instance_id, metric_data)
-            elif metric_name == 'locks':
-                db.insert_metric_locks(session, instance_id, metric_data)
-            elif metric_name == 'blocks':
-                db.insert_metric_blocks(session, instance_id, metric_data)
-            elif metric_name == 'bgwriter':
-                db.insert_metric_bgwriter(session, instance_id, metric_data)
-            elif metric_name == 'db_size':
-                db.insert_metric_db_size(session, instance_id, metric_data)
-            elif metric_name == 'tblspc_size':
-                db.insert_metric_tblspc_size(session, instance_id, metric_data)
-            elif metric_name == 'filesystems_size':
-                db.insert_metric_fs_size(session, host_id, metric_data)
-            elif metric_name == 'temp_files_size_delta':
-                db.insert_metric_temp_files_size_delta(
-                    session, instance_id, metric_data
-                )
-            elif metric_name == 'wal_files':
-                db.insert_metric_wal_files(session, instance_id, metric_data)
-            elif metric_name == 'cpu':
-                db.insert_metric_cpu(session, host_id, metric_data)
-            elif metric_name == 'process':
-                db.insert_metric_process(session, host_id, metric_data)
-            elif metric_name == 'memory':
-                db.insert_metric_memory(session, host_id, metric_data)
-            elif metric_name == 'loadavg':
-                db.insert_metric_loadavg(session, host_id, metric_data)
-            elif metric_name == 'vacuum_analyze':
-                db.insert_metric_vacuum_analyze(
-                    session, instance_id, metric_data
-                )
-            elif metric_name == 'replication_lag':
-                db.insert_metric_replication_lag(
-                    session, instance_id, metric_data
-                )
-            elif metric_name == 'replication_connection':
-                db.insert_metric_replication_connection(
-                    session, instance_id, metric_data
-                )
-            elif metric_name == 'heap_bloat':
-                db.insert_metric_heap_bloat(session, instance_id, metric_data)
-            elif metric_name == 'btree_bloat':
-                db.insert_metric_btree_bloat(session, instance_id, metric_data)
+    tables = db.group_metric_rows(host_id, instance_id, data)
+    # Sort tables to lock them in the same order as concurrent collectors.
+    for table, rows in sorted(tables.items()):
+        call_duration = datetime.utcnow() - start
+        if call_duration >= max_duration:
+            logger.warning(
+                "Metrics insertion is too long. "
+                "Maybe another task is locking tables.")
+            logger.warning(
+                "Aborting metrics insertion. Retrying in less than a minute.")
+            session.rollback()
+            raise TimeoutError(
+                "Metrics insertion takes more than %s." % max_duration)
 
-            session.commit()
+        if not rows:
+            continue
+
+        logger.debug("Inserting %s rows in %s.", len(rows), table)
+        db.insert_metric_rows(session, table, rows)
+
+    session.commit()
 
 
 def generate_logfmt_records(metric, points):
@@ -272,7 +247,8 @@ def populate_host_checks(session, host_id, instance_id, hostinfo):
 
 
 def update_collector_status(session, instance_id, status, last_pull=None,
-                            last_push=None, last_insert=None):
+                            last_push=None, last_insert=None,
+                            inventory_fingerprint=None, history_cursor=None):
     cs = CollectorStatus()
     cs.instance_id = instance_id
     cs.status = status
@@ -282,10 +258,82 @@ def update_collector_status(session, instance_id, status, last_pull=None,
         cs.last_push = last_push
     if last_insert:
         cs.last_insert = last_insert
+    if inventory_fingerprint:
+        cs.inventory_fingerprint = inventory_fingerprint
+    if history_cursor:
+        cs.history_cursor = history_cursor
 
     session.merge(cs)
 
 
+def fingerprint_inventory(hostinfo, instance_info, discover_etag=None):
+    # Hash inventory data stored in monitoring hosts and instances tables, to
+    # detect changes. Volatile data sent along, like filesystems usage,
+    # databases size or CPU frequency, is ignored.
+    payload = json.dumps([
+        [hostinfo.get(c) for c in Host.__table__.columns.keys()],
+        [instance_info.get(c) for c in Instance.__table__.columns.keys()],
+        instance_info.get('available'),
+        discover_etag,
+    ], default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class InventoryCache(dict):
+    # Maps agent address and port to monitoring inventory: host_id,
+    # instance_id, enabled checks, last_insert and history cursor. Entries
+    # are loaded from collector status in repository and refreshed when
+    # agent inventory fingerprint changes. Entries live as long as the worker
+    # process.
+
+    def load(self, session, agent_id, host_id, instance_id):
+        # Load inventory entry of a known instance from repository.
+        cs = session.query(CollectorStatus).filter(
+            CollectorStatus.instance_id == instance_id
+        ).first()
+        self[agent_id] = dict(
+            fingerprint=cs.inventory_fingerprint if cs else None,
+            host_id=host_id,
+            instance_id=instance_id,
+            checks=get_instance_checks(session, instance_id),
+            last_insert=cs.last_insert if cs else None,
+            cursor=cs.history_cursor if cs else None,
+        )
+        return self[agent_id]
+
+    def resolve(self, session, agent_id, pg_port, hostinfo, instance_info,
+                discover_etag=None):
+        # Returns inventory entry for agent, merging inventory in repository
+        # only if agent data changed.
+        fingerprint = fingerprint_inventory(
+            hostinfo, instance_info, discover_etag)
+        entry = self.get(agent_id)
+        if entry and entry['fingerprint'] == fingerprint:
+            return entry
+
+        logger.info("Update the inventory for %s.", agent_id)
+        # merge_agent_info() updates dicts inplace. Don't alter fingerprinted
+        # data.
+        host = merge_agent_info(session, dict(hostinfo), dict(instance_info))
+        instance_id = get_instance_id(session, host.host_id, pg_port)
+        populate_host_checks(
+            session, host.host_id, instance_id,
+            dict(n_cpu=hostinfo['cpu_count']),
+        )
+        self[agent_id] = dict(
+            fingerprint=fingerprint,
+            host_id=host.host_id,
+            instance_id=instance_id,
+            checks=get_instance_checks(session, instance_id),
+            last_insert=entry['last_insert'] if entry else None,
+            cursor=entry.get('cursor') if entry else None,
+        )
+        return self[agent_id]
+
+
+inventory_cache = InventoryCache()
+
+
 def build_check_task_options(data, host_id, instance_id, checks, timestamp):
     """Build Task options for check_data_worker worker."""
 
@@ -331,13 +379,24 @@ def preprocess_data(data, checks, timestamp):
 
 
 def check_preprocessed_data(app, session, host_id, instance_id, ppdata):
-    # Function in charge of checking preprocessed monitoring values
-    keys = dict()
+    # Function in charge of checking preprocessed monitoring values. Checks
+    # and current states are loaded once, then states and state changes are
+    # written in bulk.
+    checks = session.query(Check).filter(
+        Check.instance_id == instance_id).all()
+    enabled_checks = dict(
+        (c.name, c) for c in checks if c.enabled and c.host_id == host_id)
+    states = dict(
+        ((cs.check_id, cs.key), cs.state)
+        for cs in session.query(CheckState).filter(
+            CheckState.check_id.in_([c.check_id for c in checks]))
+    )
+    # Evaluated values by (check_id, key).
+    evaluated = dict()
 
     for raw in ppdata:
-        dt = raw.get('datetime')
         name = raw.get('name')
-        key = raw.get('key')
+        key = str(raw.get('key'))
         value = raw.get('value')
         warning = raw.get('warning')
         critical = raw.get('critical')
@@ -355,80 +414,55 @@ def check_preprocessed_data(app, session, host_id, instance_id, ppdata):
         if spec.get('operator')(value, critical):
             state = 'CRITICAL'
 
-        # Try to find enabled check for this host_id with the same name
-        try:
-            c = session.query(Check).filter(
-                Check.name == str(name),
-                Check.host_id == host_id,
-                Check.instance_id == instance_id,
-                Check.enabled == bool(True),
-            ).one()
-        except NoResultFound:
+        # Find enabled check for this host_id with the same name
+        c = enabled_checks.get(name)
+        if not c:
             continue
 
-        # Update/insert check current state
-        try:
-            cs = session.query(CheckState).filter(
-                CheckState.check_id == c.check_id,
-                CheckState.key == str(key)
-            ).one()
-            # State has changed since last time
-            if cs.state != state:
-                if app.scheduler.can_schedule:
-                    app.scheduler.schedule_task(
-                        'notify_state_change',
-                        options={
-                            'check_id': c.check_id,
-                            'key': key,
-                            'value': value,
-                            'state': state,
-                            'prev_state': cs.state
-                        },
-                        expire=0,
-                    )
-                else:
-                    logger.warning("Can't schedule state change task.")
-            cs.state = str(state)
-            session.merge(cs)
-
-        except NoResultFound:
-            cs = CheckState(
-                check_id=c.check_id, key=str(key), state=str(state)
-            )
-            session.add(cs)
-
-        session.flush()
-        # Append state change if any to history
-        db.append_state_changes(
-            session,
-            dt,
-            c.check_id,
-            cs.state,
-            cs.key,
-            value,
-            warning,
-            critical,
-        )
-
-        if c.check_id not in keys:
-            keys[c.check_id] = list()
-        keys[c.check_id].append(cs.key)
+        prev_state = states.get((c.check_id, key))
+        # State has changed since last time
+        if prev_state and prev_state != state:
+            if app.scheduler.can_schedule:
+                app.scheduler.schedule_task(
+                    'notify_state_change',
+                    options={
+                        'check_id': c.check_id,
+                        'key': key,
+                        'value': value,
+                        'state': state,
+                        'prev_state': prev_state,
+                    },
+                    expire=0,
+                )
+            else:
+                logger.warning("Can't schedule state change task.")
+        states[(c.check_id, key)] = state
+        evaluated[(c.check_id, key)] = (
+            raw.get('datetime'), state, value, warning, critical)
+
+    # Sort rows to lock check states in a stable order.
+    evaluated = sorted(evaluated.items())
+    db.upsert_check_states(session, [
+        (check_id, key, state)
+        for (check_id, key), (_, state, _, _, _) in evaluated
+    ])
+    # Append state change if any to history
+    db.append_state_changes(session, [
+        (dt, check_id, state, key, value, warning, critical)
+        for (check_id, key), (dt, state, value, warning, critical) in evaluated
+    ])
 
-        session.commit()
-        session.expunge_all()
+    keys = dict()
+    for check_id, key in (i[0] for i in evaluated):
+        keys.setdefault(check_id, []).append(key)
 
     # Purge CheckState
-    for check_id, ks in list(keys.items()):
-        db.purge_check_states(session, check_id, ks)
-        session.commit()
-
-    # Get the list of check_id for the given instance
-    req = session.query(Check).filter(Check.instance_id == instance_id)
-    all_check_ids = [check.check_id for check in req]
+    db.purge_check_states(session, keys)
 
     # Set to UNDEF each unchecked check for the given instance
     # This may happen when postgres is not available
-    db.undef_check_states(session, all_check_ids, list(keys.keys()))
+    db.undef_check_states(
+        session, [c.check_id for c in checks], list(keys.keys()))
     session.commit()
 
 
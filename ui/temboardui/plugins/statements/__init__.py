@@ -42,6 +42,7 @@ from temboardui.plugins.monitoring.tools import (
     parse_start_end,
 )
 from temboardui.toolkit import taskmanager
+from temboardui.toolkit.http import ACCEPT_ENCODING
 from temboardui.agentclient import TemboardAgentClient
 
 
@@ -858,7 +859,9 @@ def pull_data_for_instance(app, session, instance):
         instance.agent_key,
     )
     try:
-        response = client.get('/statements')
+        response = client.get('/statements', headers={
+            'Accept-Encoding': ACCEPT_ENCODING,
+        })
         response.raise_for_status()
         add_statement(session, instance, response.json())
         logger.info("Successfully pulled statements data for %s.", agent_id)
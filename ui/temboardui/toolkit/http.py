@@ -4,7 +4,11 @@ from __future__ import absolute_import
 import http.client
 import json
 import logging
+import os
+import socket
 import ssl
+import threading
+import zlib
 from datetime import datetime
 try:
     from datetime import timezone
@@ -21,8 +25,134 @@ try:
 except NameError:  # python2
     from socket import error as ConnectionError
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 logger = logging.getLogger(__name__)
+# Errors raised when reusing a connection closed by peer.
+STALE_CONNECTION_ERRORS = (
+    socket.error if PY2 else ConnectionError,
+    http.client.BadStatusLine,
+    http.client.CannotSendRequest,
+)
+# Methods safe to send again on a new connection.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class ConnectionPool(object):
+    # Process-wide pool of idle keep-alive HTTP connections, keyed by scheme,
+    # host, port and CA file. TemboardResponse releases its connection in
+    # the pool once the body is fully read. Collector polls each agent every
+    # minute, idle connections must outlive this interval to be reused. Agent
+    # closes idle connections after 120 seconds, evict them before.
+
+    def __init__(self, max_per_host=4, idle_timeout=90):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = dict()
+        self.requests = 0
+        self.handshakes = 0
+
+    def stats(self):
+        reused = self.requests - self.handshakes
+        return dict(
+            http_requests=self.requests,
+            http_handshakes=self.handshakes,
+            http_reuse_ratio=(
+                round(reused / float(self.requests), 3)
+                if self.requests else 0),
+        )
+
+    def acquire(self, key):
+        # Returns an idle connection for key or None.
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked. Never share sockets with parent process.
+                self.reset()
+            self.evict()
+            conns = self.idle.get(key)
+            if conns:
+                conn, _ = conns.pop()
+                return conn
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if self.pid == os.getpid() and len(conns) < self.max_per_host:
+                conns.append((conn, time()))
+                return
+        conn.close()
+
+    def count(self, handshake):
+        with self.lock:
+            self.requests += 1
+            if handshake:
+                self.handshakes += 1
+
+    def evict(self):
+        # Close connections idle for too long. Caller must hold lock.
+        deadline = time() - self.idle_timeout
+        for key, conns in list(self.idle.items()):
+            for conn, released in conns:
+                if released < deadline:
+                    conn.close()
+            conns[:] = [i for i in conns if i[1] >= deadline]
+            if not conns:
+                del self.idle[key]
+
+    def clear(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+connection_pool = ConnectionPool()
+# Content codings supported by this process, by order of preference.
+ACCEPT_ENCODING = 'zstd, gzip' if zstandard else 'gzip'
+
+
+def negotiate_encoding(accept_encoding):
+    # Choose a content coding from Accept-Encoding request header, or None.
+    # Quality values are ignored.
+    accepted = [
+        coding.split(';')[0].strip().lower()
+        for coding in (accept_encoding or '').split(',')
+    ]
+    for coding in ACCEPT_ENCODING.split(', '):
+        if coding in accepted:
+            return coding
+
+
+def compressobj(coding):
+    # Returns a streaming compressor with compress() and flush() methods.
+    if 'zstd' == coding:
+        return zstandard.ZstdCompressor().compressobj()
+    elif 'gzip' == coding:
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raise ValueError("Unsupported content coding %s." % coding)
+
+
+def decompressobj(coding):
+    # Returns a streaming decompressor with a decompress() method, or None
+    # for identity.
+    coding = (coding or 'identity').lower()
+    if 'identity' == coding:
+        return None
+    elif 'zstd' == coding and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif 'gzip' == coding:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    raise ValueError("Unsupported content coding %s." % coding)
 
 
 class TemboardHTTPError(TemboardError):
@@ -53,6 +183,11 @@ class TemboardClient(object):
     Error = TemboardHTTPError
 
     log_headers = False
+    # Socket timeout in seconds.
+    timeout = 30
+    # Time after which connecting, sending request or reading response
+    # raises socket.timeout, or None.
+    deadline = None
 
     @classmethod
     def factory(cls, config, host, port, scheme='https'):
@@ -110,25 +245,33 @@ class TemboardClient(object):
         if body is not None:
             body = ensure_bytes(body)
 
-        if 'https' == self.scheme:
-            conn = http.client.HTTPSConnection(
-                self.host, self.port, context=self.ssl_context, timeout=30,
-            )
-        else:
-            conn = http.client.HTTPConnection(
-                self.host, self.port, timeout=30,
-            )
-        conn.response_class = TemboardResponse
-
         if self.log_headers:
             for name, value in sorted(headers.items()):
                 logger.debug(">>> %s: %s", name, value)
 
+        pool_key = (self.scheme, self.host, self.port, self.ca_cert_file)
         start_time = time()
-        conn.request(method, path, body, headers)
-        response = conn.getresponse()
+        # Only idempotent requests can be sent again if a pooled connection
+        # turns out stale. Other requests always use a new connection.
+        conn = None
+        if method in IDEMPOTENT_METHODS:
+            conn = connection_pool.acquire(pool_key)
+        response = None
+        if conn:
+            try:
+                response = self.send(conn, method, path, body, headers)
+            except STALE_CONNECTION_ERRORS as e:
+                logger.debug(
+                    "Dropping stale connection to %s: %s", hostport, e)
+                conn.close()
+        if response is None:
+            conn = self.connect()
+            response = self.send(conn, method, path, body, headers)
         duration = time() - start_time
         response.path = path
+        response.pool_key = pool_key
+        response.pool_conn = conn
+        response.deadline = self.deadline
 
         if self.log_headers:
             for name, value in sorted(response.headers.items()):
@@ -144,6 +287,38 @@ class TemboardClient(object):
 
         return response
 
+    def connect(self):
+        if 'https' == self.scheme:
+            conn = http.client.HTTPSConnection(
+                self.host, self.port, context=self.ssl_context,
+                timeout=self.timeout,
+            )
+        else:
+            conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout,
+            )
+        conn.response_class = TemboardResponse
+        return conn
+
+    def send(self, conn, method, path, body, headers):
+        # A connection without socket will handshake on request.
+        connection_pool.count(handshake=conn.sock is None)
+        conn.timeout = self.remaining_timeout()
+        if conn.sock:
+            conn.sock.settimeout(conn.timeout)
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def remaining_timeout(self):
+        # Bound connection, request and response headers by time left before
+        # deadline.
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time()
+        if remaining <= 0:
+            raise socket.timeout("Request deadline exceeded.")
+        return min(self.timeout, remaining)
+
     def get(self, path, headers=None):
         return self.request('GET', path, headers)
 
@@ -154,10 +329,38 @@ class TemboardClient(object):
 class TemboardResponse(http.client.HTTPResponse):
     # Extensions to HTTPResponse, inspired by httpx
 
+    pool_key = None
+    pool_conn = None
+    # Time after which reading body raises socket.timeout, or None.
+    deadline = None
+    # Whether the body has been closed before being fully read.
+    _discard = False
+
     if PY2:
         @property
         def headers(self):
             return dict(self.getheaders())
+    else:
+        def _close_conn(self):
+            # Called on end of body or on close().
+            http.client.HTTPResponse._close_conn(self)
+            self.release()
+
+    def close(self):
+        if self.fp:
+            # Unread body remains in socket, don't reuse connection.
+            self._discard = True
+        http.client.HTTPResponse.close(self)
+
+    def release(self):
+        # Give back connection to pool, unless server closes it.
+        conn, self.pool_conn = self.pool_conn, None
+        if conn is None:
+            return
+        if self.will_close or self._discard:
+            conn.close()
+        else:
+            connection_pool.release(self.pool_key, conn)
 
     def __str__(self):
         return '%s %s' % (self.status, self.reason)
@@ -177,7 +380,64 @@ class TemboardResponse(http.client.HTTPResponse):
             raise HTTPError(self.status, self.reason)
 
     def json(self):
-        return json.loads(self.read().decode('utf-8'))
+        return json.loads(b''.join(self.iter_content()).decode('utf-8'))
+
+    def iter_content(self, chunk_size=64 * 1024):
+        # Yields decoded body by chunks, decompressing body according to
+        # Content-Encoding.
+        decompressor = decompressobj(self.getheader('content-encoding'))
+        # On streamed body, read1() returns available data without waiting
+        # for a full chunk. read() closes connection at end of sized body.
+        if self.length is None and hasattr(self, 'read1'):
+            read = self.read1
+        else:
+            read = self.read
+        while True:
+            self.wait_deadline()
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            yield chunk
+        # Decompressor may hold the end of last block.
+        if decompressor and hasattr(decompressor, 'flush'):
+            yield decompressor.flush()
+
+    def wait_deadline(self):
+        # Bound next socket read by time left before deadline. A peer
+        # sending body byte by byte can't extend reading beyond deadline.
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time()
+        if remaining <= 0:
+            raise socket.timeout("Response deadline exceeded.")
+        sock = self.pool_conn.sock if self.pool_conn else None
+        if sock:
+            sock.settimeout(min(remaining, sock.gettimeout() or remaining))
+
+    def iter_lines(self):
+        pending = b''
+        for chunk in self.iter_content():
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
+    def iter_json(self):
+        # Yields documents from a newline delimited JSON body, line by line,
+        # or from a JSON array body.
+        if 'ndjson' not in (self.getheader('content-type') or ''):
+            for document in self.json():
+                yield document
+            return
+
+        for line in self.iter_lines():
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
 
 
 def format_date(date=None):
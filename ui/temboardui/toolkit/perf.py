@@ -4,6 +4,8 @@ import logging
 import os
 import signal
 
+from .http import connection_pool
+
 
 logger = logging.getLogger(__name__)
 SC_CLK_TCK = os.sysconf('SC_CLK_TCK')
@@ -92,6 +94,10 @@ class PerfCounters(dict):
             loadavg = fo.read()
         self['load1'], self['load5'], self['load15'], _ = loadavg.split(' ', 3)
 
+        # HTTP CLIENT, only for processes requesting agents.
+        if connection_pool.requests:
+            self.update(connection_pool.stats())
+
 
 def parse(lines):
     for line in lines:
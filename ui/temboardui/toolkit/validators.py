@@ -140,6 +140,23 @@ def commalist(raw):
     return list(filter(None, [w.strip() for w in raw.split(',')]))
 
 
+def intervals(raw):
+    # Parse a comma separated list of name=seconds.
+    if isinstance(raw, dict):
+        return raw
+
+    intervals = {}
+    for entry in commalist(raw):
+        name, sep, seconds = entry.partition('=')
+        if not sep:
+            raise ValueError('%s is not name=seconds' % entry)
+        seconds = int(seconds)
+        if seconds < 0:
+            raise ValueError('Negative interval for %s' % name)
+        intervals[name.strip()] = seconds
+    return intervals
+
+
 def nday(raw):
     nday = int(raw)
 
@@ -0,0 +1,64 @@
+def test_lttb():
+    from temboardui.plugins.monitoring.downsample import lttb
+
+    xs = list(range(10))
+    ys = [0, 0, 0, 9, 0, 0, 0, 0, 0, 1]
+    selected = lttb(xs, [ys], 4)
+    assert 4 == len(selected)
+    assert 0 == selected[0]
+    assert 9 == selected[-1]
+    # Peak is kept.
+    assert 3 in selected
+
+
+def test_lttb_constant_sum():
+    from temboardui.plugins.monitoring.downsample import lttb
+
+    # Used and free memory: sum is flat, each serie has its own peak.
+    xs = list(range(100))
+    used = [10.] * 100
+    used[42] = 90.
+    used[77] = 5.
+    free = [100. - u for u in used]
+    selected = lttb(xs, [used, free], 10)
+    assert 10 == len(selected)
+    assert 42 in selected
+    assert 77 in selected
+
+
+def test_downsample_csv():
+    from temboardui.plugins.monitoring.downsample import downsample_csv
+
+    rows = [
+        "2023-01-01 00:%02d:00+00,%s," % (i, 100 if i == 30 else 1)
+        for i in range(60)
+    ]
+    data = "date,a,b\n" + "\n".join(rows) + "\n"
+
+    assert data == downsample_csv(data, 100)
+
+    out = downsample_csv(data, 10).splitlines()
+    assert "date,a,b" == out[0]
+    assert 11 == len(out)
+    assert rows[0] == out[1]
+    assert rows[30] in out
+    assert rows[-1] == out[-1]
+
+
+def test_downsample_columns():
+    from temboardui.plugins.monitoring.downsample import downsample_columns
+
+    columns = dict(
+        timestamps=list(range(60)),
+        series=dict(
+            a=[100. if i == 30 else 1. for i in range(60)],
+            b=[None] * 60,
+        ),
+    )
+    assert columns is downsample_columns(columns, 100)
+
+    out = downsample_columns(columns, 10)
+    assert 10 == len(out['timestamps'])
+    assert 30 in out['timestamps']
+    assert 10 == len(out['series']['a'])
+    assert 100. in out['series']['a']
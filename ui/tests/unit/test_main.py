@@ -21,3 +21,19 @@ def test_pgvar_map():
     env = dict(PGHOST='pg', TEMBOARD_REPOSITORY_HOST='temboard')
     mapped = map_pgvars(env)
     assert 'temboard' == mapped['TEMBOARD_REPOSITORY_HOST']
+
+
+def test_benchmark_timings():
+    from temboardui.cli.benchmark import format_timings, percentile
+
+    values = [float(i) for i in range(1, 101)]
+    assert 50. == percentile(values, 50)
+    assert 99. == percentile(values, 99)
+    assert 1. == percentile([1.], 90)
+
+    table = format_timings({'home instances': [.001, .003, .002]})
+    header, line = table.splitlines()
+    assert header.split() == [
+        'path', 'n', 'p50', 'ms', 'p90', 'ms', 'p99', 'ms', 'max', 'ms']
+    assert line.split() == [
+        'home', 'instances', '3', '2.0', '3.0', '3.0', '3.0']
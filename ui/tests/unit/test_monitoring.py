@@ -0,0 +1,414 @@
+import threading
+
+
+def test_build_metric_row():
+    from temboardui.plugins.monitoring.model.db import build_metric_row
+
+    row = build_metric_row('xacts', 1, 2, dict(
+        datetime='2023-01-01 00:00:00 +0000',
+        dbname='postgres',
+        measure_interval=60.1,
+        n_commit=10,
+        n_rollback=1,
+    ))
+    assert ('2023-01-01 00:00:00 +0000', 2, 'postgres',
+            (None, '60.1', 10, 1)) == row
+
+    row = build_metric_row('loadavg', 1, 2, dict(
+        datetime='2023-01-01 00:00:00 +0000',
+        load1=1., load5=.5, load15=.1,
+    ))
+    assert ('2023-01-01 00:00:00 +0000', 1, (None, 1., .5, .1)) == row
+
+
+def test_group_metric_rows():
+    from temboardui.plugins.monitoring.model.db import group_metric_rows
+
+    tables = group_metric_rows(1, 2, dict(
+        db_size=[
+            dict(datetime='d0', dbname='postgres', size=1),
+            dict(datetime='d0', dbname='template1', size=2),
+            # Missing size, point is skipped.
+            dict(datetime='d0', dbname='broken'),
+        ],
+        tblspc_size=[dict(datetime='d0', spcname='pg_default', size=3)],
+        replication_lag=[],
+        max_connections=100,
+    ))
+
+    assert ['metric_db_size_current', 'metric_tblspc_size_current'] == \
+        sorted(tables)
+    assert 2 == len(tables['metric_db_size_current'])
+
+
+def test_insert_metric_rows(mocker):
+    from temboardui.plugins.monitoring.model.db import insert_metric_rows
+
+    session = mocker.Mock(name='session')
+    cur = session.connection.return_value.connection.cursor.return_value
+    cur.mogrify.side_effect = lambda tpl, row: repr(row).encode('ascii')
+
+    rows = [('d%s' % i, 1, (None, i)) for i in range(5)]
+    assert 5 == insert_metric_rows(
+        session, 'metric_loadavg_current', rows, page_size=2)
+
+    # 5 rows by page of 2 rows.
+    assert 3 == cur.execute.call_count
+    sql = cur.execute.call_args_list[0][0][0]
+    assert sql.startswith(b'INSERT INTO monitoring.metric_loadavg_current')
+
+
+def test_collector_sweep(mocker):
+    mod = 'temboardui.plugins.monitoring'
+    mocker.patch(mod + '.worker_engine')
+    fetch_history = mocker.patch(mod + '.fetch_history')
+    store_history = mocker.patch(mod + '.store_history')
+
+    from temboardui.plugins.monitoring import collector_sweep
+
+    def fetch(app, engine, address, port, key, timeout):
+        if 'down' == address:
+            return None
+        if 'buggy' == address:
+            raise Exception("Buggy agent")
+        return ('instance', 1, 'etag', [])
+
+    fetch_history.side_effect = fetch
+    threads = []
+    store_history.side_effect = (
+        lambda *a: threads.append(threading.current_thread()))
+    app = mocker.Mock(name='app')
+    app.config.monitoring.collector_concurrency = 4
+    app.config.monitoring.collector_timeout = 5
+
+    collector_sweep(app, agents=[
+        ('up', 2345, 'key'),
+        ('down', 2345, 'key'),
+        ('buggy', 2345, 'key'),
+    ])
+
+    assert 3 == fetch_history.call_count
+    assert 1 == store_history.call_count
+    # History is stored in agent thread, not after the sweep.
+    assert threading.main_thread() is not threads[0]
+
+
+def test_inventory_cache(mocker):
+    from temboardui.plugins.monitoring.tools import InventoryCache
+
+    prefix = 'temboardui.plugins.monitoring.tools.'
+    merge = mocker.patch(prefix + 'merge_agent_info')
+    merge.return_value.host_id = 1
+    mocker.patch(prefix + 'get_instance_id', return_value=2)
+    mocker.patch(prefix + 'populate_host_checks')
+    mocker.patch(prefix + 'get_instance_checks', return_value=[])
+
+    cache = InventoryCache()
+    hostinfo = dict(hostname='pouet', cpu_count=4, memory_size=1024,
+                    cpu_MHz=2400, filesystems=[dict(used=1)])
+    instance = dict(port=5432, available=True, version='15.2',
+                    data_directory='/pgdata', dbnames=[dict(size=8000)])
+    entry = cache.resolve(None, 'agent', 5432, hostinfo, instance, 'etag')
+    assert 1 == entry['host_id']
+    assert 2 == entry['instance_id']
+    # merge_agent_info() must not alter fingerprinted data.
+    assert 'host_id' not in hostinfo
+
+    # Volatile data changes on each payload and does not trigger a merge.
+    entry['last_insert'] = 'last'
+    hostinfo.update(cpu_MHz=2600, filesystems=[dict(used=2)])
+    instance['dbnames'] = [dict(size=9000)]
+    assert entry is cache.resolve(
+        None, 'agent', 5432, hostinfo, instance, 'etag')
+    assert 1 == merge.call_count
+
+    hostinfo['memory_size'] = 2048
+    entry = cache.resolve(None, 'agent', 5432, hostinfo, instance, 'etag')
+    assert 2 == merge.call_count
+    assert 'last' == entry['last_insert']
+
+    cache.resolve(None, 'agent', 5432, hostinfo, instance, 'etag2')
+    assert 3 == merge.call_count
+
+    # Fingerprint is loaded from collector status by next task.
+    fingerprint = cache['agent']['fingerprint']
+    session = mocker.Mock(name='session')
+    query = session.query.return_value.filter.return_value
+    query.first.return_value = mocker.Mock(
+        inventory_fingerprint=fingerprint, last_insert='last')
+    cache = InventoryCache()
+    entry = cache.load(session, 'agent', 1, 2)
+    assert 'last' == entry['last_insert']
+    assert entry is cache.resolve(
+        None, 'agent', 5432, hostinfo, instance, 'etag2')
+    assert 3 == merge.call_count
+
+
+def test_check_preprocessed_data(mocker):
+    from temboardui.plugins.monitoring.tools import check_preprocessed_data
+
+    db = mocker.patch('temboardui.plugins.monitoring.tools.db')
+    app = mocker.Mock(name='app')
+    session = mocker.Mock(name='session')
+    load1 = mocker.Mock(check_id=1, host_id=1, enabled=True)
+    load1.name = 'load1'
+    disabled = mocker.Mock(check_id=2, host_id=1, enabled=False)
+    disabled.name = 'cpu_core'
+    state = mocker.Mock(check_id=1, key='None', state='OK')
+    session.query.return_value.filter.return_value.all.return_value = [
+        load1, disabled]
+    session.query.return_value.filter.return_value.__iter__ = (
+        lambda self: iter([state]))
+
+    check_preprocessed_data(app, session, 1, 1, [
+        dict(datetime='d', name='load1', key=None,
+             value=5, warning=2, critical=4),
+        dict(datetime='d', name='cpu_core', key=None,
+             value=5, warning=2, critical=4),
+    ])
+
+    # Only load1 transitioned.
+    assert 1 == app.scheduler.schedule_task.call_count
+    options = app.scheduler.schedule_task.call_args[1]['options']
+    assert 'OK' == options['prev_state']
+    assert 'CRITICAL' == options['state']
+    db.upsert_check_states.assert_called_once_with(
+        session, [(1, 'None', 'CRITICAL')])
+    db.append_state_changes.assert_called_once_with(
+        session, [('d', 1, 'CRITICAL', 'None', 5, 2, 4)])
+    db.purge_check_states.assert_called_once_with(session, {1: ['None']})
+    db.undef_check_states.assert_called_once_with(session, [1, 2], [1])
+    assert 1 == session.commit.call_count
+
+
+def test_process_metric_tables(mocker):
+    from datetime import timedelta
+    from temboardui.plugins.monitoring import process_metric_tables
+
+    mod = 'temboardui.plugins.monitoring'
+    engine = mocker.patch(mod + '.worker_engine').return_value
+    conn = engine.connect.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.side_effect = [
+        (dict(a=dict(name='a', record_type='a', aggregate='a30m'),
+              b=dict(name='b', record_type='b', aggregate='b30m')),),
+        ('metric_a', 1),
+        Exception('Failed'),
+    ]
+    app = mocker.Mock(name='app')
+    app.config.monitoring.maintenance_concurrency = 1
+    mocker.patch(mod + '.Stopwatch').return_value.last_delta = timedelta()
+
+    process_metric_tables(
+        app, 'aggregate_data_single', 'aggregate', 'aggregating')
+
+    sql = [c[0][0] for c in conn.execute.call_args_list]
+    assert 2 == sql.count(
+        "SELECT * FROM aggregate_data_single(%s, %s, %s)")
+    assert engine.dispose.called
+
+
+def test_chart_cache():
+    from temboardui.plugins.monitoring.chartdata import ChartCache
+
+    cache = ChartCache(max_size=8)
+    _, etag, _ = cache.set('a', u'aaaa', version=1)
+    assert (u'aaaa', etag, 1) == cache.get('a', version=1)
+    # New points stored, entry is outdated.
+    assert cache.get('a', version=2) is None
+    assert 0 == cache.size
+
+    cache.set('a', u'aaaa')
+    cache.set('b', u'bbbb')
+    cache.get('a')
+    # Least recently used entry is evicted.
+    cache.set('c', u'cccc')
+    assert ['a', 'c'] == list(cache.entries)
+    assert 8 == cache.size
+
+
+def test_round_range():
+    from datetime import datetime, timedelta
+    from temboardui.plugins.monitoring.chartdata import round_range
+
+    start = datetime(2023, 1, 1, 12, 10, 30)
+    rstart, rend = round_range(start, start + timedelta(days=10), 1800)
+    assert datetime(2023, 1, 1, 12) == rstart
+    assert datetime(2023, 1, 11, 12, 30) == rend
+
+
+def test_select_tier():
+    import calendar
+    from datetime import datetime, timedelta
+    from temboardui.plugins.monitoring.chartdata import RAW_TIER, select_tier
+
+    tiers = [('5m', 300), ('30m', 1800), ('6h', 21600), ('1d', 86400)]
+    start = datetime(2023, 1, 1)
+
+    def select(days, points=None):
+        return select_tier(tiers, start, start + timedelta(days=days), points)
+
+    assert RAW_TIER == select(1)
+    assert '5m' == select(3)[0]
+    assert '30m' == select(31)[0]
+    assert '6h' == select(365)[0]
+    assert '1d' == select(3 * 365)[0]
+    # Wider charts get finer tier.
+    assert '5m' == select(31, points=2000)[0]
+    assert RAW_TIER == select_tier([], start, None)
+
+    # 5m tier is still backfilled, fallback to raw points. Up to date 30m
+    # tier is used despite its last bucket is not complete.
+    end = start + timedelta(days=31)
+    watermarks = {'5m': 0, '30m': calendar.timegm(end.utctimetuple()) - 1800}
+    assert RAW_TIER == select_tier(
+        tiers, start, start + timedelta(days=3), watermarks=watermarks)
+    assert '30m' == select_tier(tiers, start, end, watermarks=watermarks)[0]
+
+
+def test_get_tier_watermarks(mocker):
+    from temboardui.plugins.monitoring import chartdata
+
+    mocker.patch.object(
+        chartdata, 'get_rollup_tiers', return_value=[('5m', 300)])
+    session = mocker.Mock(name='session')
+    session.execute.return_value.fetchall.side_effect = [
+        [('metric_blocks_5m_current', 1000.)],
+        [('metric_blocks_5m_current', 1300.)],
+    ]
+
+    # Watermarks are read from repository on each call.
+    assert {'5m': 1000.} == chartdata.get_tier_watermarks(session, ['blocks'])
+    assert {'5m': 1300.} == chartdata.get_tier_watermarks(session, ['blocks'])
+    # Slowest metric sets the watermark, unknown is not aggregated yet.
+    session.execute.return_value.fetchall.side_effect = [
+        [('metric_blocks_5m_current', 1000.)],
+    ]
+    assert {'5m': 0} == chartdata.get_tier_watermarks(
+        session, ['blocks', 'checkpoints'])
+
+
+def test_get_metrics_data_cached(mocker):
+    import calendar
+    from datetime import datetime, timedelta
+    from temboardui.plugins.monitoring import chartdata
+
+    mocker.patch.object(chartdata, 'chart_cache', chartdata.ChartCache())
+    mocker.patch.object(chartdata, 'get_rollup_tiers', return_value=[])
+    mocker.patch.object(chartdata, 'get_tier_watermarks', return_value={})
+    get_last_insert = mocker.patch.object(
+        chartdata, 'get_last_insert', return_value=datetime(2023, 1, 1))
+    get_csv = mocker.patch.object(
+        chartdata, 'get_metric_data_csv', side_effect=lambda s, m, *a, **kw: m)
+
+    start = datetime.utcnow() - timedelta(hours=1)
+    for _ in range(2):
+        data, etags, last_modified, closed = chartdata.get_metrics_data_cached(
+            None, ['tps', 'sessions'], start, None, host_id=1, instance_id=1)
+        assert dict(tps='tps', sessions='sessions') == data
+        assert 2 == len(etags)
+        assert not closed
+
+    assert 2 == get_csv.call_count
+    assert 2 == get_last_insert.call_count
+    assert datetime(2023, 1, 1) == last_modified
+
+    # Range is closed according to its end rounded to minute.
+    now = datetime(2023, 1, 2, 12, 0, 30)
+    mocker.patch.object(
+        chartdata.time, 'time', return_value=calendar.timegm(now.timetuple()))
+    start = datetime(2023, 1, 1, 12)
+    _, _, last_modified, closed = chartdata.get_metrics_data_cached(
+        None, ['tps'], start, datetime(2023, 1, 2, 0, 0, 10),
+        host_id=1, instance_id=1)
+    assert not closed
+    assert datetime(2023, 1, 1) == last_modified
+    _, _, last_modified, closed = chartdata.get_metrics_data_cached(
+        None, ['tps'], start, datetime(2023, 1, 1, 23, 59, 10),
+        host_id=1, instance_id=1)
+    assert closed
+    assert datetime(2023, 1, 2) == last_modified
+
+
+def test_get_metric_data_columns(mocker):
+    from datetime import datetime
+    from decimal import Decimal
+    from temboardui.plugins.monitoring.chartdata import (
+        get_metric_data_columns)
+
+    session = mocker.Mock(name='session')
+    cur = session.connection.return_value.connection.cursor.return_value
+    cur.mogrify.return_value = b'SELECT'
+    cur.description = [('date',), ('dbname',), ('size',)]
+    t0, t1 = datetime(2023, 1, 1), datetime(2023, 1, 1, 0, 1)
+    cur.fetchall.return_value = [
+        (t0, 'a', Decimal('1')),
+        (t0, 'b', 2),
+        (t1, 'b', 3),
+        (t1, 'c', None),
+    ]
+
+    columns = get_metric_data_columns(
+        session, 'db_size', t0, t1, instance_id=1, tier=(None, 60))
+
+    assert [1672531200000, 1672531260000] == columns['timestamps']
+    assert dict(a=[1., None], b=[2., 3.], c=[None, None]) == dict(
+        columns['series'])
+    assert ['a', 'b', 'c'] == list(columns['series'])
+
+
+def test_format_metric_query_rates(mocker):
+    from temboardui.plugins.monitoring.chartdata import (
+        METRICS, format_metric_query)
+
+    cur = mocker.Mock(name='cursor')
+    cur.mogrify.side_effect = lambda q, p: (q % p).encode('utf-8')
+
+    query = format_metric_query(
+        cur, METRICS['tps'], 'start', 'end', 1, 1, None, '30m')
+    assert 'FROM metric_xacts_30m_rates' in query
+    assert 'measure_interval' not in query
+
+    query = format_metric_query(
+        cur, METRICS['locks'], 'start', 'end', 1, 1, None, '30m')
+    assert 'FROM metric_locks_30m_current' in query
+
+
+def test_format_metric_query_raw(mocker):
+    from temboardui.plugins.monitoring.chartdata import (
+        METRICS, format_metric_query)
+
+    cur = mocker.Mock(name='cursor')
+    cur.mogrify.side_effect = lambda q, p: (q % p).encode('utf-8')
+
+    for name, metric in METRICS.items():
+        query = format_metric_query(
+            cur, metric, 'start', 'end', 1, 1, None, None)
+        assert 'expand_data' not in query, name
+        assert '%s_history' % metric['expand'][0] in query, name
+        assert 'lower(history_range)' in query, name
+
+    query = format_metric_query(
+        cur, METRICS['db_size'], 'start', 'end', 1, 2, None, None)
+    assert 'WHERE instance_id = 2' in query
+
+
+def test_format_metric_query_columnar(mocker):
+    from temboardui.plugins.monitoring.chartdata import (
+        METRICS, format_metric_query)
+
+    cur = mocker.Mock(name='cursor')
+    cur.mogrify.side_effect = lambda q, p: (q % p).encode('utf-8')
+
+    query = format_metric_query(
+        cur, METRICS['ctxforks'], 'start', 'end', 1, 2, None, None)
+    assert (
+        'unnest(datetime, measure_interval, context_switches, forks)'
+    ) in query
+    assert (
+        'ROW(c.datetime, c.measure_interval, c.context_switches, c.forks,'
+        ' NULL, NULL, NULL)::metric_process_record'
+    ) in query
+
+    query = format_metric_query(
+        cur, METRICS['heap_bloat'], 'start', 'end', 1, 2, None, None)
+    assert '::metric_bloat_ratio_record' in query
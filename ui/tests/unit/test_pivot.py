@@ -30,3 +30,11 @@ def test_pivot():
         output=out_
     )
     assert out_.getvalue() == expected
+
+
+def test_pivot_empty():
+    from temboardui.plugins.monitoring.pivot import pivot_timeserie
+
+    out_ = StringIO()
+    pivot_timeserie(StringIO(""), 'i', 'k', 'v', output=out_)
+    assert "i\n" == out_.getvalue()
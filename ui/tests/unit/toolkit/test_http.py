@@ -0,0 +1,259 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def keepalive_server():
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if '/trickle' == self.path:
+                return self.trickle()
+            if '/stall' == self.path:
+                # Never answer, but keep connection open.
+                time.sleep(5)
+                return
+            body = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.do_GET()
+
+        def trickle(self):
+            # Send a stream byte by byte, for ever.
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            try:
+                while True:
+                    self.wfile.write(b'{"a": 1}\n'[:1])
+                    self.wfile.flush()
+                    time.sleep(.05)
+            except (OSError, ValueError):
+                pass
+
+        def log_message(self, *a):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_pool_evict(mocker):
+    from temboardui.toolkit.http import ConnectionPool
+
+    pool = ConnectionPool(max_per_host=1, idle_timeout=10)
+    first, second = mocker.Mock(), mocker.Mock()
+    pool.release('key', first)
+    pool.release('key', second)
+    # Pool is full, second connection is closed.
+    assert second.close.called
+
+    mocker.patch('temboardui.toolkit.http.time', return_value=1e12)
+    assert pool.acquire('key') is None
+    assert first.close.called
+
+
+def test_client_reuse(keepalive_server, mocker):
+    from temboardui.toolkit import http
+
+    pool = http.ConnectionPool()
+    mocker.patch.object(http, 'connection_pool', pool)
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+
+    assert {'ok': True} == client.get('/').json()
+    assert 1 == len(pool.idle)
+    assert {'ok': True} == client.get('/').json()
+
+    stats = pool.stats()
+    assert 2 == stats['http_requests']
+    assert 1 == stats['http_handshakes']
+    assert .5 == stats['http_reuse_ratio']
+
+
+def test_client_reuse_polls(keepalive_server, mocker):
+    from temboardui.toolkit import http
+
+    pool = http.ConnectionPool()
+    mocker.patch.object(http, 'connection_pool', pool)
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+    clock = [time.time()]
+    mocker.patch('temboardui.toolkit.http.time', side_effect=lambda: clock[0])
+
+    # Collector polls agent each minute on the same connection.
+    for _ in range(3):
+        assert {'ok': True} == client.get('/').json()
+        clock[0] += 60
+    assert 1 == pool.stats()['http_handshakes']
+
+    # Connection idle for too long is not reused.
+    clock[0] += pool.idle_timeout
+    assert {'ok': True} == client.get('/').json()
+    assert 2 == pool.stats()['http_handshakes']
+
+
+def test_client_stale(keepalive_server, mocker):
+    from temboardui.toolkit import http
+
+    pool = http.ConnectionPool()
+    mocker.patch.object(http, 'connection_pool', pool)
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+
+    stale = client.connect()
+    stale.request = mocker.Mock(side_effect=ConnectionResetError())
+    pool.release(pool_key(client), stale)
+
+    assert {'ok': True} == client.get('/').json()
+    assert stale.request.called
+    assert 2 == pool.stats()['http_handshakes']
+
+
+def test_client_post_not_pooled(keepalive_server, mocker):
+    from temboardui.toolkit import http
+
+    pool = http.ConnectionPool()
+    mocker.patch.object(http, 'connection_pool', pool)
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+
+    idle = client.connect()
+    idle.request = mocker.Mock(side_effect=ConnectionResetError())
+    pool.release(pool_key(client), idle)
+
+    # POST is never sent on a pooled connection, it can't be sent again.
+    assert {'ok': True} == client.post('/', body={'a': 1}).json()
+    assert not idle.request.called
+
+
+def pool_key(client):
+    return client.scheme, client.host, client.port, client.ca_cert_file
+
+
+def build_response(body, **headers):
+    from io import BytesIO
+    from temboardui.toolkit.http import TemboardResponse
+
+    class FakeSocket(object):
+        def makefile(self, *a, **kw):
+            return BytesIO(raw)
+
+    headers.setdefault('Content-Length', str(len(body)))
+    raw = b'HTTP/1.1 200 OK\r\n' + b''.join(
+        ('%s: %s\r\n' % (k.replace('_', '-'), v)).encode('ascii')
+        for k, v in headers.items()
+    ) + b'\r\n' + body
+    response = TemboardResponse(FakeSocket())
+    response.begin()
+    return response
+
+
+def test_response_iter_json():
+    body = b'{"a": 1}\n\n{"a": 2}\n'
+    response = build_response(body, Content_Type='application/x-ndjson')
+    assert [{'a': 1}, {'a': 2}] == list(response.iter_json())
+
+    response = build_response(b'[{"a": 1}]', Content_Type='application/json')
+    assert [{'a': 1}] == list(response.iter_json())
+
+
+def test_response_gzip():
+    import zlib
+    from temboardui.toolkit.http import compressobj, negotiate_encoding
+
+    assert 'gzip' == negotiate_encoding('deflate, gzip;q=0.8')
+    assert negotiate_encoding('br') is None
+
+    compressor = compressobj('gzip')
+    body = compressor.compress(b'{"a": 1}\n{"a": 2}\n') + compressor.flush()
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS).startswith(b'{"a": 1}')
+
+    response = build_response(
+        body, Content_Type='application/x-ndjson', Content_Encoding='gzip')
+    assert [{'a': 1}, {'a': 2}] == list(response.iter_json())
+
+
+def test_response_decompress_flush(mocker):
+    from temboardui.toolkit import http
+
+    body = b'{"a": 1}\n{"a": 2}\n'
+    compressor = http.compressobj('gzip')
+    response = build_response(
+        compressor.compress(body) + compressor.flush(),
+        Content_Encoding='gzip')
+    # Last chunk ends in the middle of a deflate block.
+    assert body == b''.join(response.iter_content(chunk_size=7))
+
+    class Buffered(object):
+        # Holds back last byte until flush().
+        held = b''
+
+        def decompress(self, data):
+            data, self.held = self.held + data[:-1], data[-1:]
+            return data
+
+        def flush(self):
+            return self.held
+
+    mocker.patch.object(http, 'decompressobj', return_value=Buffered())
+    response = build_response(body, Content_Encoding='gzip')
+    assert body == b''.join(response.iter_content(chunk_size=7))
+
+
+def test_response_deadline(keepalive_server):
+    import socket
+    from temboardui.toolkit import http
+
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+    response = client.get('/trickle')
+    response.deadline = time.time() + .3
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        list(response.iter_content(chunk_size=1))
+    assert time.time() - start < 1
+
+
+def test_client_deadline(keepalive_server):
+    import socket
+    from temboardui.toolkit import http
+
+    client = http.TemboardClient(
+        '127.0.0.1', keepalive_server.server_address[1], scheme='http')
+    # Deadline bounds waiting for response headers, not only body.
+    client.deadline = time.time() + .3
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        client.get('/stall')
+    assert time.time() - start < 1
+
+    # Deadline already passed, agent is not even contacted.
+    with pytest.raises(socket.timeout):
+        client.get('/')
+
+    client.deadline = time.time() + 10
+    response = client.get('/')
+    assert client.deadline == response.deadline
+    assert {'ok': True} == response.json()
@@ -113,6 +113,19 @@ def test_port():
         v.port('pouet')
 
 
+def test_intervals():
+    intervals = v.intervals("db_size=300, heap_bloat=1800")
+    assert dict(db_size=300, heap_bloat=1800) == intervals
+    assert intervals == v.intervals(intervals)
+    assert {} == v.intervals("")
+
+    with pytest.raises(ValueError):
+        v.intervals("db_size")
+
+    with pytest.raises(ValueError):
+        v.intervals("db_size=-1")
+
+
 def test_nday():
     with pytest.raises(ValueError):
         v.nday(-1)